@@ -0,0 +1,200 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Optional
+
+import metrics
+from workers import JobCancelled, get_worker_pool
+from workspace import Workspace
+
+# Запас к размеру файла при резервировании места под его архив
+ARCHIVE_OVERHEAD = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveBuild:
+    """Одна сборка архива: готовые части по порядку и её состояние."""
+
+    def __init__(self, key: tuple) -> None:
+        self.key = key
+        # Каталог в Workspace; появляется, когда под сборку найдётся место
+        self.lease = None
+        self.workdir = None
+        self.pinned = False
+        self.parts = []
+        self.done = False
+        self.error = None
+        self.refs = 0
+        self.expires = 0.0
+        self.task = None
+        # Заменяется новым событием при каждом изменении сборки
+        self.changed = asyncio.Event()
+
+
+class ArchiveBuilds:
+    """
+    Single-flight для архивов: одновременные запросы одного файла
+    (путь, размер, mtime, политика, размер части) читают части одной
+    сборки, а не собирают каждый свой zip. Готовая сборка хранится
+    ещё ttl секунд после последнего читателя, если Workspace не заберёт
+    место раньше. Сборка, которую бросили все читатели до конца,
+    останавливается и удаляется.
+    """
+
+    def __init__(self, ttl: float = 600.0, workspace: Optional[Workspace] = None) -> None:
+        self.ttl = ttl
+        self.workspace = workspace if workspace is not None else Workspace()
+        self._builds = {}
+        self._owners = defaultdict(set)
+        # Удаления каталогов остановленных сборок
+        self._removals = set()
+
+    def __len__(self) -> int:
+        return len(self._builds)
+
+    async def parts(self, file_path: str, part_size: int, policy, owner=None,
+                    st: Optional[os.stat_result] = None):
+        """
+        Асинхронный генератор путей частей архива file_path.
+        Части общие: удалять их нельзя. Бросает JobCancelled после
+        cancel(owner) и ошибки сборки (например, QueueFull или WorkspaceFull).
+        st — уже сделанный stat файла: по нему выбирается сборка.
+        """
+        if st is None:
+            st = os.stat(file_path)
+        key = (os.path.realpath(file_path), st.st_size, st.st_mtime_ns,
+               policy.name, part_size)
+        await self.sweep()
+        build = self._builds.get(key)
+        if build is None:
+            build = self._start(key, file_path, part_size, policy)
+            metrics.ARCHIVE_BUILDS.inc(result='built')
+        else:
+            metrics.ARCHIVE_BUILDS.inc(result='reused' if build.done else 'joined')
+        cancelled = asyncio.Event()
+        self._owners[owner].add(cancelled)
+        build.refs += 1
+        self._hold(build)
+        try:
+            index = 0
+            while True:
+                changed = build.changed
+                if cancelled.is_set():
+                    raise JobCancelled()
+                if index < len(build.parts):
+                    index += 1
+                    yield build.parts[index - 1]
+                    continue
+                if build.error is not None:
+                    raise build.error
+                if build.done:
+                    return
+                await changed.wait()
+        finally:
+            self._owners[owner].discard(cancelled)
+            if not self._owners[owner]:
+                self._owners.pop(owner, None)
+            build.refs -= 1
+            build.expires = time.monotonic() + self.ttl
+            await self._release(build)
+
+    def cancel(self, owner) -> int:
+        """Прерывает чтение частей читателями owner (обычно chat_id)."""
+        events = self._owners.get(owner, set())
+        for event in events:
+            event.set()
+        for build in list(self._builds.values()):
+            self._wake(build)
+        return len(events)
+
+    async def sweep(self) -> int:
+        """Удаляет готовые сборки без читателей с истёкшим ttl."""
+        now = time.monotonic()
+        expired = [b for b in self._builds.values()
+                   if b.refs == 0 and b.done and b.expires <= now]
+        for build in expired:
+            await self._drop(build)
+        return len(expired)
+
+    def _start(self, key, file_path, part_size, policy) -> ArchiveBuild:
+        build = ArchiveBuild(key)
+        self._builds[key] = build
+        build.task = asyncio.get_running_loop().create_task(
+            self._produce(build, file_path, part_size, policy))
+        return build
+
+    async def _produce(self, build, file_path, part_size, policy) -> None:
+        try:
+            # Сжатый архив не больше файла с небольшим запасом
+            build.lease = await self.workspace.reserve(
+                build.key[1] + ARCHIVE_OVERHEAD, on_evict=lambda: self._forget(build))
+            build.workdir = build.lease.path
+            self._hold(build)
+            archive_path = os.path.join(build.workdir, f"{os.path.basename(file_path)}.zip")
+            stream = get_worker_pool().archive_parts(
+                [file_path], archive_path, part_size, owner=build.key, policy=policy)
+            async with contextlib.aclosing(stream):
+                async for part in stream:
+                    build.parts.append(part)
+                    self._wake(build)
+            build.done = True
+            await self.workspace.commit(build.lease)
+            if not build.refs:
+                self._unhold(build)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            build.error = err
+            self._forget(build)
+        finally:
+            self._wake(build)
+
+    def _wake(self, build: ArchiveBuild) -> None:
+        event, build.changed = build.changed, asyncio.Event()
+        event.set()
+
+    def _hold(self, build: ArchiveBuild) -> None:
+        """Пока сборку читают или собирают, Workspace не удаляет её каталог."""
+        if build.lease is not None and not build.pinned:
+            build.pinned = True
+            self.workspace.pin(build.lease)
+
+    def _unhold(self, build: ArchiveBuild) -> None:
+        if build.pinned:
+            build.pinned = False
+            self.workspace.unpin(build.lease)
+
+    async def _release(self, build: ArchiveBuild) -> None:
+        if build.refs:
+            return
+        if not build.done or build.error is not None or self.ttl <= 0:
+            await self._drop(build)
+        else:
+            # Готовая сборка без читателей: её место можно отдать (LRU)
+            self._unhold(build)
+
+    def _forget(self, build: ArchiveBuild) -> None:
+        if self._builds.get(build.key) is build:
+            del self._builds[build.key]
+
+    async def _remove_files(self, build: ArchiveBuild) -> None:
+        if build.lease is not None:
+            await self.workspace.remove(build.lease)
+
+    async def _drop(self, build: ArchiveBuild) -> None:
+        self._forget(build)
+        if build.task is not None and not build.task.done():
+            build.task.cancel()
+            # Каталог удаляется, когда сборка действительно остановится
+            build.task.add_done_callback(lambda _: self._remove_later(build))
+        else:
+            await self._remove_files(build)
+
+    def _remove_later(self, build: ArchiveBuild) -> None:
+        task = asyncio.get_running_loop().create_task(self._remove_files(build))
+        self._removals.add(task)
+        task.add_done_callback(self._removals.discard)
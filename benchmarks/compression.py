@@ -0,0 +1,116 @@
+"""
+Сравнение политик сжатия архивов (core.POLICIES) по времени и размеру
+на синтетическом корпусе: mp3-подобные записи, wav (PCM) и текст.
+
+    python -m benchmarks.compression --size-mb 16 --json
+"""
+import argparse
+import json
+import math
+import os
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import POLICIES, archive_files, build_table  # noqa: E402
+
+
+def make_mp3(path: str, size: int) -> None:
+    """Сжатый звук: заголовки кадров MPEG и случайные данные внутри."""
+    frame = 417
+    header = b'\xff\xfb\x90\x64'
+    with open(path, 'wb') as f:
+        for _ in range(size // frame):
+            f.write(header + os.urandom(frame - len(header)))
+
+
+def make_wav(path: str, size: int) -> None:
+    """Несжатый 16-битный моно PCM: синус с шумом."""
+    rate = 44100
+    samples = size // 2
+    with open(path, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', 36 + samples * 2) + b'WAVE')
+        f.write(b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, rate, rate * 2, 2, 16))
+        f.write(b'data' + struct.pack('<I', samples * 2))
+        noise = os.urandom(samples)
+        block = []
+        for i in range(samples):
+            value = int(8000 * math.sin(2 * math.pi * 440 * i / rate)) + noise[i] - 128
+            block.append(value)
+            if len(block) == 65536:
+                f.write(struct.pack(f'<{len(block)}h', *block))
+                block = []
+        if block:
+            f.write(struct.pack(f'<{len(block)}h', *block))
+
+
+def make_text(path: str, size: int) -> None:
+    """Текстовый лог с именами записей."""
+    with open(path, 'w') as f:
+        written = i = 0
+        while written < size:
+            line = f"{20240000 + i % 1231:08d}-{i % 240000:06d}.mp3 записано {i * 37 % 9973} КБ\n"
+            f.write(line)
+            written += len(line.encode())
+            i += 1
+
+
+CORPORA = {
+    'mp3': ('.mp3', make_mp3),
+    'wav': ('.wav', make_wav),
+    'text': ('.log', make_text),
+}
+
+
+def run(size_mb: int, files: int) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for corpus, (ext, make) in CORPORA.items():
+            paths = []
+            for i in range(files):
+                path = os.path.join(tmpdir, f"{corpus}{i}{ext}")
+                make(path, size_mb * 1024 * 1024 // files)
+                paths.append(path)
+            source = sum(os.path.getsize(p) for p in paths)
+            for name, policy in POLICIES.items():
+                archive_path = os.path.join(tmpdir, f"{corpus}-{name}.zip")
+                started = time.perf_counter()
+                archive_files(paths, archive_path, policy)
+                elapsed = time.perf_counter() - started
+                results.append({
+                    'corpus': corpus,
+                    'policy': name,
+                    'seconds': round(elapsed, 4),
+                    'source_bytes': source,
+                    'archive_bytes': os.path.getsize(archive_path),
+                    'ratio': round(os.path.getsize(archive_path) / source, 4),
+                    'mb_per_s': round(source / elapsed / 1024 / 1024, 1),
+                })
+                os.remove(archive_path)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size-mb', type=int, default=16, help='объём каждого корпуса')
+    parser.add_argument('--files', type=int, default=4, help='файлов в корпусе')
+    parser.add_argument('--json', action='store_true', help='вывести JSON')
+    args = parser.parse_args()
+    results = run(args.size_mb, args.files)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    for corpus in CORPORA:
+        rows = [
+            (r['policy'], f"{r['seconds']:.2f} s  {r['ratio']:.3f}  {r['mb_per_s']} MB/s")
+            for r in results if r['corpus'] == corpus
+        ]
+        print(corpus)
+        print(build_table(rows, 'policy', 'time  ratio  speed'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Память и время построения записей File на большом диске:
+текущий core.File (__slots__, один stat, ленивое форматирование)
+против прежнего варианта (__dict__, два stat, всё считается сразу),
+и загрузка записей в FilesData пачкой против добавления по одной.
+
+    python -m benchmarks.files --files 100000 --json
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hurry.filesize import size  # noqa: E402
+
+from core import File, FilesData, parse_name_stamp  # noqa: E402
+
+
+class LegacyFile:
+    """
+    core.File до перехода на __slots__ и ленивое форматирование
+    (с тем же разбором метки времени, чтобы сравнение было честным).
+    """
+
+    def __init__(self, file: str) -> None:
+        self.file = file
+        self.dir, self.name = os.path.split(file)
+        self.size = os.stat(self.file).st_size
+        self.h_size = size(self.size)
+        self.ctime = os.stat(self.file).st_ctime
+        self.h_ctime = datetime.fromtimestamp(
+            self.ctime).strftime("%d/%m %H:%M:%S")
+        self.date, self.stamp = parse_name_stamp(self.name)
+
+
+def synthetic_stats(count: int) -> list:
+    """Пути и результаты stat для записей вида YYYYMMDD-HHMMSS.mp3."""
+    base = datetime(2023, 1, 1).timestamp()
+    items = []
+    for i in range(count):
+        ctime = base + i * 1800
+        name = datetime.fromtimestamp(ctime).strftime('%Y%m%d-%H%M%S') + '.mp3'
+        path = f"/app/USB/{i % 50:02d}/{name}"
+        st = os.stat_result((0o100644, i, 1, 1, 0, 0, 1024 * (i % 90000 + 1), ctime, ctime, ctime))
+        items.append((path, st))
+    return items
+
+
+def measure(build, items: list) -> dict:
+    """Время построения и прирост памяти для списка записей."""
+    stats = {}
+
+    def fake_stat(path, *args, **kwargs):
+        stats['calls'] = stats.get('calls', 0) + 1
+        return lookup[path]
+
+    lookup = dict(items)
+    with mock.patch('os.stat', fake_stat):
+        gc.collect()
+        started = time.perf_counter()
+        records = [build(path) for path, st in items]
+        elapsed = time.perf_counter() - started
+        del records
+        gc.collect()
+        tracemalloc.start()
+        records = [build(path) for path, st in items]
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    del records
+    return {
+        'seconds': round(elapsed, 4),
+        'bytes': current,
+        'bytes_per_file': round(current / len(items), 1),
+        'stat_calls': stats.get('calls', 0) // 2,
+    }
+
+
+def measure_load(items: list) -> dict:
+    """Секунды на заполнение FilesData: add_file по одной и add_files пачкой."""
+    files = [File(path, st) for path, st in items]
+    # Порядок обхода диска не совпадает ни с одним из порядков индекса
+    files.sort(key=lambda f: f.uid)
+    result = {}
+    for name in ('add_file', 'add_files'):
+        data = FilesData()
+        started = time.perf_counter()
+        if name == 'add_file':
+            for file in files:
+                data.add_file(file)
+        else:
+            data.add_files(files)
+        result[name] = round(time.perf_counter() - started, 4)
+    return result
+
+
+def run(count: int) -> dict:
+    items = synthetic_stats(count)
+    return {
+        'files': count,
+        'legacy': measure(LegacyFile, items),
+        'current': measure(File, items),
+        'load_seconds': measure_load(items),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=100000, help='число записей')
+    parser.add_argument('--json', action='store_true', help='вывести JSON')
+    args = parser.parse_args()
+    result = run(args.files)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    for variant in ('legacy', 'current'):
+        r = result[variant]
+        print(
+            f"{variant:8} {r['seconds']:.3f} s  {r['bytes'] / 1024 / 1024:.1f} MiB"
+            f"  {r['bytes_per_file']:.0f} B/file  stat: {r['stat_calls']}"
+        )
+    for name, seconds in result['load_seconds'].items():
+        print(f"{name:9} {seconds:.3f} s")
+
+
+if __name__ == '__main__':
+    main()
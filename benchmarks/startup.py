@@ -0,0 +1,207 @@
+"""
+Холодный старт бота: время импорта usb_bot (python -X importtime)
+и время от запуска процесса до первого запроса getUpdates.
+Для второго замера бот ходит в локальную заглушку Bot API,
+а MOUNT_PATH указывает на синтетическое дерево (см. suite.make_tree).
+
+    python -m benchmarks.startup --files 100000
+"""
+import argparse
+import email.parser
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Запускается в дочернем процессе: направляет бота на заглушку и стартует main()
+CHILD = '''
+import sys
+import telegram.ext
+token = telegram.ext.ApplicationBuilder.token
+telegram.ext.ApplicationBuilder.token = (
+    lambda self, value: token(self, value).base_url(sys.argv[1]))
+import usb_bot
+usb_bot.main()
+'''
+
+
+def import_time() -> dict:
+    """Импорт usb_bot в чистом интерпретаторе: сумма по importtime и по часам."""
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import usb_bot'],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    wall = time.perf_counter() - started
+    own = 0
+    for line in proc.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == 'usb_bot':
+            own = int(parts[1])
+    return {'import_us': own, 'process_s': round(wall, 4)}
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    """
+    Заглушка Bot API: отвечает на getMe, на getUpdates — пустым списком
+    и запоминает время первого getUpdates, на send*/edit* — сообщением
+    (на sendMediaGroup — списком сообщений) с новым message_id, на остальное —
+    true. Все вызовы пишутся в calls: (метод, время, параметры).
+    """
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), _FakeBotApiHandler)
+        self.first_get_updates = None
+        self.got_updates = threading.Event()
+        self.calls = []
+        self.message_ids = itertools.count(1)
+        self._called = threading.Condition()
+
+    def record(self, method: str, params: dict) -> None:
+        with self._called:
+            self.calls.append((method, time.perf_counter(), params))
+            self._called.notify_all()
+
+    def wait_for(self, method: str, after: int = 0, timeout: float = 10.0):
+        """Ждёт вызова method среди calls[after:] и возвращает его."""
+        deadline = time.monotonic() + timeout
+        with self._called:
+            while True:
+                for call in self.calls[after:]:
+                    if call[0] == method:
+                        return call
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError(f'нет вызова {method}')
+                self._called.wait(left)
+
+    def handle_error(self, request, client_address) -> None:
+        # Бот закрывает соединения при остановке — это не ошибка
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/bot'
+
+
+class _FakeBotApiHandler(BaseHTTPRequestHandler):
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        method = self.path.rsplit('/', 1)[-1]
+        params = {}
+        content_type = self.headers.get('Content-Type', '')
+        if 'urlencoded' in content_type:
+            params = {k: v[-1] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+        elif 'multipart' in content_type:
+            # Текстовые поля формы; загружаемые файлы пропускаются
+            form = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+            params = {part.get_param('name', header='content-disposition'):
+                      part.get_payload(decode=True).decode()
+                      for part in form.get_payload()
+                      if part.get_filename() is None}
+        self.server.record(method, params)
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'usb_bot',
+                      'username': 'usb_bot'}
+        elif method == 'getUpdates':
+            if self.server.first_get_updates is None:
+                self.server.first_get_updates = time.perf_counter()
+                self.server.got_updates.set()
+            time.sleep(0.2)
+            result = []
+        elif method == 'sendMediaGroup':
+            result = [self.message(params, item['type'], n)
+                      for n, item in enumerate(json.loads(params['media']))]
+        elif method.startswith(('send', 'edit')):
+            media = {'sendAudio': 'audio', 'sendDocument': 'document'}.get(method)
+            result = self.message(params, media)
+        else:
+            result = True
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def message(self, params: dict, media: str = None, n: int = None) -> dict:
+        result = {'message_id': next(self.server.message_ids), 'date': int(time.time()),
+                  'chat': {'id': int(params.get('chat_id') or 1),
+                           'type': 'private'},
+                  'text': params.get('text', '')}
+        if media:
+            suffix = '' if n is None else f'_{n}'
+            result[media] = {'file_id': f'file{len(self.server.calls)}{suffix}',
+                             'file_unique_id': 'u', 'duration': 0}
+        return result
+
+    do_GET = do_POST
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def first_get_updates(mount_path: str, timeout: float = 60.0) -> float:
+    """Секунды от запуска процесса бота до его первого getUpdates."""
+    server = FakeBotApi()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as state:
+        env = dict(
+            os.environ,
+            TELEGRAM_TOKEN='123:startup',
+            TELEGRAM_CHAT_ID='1',
+            MOUNT_PATH=mount_path,
+            STATE_DB_PATH=os.path.join(state, 'state.sqlite3'),
+        )
+        started = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, '-c', CHILD, server.url], cwd=ROOT, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            if not server.got_updates.wait(timeout):
+                raise TimeoutError('бот не дошёл до getUpdates')
+            return server.first_get_updates - started
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            server.shutdown()
+            server.server_close()
+
+
+def run(files: int) -> dict:
+    from benchmarks.suite import make_tree
+    report = {'import': import_time()}
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, files)
+        report['first_get_updates_s'] = round(first_get_updates(root), 4)
+    report['files'] = files
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=10000,
+                        help='файлов в синтетическом MOUNT_PATH')
+    args = parser.parse_args()
+    print(json.dumps(run(args.files), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Бенчмарки горячих путей бота на синтетических деревьях USB:
+обход каталога (FilesData.get_files, FileIndex.rescan), отрисовка
+страницы списка (one) и клавиатуры выбора файла (six), пропускная
+способность archive_files / split_file / stream_archive_parts.
+Результат — JSON, чтобы сравнивать релизы между собой.
+
+    python -m benchmarks.suite --sizes 1000,10000,100000 --output bench.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import (  # noqa: E402
+    FileIndex, FilesData, archive_files, split_file, stream_archive_parts,
+)
+import usb_bot  # noqa: E402
+
+EXTENSIONS = ['.mp3'] * 8 + ['.m4a', '.wav']
+
+
+def make_tree(root: str, count: int, seed: int = 0) -> None:
+    """
+    Дерево как на диске рекордера: каталоги по месяцам, имена
+    YYYYMMDD-HHMMSS.ext, размеры от сотен КБ до сотен МБ.
+    Файлы разреженные, поэтому место на диске почти не занимают.
+    """
+    rnd = random.Random(seed)
+    stamp = datetime.datetime(2020, 1, 5, 9, 0)
+    for _ in range(count):
+        stamp += datetime.timedelta(minutes=rnd.randint(5, 600))
+        folder = os.path.join(root, stamp.strftime('%Y-%m'))
+        os.makedirs(folder, exist_ok=True)
+        name = stamp.strftime('%Y%m%d-%H%M%S') + rnd.choice(EXTENSIONS)
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as f:
+            f.truncate(int(rnd.lognormvariate(16.5, 1.2)))
+
+
+def best_of(func, repeat: int) -> float:
+    """Лучшее время из repeat запусков func."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def bench_tree(count: int, repeat: int) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, count)
+
+        def scan():
+            FilesData().get_files(root)
+
+        results.append({'name': 'get_files', 'files': count, 'seconds': best_of(scan, repeat)})
+
+        def rescan():
+            FileIndex(root).rescan()
+
+        results.append({'name': 'index_rescan', 'files': count, 'seconds': best_of(rescan, repeat)})
+        files = FilesData()
+        files.get_files(root)
+        pages = max(1, min(50, count // usb_bot.PAGE_SIZE))
+
+        def render_one():
+            for page in range(pages):
+                usb_bot.render_files_page(files, page, 'ctime')
+
+        seconds = best_of(render_one, repeat)
+        results.append({'name': 'render_one_page', 'files': count, 'seconds': seconds / pages})
+        last_sunday = usb_bot.get_last_sunday()
+
+        def render_six():
+            for page in range(pages):
+                usb_bot.render_file_picker(files, page, 'ctime', last_sunday)
+
+        seconds = best_of(render_six, repeat)
+        results.append({'name': 'render_six_keyboard', 'files': count, 'seconds': seconds / pages})
+    return results
+
+
+def bench_archive(size_mb: int, repeat: int) -> list:
+    results = []
+    part_size = usb_bot.MAX_FILE_SIZE // 4
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Половина несжимаемых данных, половина повторяющихся
+        src = os.path.join(tmpdir, '20240428-170000.wav')
+        chunk = os.urandom(512 * 1024) + b'\0' * 512 * 1024
+        with open(src, 'wb') as f:
+            for _ in range(size_mb):
+                f.write(chunk)
+        source = os.path.getsize(src)
+        archive_path = os.path.join(tmpdir, 'a.zip')
+
+        def archive():
+            archive_files([src], archive_path)
+
+        seconds = best_of(archive, repeat)
+        results.append({'name': 'archive_files', 'bytes': source, 'seconds': seconds,
+                        'mb_per_s': source / seconds / 2 ** 20})
+        archived = os.path.getsize(archive_path)
+
+        def split():
+            for part in split_file(archive_path, part_size):
+                os.remove(part)
+
+        seconds = best_of(split, repeat)
+        results.append({'name': 'split_file', 'bytes': archived, 'seconds': seconds,
+                        'mb_per_s': archived / seconds / 2 ** 20})
+
+        def stream():
+            for part in stream_archive_parts([src], os.path.join(tmpdir, 's.zip'), part_size):
+                os.remove(part)
+
+        seconds = best_of(stream, repeat)
+        results.append({'name': 'stream_archive_parts', 'bytes': source, 'seconds': seconds,
+                        'mb_per_s': source / seconds / 2 ** 20})
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(sizes: list, archive_mb: int, repeat: int) -> dict:
+    results = []
+    for count in sizes:
+        results.extend(bench_tree(count, repeat))
+    if archive_mb:
+        results.extend(bench_archive(archive_mb, repeat))
+    for r in results:
+        r['seconds'] = round(r['seconds'], 6)
+        if 'mb_per_s' in r:
+            r['mb_per_s'] = round(r['mb_per_s'], 1)
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'results': results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000', help='размеры деревьев через запятую')
+    parser.add_argument('--archive-mb', type=int, default=64, help='размер файла для архивации, 0 — пропустить')
+    parser.add_argument('--repeat', type=int, default=3, help='повторов, берётся лучший')
+    parser.add_argument('--output', help='файл для JSON (по умолчанию stdout)')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    report = json.dumps(run(sizes, args.archive_mb, args.repeat), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Пропускная способность отправок через UploadEngine: files файлов
+по size КБ уходят send_document в заглушку Bot API (startup.FakeBotApi)
+из chats чатов сразу. Заглушка отвечает с задержкой latency мс,
+как настоящий сервер; по результату подбираются UPLOAD_CONCURRENCY
+и UPLOAD_PER_CHAT.
+
+    python -m benchmarks.uploads --files 60 --size-kb 512 --chats 3 --concurrency 1,4,8
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import usb_bot  # noqa: E402
+from benchmarks.startup import FakeBotApi  # noqa: E402
+from uploads import UploadEngine  # noqa: E402
+
+
+class SlowBotApi(FakeBotApi):
+    """Заглушка, отвечающая на send* не сразу."""
+
+    def __init__(self, latency: float) -> None:
+        super().__init__()
+        self.latency = latency
+
+    def record(self, method: str, params: dict) -> None:
+        if method.startswith('send'):
+            time.sleep(self.latency)
+        super().record(method, params)
+
+
+async def measure(path: str, files: int, chats: int, concurrency: int,
+                  per_chat: int, api_url: str) -> dict:
+    engine = UploadEngine(concurrency=concurrency, per_chat=per_chat,
+                          chat_rate=0, global_rate=0)
+    app = usb_bot.build_application(token='123:uploads', base_url=api_url)
+    async with app:
+        async def upload(chat_id):
+            with open(path, 'rb') as f:
+                return await app.bot.send_document(chat_id=chat_id, document=f)
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            engine.send(n % chats + 1, lambda n=n: upload(n % chats + 1),
+                        size=os.path.getsize(path))
+            for n in range(files)))
+        wall = time.perf_counter() - started
+    return dict(engine.stats(), concurrency=concurrency, per_chat=per_chat,
+                wall_seconds=round(wall, 3), files_per_second=round(files / wall, 1))
+
+
+def run(files: int, size_kb: int, chats: int, concurrency: list, latency_ms: int) -> list:
+    api = SlowBotApi(latency_ms / 1000)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'clip.mp3')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size_kb * 1024))
+            return [asyncio.run(measure(path, files, chats, n, n, api.url))
+                    for n in concurrency]
+    finally:
+        api.shutdown()
+        api.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=60)
+    parser.add_argument('--size-kb', type=int, default=512)
+    parser.add_argument('--chats', type=int, default=3)
+    parser.add_argument('--concurrency', default='1,4,8',
+                        help='значения UPLOAD_CONCURRENCY через запятую')
+    parser.add_argument('--latency-ms', type=int, default=50,
+                        help='задержка ответа заглушки на send*')
+    args = parser.parse_args()
+    concurrency = [int(n) for n in args.concurrency.split(',')]
+    print(json.dumps(run(args.files, args.size_kb, args.chats, concurrency,
+                         args.latency_ms), indent=2))
+
+
+if __name__ == '__main__':
+    main()
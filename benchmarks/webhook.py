@@ -0,0 +1,148 @@
+"""
+Задержка ответа бота в режиме webhook без Telegram. Бот поднимает
+свой webhook-сервер (Updater.start_webhook с webhook_options), Bot API
+заменён заглушкой (startup.FakeBotApi), а обновления присылает
+локальный HTTP-клиент. Меряется время от POST нажатия кнопки
+до answerCallbackQuery.
+
+    python -m benchmarks.webhook --files 10000 --clicks 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import usb_bot  # noqa: E402
+from benchmarks.startup import FakeBotApi  # noqa: E402
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class WebhookHarness:
+    """
+    Бот в режиме webhook на 127.0.0.1 и заглушка Bot API вокруг него.
+    Используется как async with; update_id и id нажатий растут сами.
+    """
+
+    def __init__(self, secret_token: str = 'harness-secret', user_id: int = 1) -> None:
+        self.secret_token = secret_token
+        self.user_id = user_id
+        self.api = None
+        self.app = None
+        self.url = None
+        self._client = None
+        self._update_id = 0
+
+    async def __aenter__(self) -> "WebhookHarness":
+        self.api = FakeBotApi()
+        threading.Thread(target=self.api.serve_forever, daemon=True).start()
+        port = free_port()
+        options = dict(
+            usb_bot.webhook_options(),
+            listen='127.0.0.1', port=port, url_path='hook',
+            webhook_url=f'http://127.0.0.1:{port}/hook',
+            secret_token=self.secret_token, cert=None, key=None,
+        )
+        self.url = options['webhook_url']
+        self.app = usb_bot.build_application(token='123:webhook', base_url=self.api.url)
+        await self.app.initialize()
+        await self.app.updater.start_webhook(**options)
+        await self.app.start()
+        self._client = httpx.AsyncClient()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self._client.aclose()
+        await self.app.updater.stop()
+        await self.app.stop()
+        await self.app.shutdown()
+        self.api.shutdown()
+        self.api.server_close()
+
+    async def post(self, update: dict, secret_token: str = None) -> httpx.Response:
+        self._update_id += 1
+        update = dict(update, update_id=self._update_id)
+        token = self.secret_token if secret_token is None else secret_token
+        return await self._client.post(
+            self.url, json=update, headers={SECRET_HEADER: token})
+
+    def _user(self) -> dict:
+        return {'id': self.user_id, 'is_bot': False, 'first_name': 'Тест'}
+
+    async def command(self, text: str = '/usb') -> httpx.Response:
+        chat = {'id': self.user_id, 'type': 'private'}
+        return await self.post({'message': {
+            'message_id': self._update_id + 1, 'date': int(time.time()),
+            'chat': chat, 'from': self._user(), 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0,
+                          'length': len(text.split()[0])}],
+        }})
+
+    async def click(self, data: str, timeout: float = 10.0) -> float:
+        """Нажимает кнопку data, возвращает секунды до answerCallbackQuery."""
+        after = len(self.api.calls)
+        started = time.perf_counter()
+        response = await self.post({'callback_query': {
+            'id': f'cb{self._update_id + 1}', 'from': self._user(),
+            'chat_instance': str(self.user_id), 'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()),
+                        'chat': {'id': self.user_id, 'type': 'private'}},
+        }})
+        response.raise_for_status()
+        call = await asyncio.to_thread(
+            self.api.wait_for, 'answerCallbackQuery', after, timeout)
+        return call[1] - started
+
+
+async def measure(clicks: int) -> list:
+    async with WebhookHarness() as harness:
+        await harness.command()
+        await asyncio.to_thread(harness.api.wait_for, 'sendMessage')
+        return [await harness.click(str(usb_bot.ONE)) for _ in range(clicks)]
+
+
+def run(files: int, clicks: int) -> dict:
+    from benchmarks.suite import make_tree
+    from core import FileIndex
+    from scheduler import MenuScheduler
+    from storage import FileIdCache, MenuDeletions
+    # Состояние бенчмарка не пишется в рабочую базу
+    usb_bot.FILE_ID_CACHE = FileIdCache(':memory:')
+    usb_bot.MENU_SCHEDULER = MenuScheduler(MenuDeletions(':memory:'))
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, files)
+        usb_bot.FILE_INDEX = FileIndex(root)
+        usb_bot.FILE_INDEX.rescan()
+        latencies = sorted(asyncio.run(measure(clicks)))
+    pick = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 2)  # noqa: E731
+    return {'files': files, 'clicks': clicks,
+            'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'max_ms': pick(1.0)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=10000,
+                        help='файлов в синтетическом MOUNT_PATH')
+    parser.add_argument('--clicks', type=int, default=200,
+                        help='нажатий кнопки «Посмотреть файлы»')
+    args = parser.parse_args()
+    print(json.dumps(run(args.files, args.clicks), indent=2))
+
+
+if __name__ == '__main__':
+    main()
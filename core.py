@@ -1,8 +1,28 @@
+import base64
+import bisect
+import functools
+import hashlib
+import io
 import os
+import logging
+import re
+import select
+import shutil
+import stat
+import struct
+import sys
+import threading
+import time
 from hurry.filesize import size
-from datetime import datetime
-import prettytable as pt
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+from typing import Optional
 import zipfile
+import zlib
+
+import metrics
+
+logger = logging.getLogger(__name__)
 
 
 def build_table(data: list, a: str, b: str):
@@ -12,6 +32,7 @@ def build_table(data: list, a: str, b: str):
         ('ABC', 20.85, 1.626),
     ]
     """
+    import prettytable as pt
     table = pt.PrettyTable([a, b])
     table.align['name'] = 'l'
     table.align['size'] = 'r'
@@ -22,52 +43,635 @@ def build_table(data: list, a: str, b: str):
     return table
 
 
+# Метка времени записи в имени файла: YYYYMMDD или YYYYMMDD-HHMMSS
+# Восемь цифр подряд, не больше: серийные номера и счётчики длиннее
+STAMP_RE = re.compile(r'(?<!\d)(\d{8})(?!\d)(?:-(\d{6})(?!\d))?')
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(date_str: str) -> date:
+    # Записи за один день делят один объект date
+    return date(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:]))
+
+
+def parse_name_stamp(name: str) -> tuple:
+    """
+    Разбирает метку записи из имени файла.
+    Возвращает (date или None, datetime или None): datetime есть,
+    только если в имени указано и время.
+    """
+    # Первой группе из восьми цифр может оказаться номер, а не дата
+    for match in STAMP_RE.finditer(name):
+        date_str, time_str = match.groups()
+        try:
+            day = _parse_date(date_str)
+            if not time_str:
+                return day, None
+            return day, datetime(
+                day.year, day.month, day.day,
+                int(time_str[:2]), int(time_str[2:4]), int(time_str[4:])
+            )
+        except ValueError:
+            continue
+    return None, None
+
+
+def file_uid(path: str) -> str:
+    """
+    Короткий стабильный идентификатор файла по его пути (8 символов),
+    пригодный для callback_data кнопок Telegram.
+    """
+    digest = hashlib.blake2b(os.fsencode(path), digest_size=6).digest()
+    return base64.urlsafe_b64encode(digest).decode()
+
+
+def file_tag(size: int, ctime: float) -> str:
+    return format(zlib.crc32(f"{size}:{ctime}".encode()), '08x')
+
+
 class File:
     """
-    File object. init with file as abs url file
+    File object. init with file as abs url file.
+    st — готовый результат os.stat, чтобы не делать stat повторно.
+    Человекочитаемые размер и время считаются при первом обращении.
     """
+    __slots__ = ('file', 'uid', 'name', 'size', 'ctime', 'date', 'stamp',
+                 '_h_size', '_h_ctime')
 
-    def __init__(self, file: str) -> None:
+    def __init__(self, file: str, st: os.stat_result = None) -> None:
+        if st is None:
+            st = os.stat(file)
         self.file = file
-        self.dir, self.name = os.path.split(file)
-        self.size = os.stat(self.file).st_size
-        self.h_size = size(self.size)
-        self.ctime = os.stat(self.file).st_ctime
-        self.h_ctime = datetime.fromtimestamp(
-            self.ctime).strftime("%d/%m %H:%M:%S")
+        self.uid = file_uid(file)
+        self.name = os.path.basename(file)
+        self.size = st.st_size
+        self.ctime = st.st_ctime
+        self.date, self.stamp = parse_name_stamp(self.name)
+        self._h_size = None
+        self._h_ctime = None
+
+    @property
+    def dir(self) -> str:
+        return os.path.dirname(self.file)
+
+    @property
+    def tag(self) -> str:
+        """Короткий отпечаток размера и ctime: меняется вместе с файлом."""
+        return file_tag(self.size, self.ctime)
+
+    @property
+    def h_size(self) -> str:
+        if self._h_size is None:
+            self._h_size = size(self.size)
+        return self._h_size
+
+    @property
+    def h_ctime(self) -> str:
+        if self._h_ctime is None:
+            self._h_ctime = datetime.fromtimestamp(
+                self.ctime).strftime("%d/%m %H:%M:%S")
+        return self._h_ctime
+
+
+class SortedIndex:
+    """
+    Файлы, упорядоченные по key(file). Держит отсортированный массив
+    ключей, поэтому позиция для вставки и удаления ищется bisect'ом
+    за O(log n), а страница берётся срезом без сортировки.
+    """
+
+    def __init__(self, key) -> None:
+        self.key = key
+        self._keys = []
+        self._files = []
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def _entry(self, file: File) -> tuple:
+        # Путь в ключе различает файлы с одинаковым значением key
+        return (self.key(file), file.file)
+
+    def insert(self, file: File) -> None:
+        entry = self._entry(file)
+        i = bisect.bisect_right(self._keys, entry)
+        self._keys.insert(i, entry)
+        self._files.insert(i, file)
+
+    def extend(self, files) -> None:
+        """
+        Добавляет много файлов одной сортировкой: при загрузке каталога
+        это O(n log n) вместо O(n²) вставок по одной.
+        """
+        pairs = list(zip(self._keys, self._files))
+        pairs.extend((self._entry(file), file) for file in files)
+        pairs.sort(key=lambda pair: pair[0])
+        self._keys = [entry for entry, _ in pairs]
+        self._files = [file for _, file in pairs]
+
+    def remove(self, file: File) -> None:
+        entry = self._entry(file)
+        i = bisect.bisect_left(self._keys, entry)
+        if i < len(self._keys) and self._keys[i] == entry:
+            del self._keys[i]
+            del self._files[i]
+
+    def slice(self, start: int = 0, stop: int = None, reverse: bool = False) -> list:
+        """Файлы с позиций [start:stop) по возрастанию или убыванию key."""
+        if not reverse:
+            return self._files[start:stop]
+        n = len(self._files)
+        stop = n if stop is None else min(stop, n)
+        if start >= stop:
+            return []
+        return self._files[n - stop:n - start][::-1]
+
+    def copy(self) -> "SortedIndex":
+        index = SortedIndex(self.key)
+        index._keys = list(self._keys)
+        index._files = list(self._files)
+        return index
 
 
 class FilesData:
+    # Порядки сортировки: имя -> ключ
+    ORDERS = {
+        'size': lambda f: f.size,
+        'ctime': lambda f: f.ctime,
+        'name': lambda f: f.name,
+    }
+
     def __init__(self) -> None:
         self.path = ""
-        self.file_list = []
-        self.file_url_list = []
-        self.file_name_list = []
         self.size_sum = 0
         self.count = 0
-        self.h_size_sum = 0
+        self.version = 0
+        self._by_path = {}
+        self._by_uid = {}
+        self._by_date = defaultdict(dict)
+        self._orders = {
+            order: SortedIndex(key) for order, key in self.ORDERS.items()
+        }
+        # Расширение в нижнем регистре ('' без расширения) -> число файлов
+        self.ext_counts = Counter()
+
+    @property
+    def file_list(self):
+        """Файлы в порядке добавления."""
+        return list(self._by_path.values())
+
+    @property
+    def h_size_sum(self):
+        return size(self.size_sum)
+
+    @property
+    def file_url_list(self):
+        return [f.file for f in self._by_path.values()]
+
+    @property
+    def file_name_list(self):
+        return [(f.name, f) for f in self._by_path.values()]
 
     def get_files(self, path: str):
         self.path = path
+        found = []
         for address, dirs, files in os.walk(self.path):
             files.sort()
             for name in files:
-                file = File(os.path.join(address, name))
-                self.file_list.append(file)
-                self.size_sum += file.size
-                self.count += 1
-                self.file_url_list.append(file.file)
-                self.file_name_list.append((file.name, file))
-        self.h_size_sum = size(self.size_sum)
+                file = os.path.join(address, name)
+                try:
+                    st = os.stat(file)
+                except OSError:
+                    continue
+                found.append(File(file, st))
+        self.add_files(found)
+
+    def get(self, file: str):
+        return self._by_path.get(file)
+
+    def by_uid(self, uid: str):
+        """Файл по идентификатору File.uid или None."""
+        return self._by_uid.get(uid)
+
+    def add_file(self, file: File) -> None:
+        """
+        Добавляет файл в набор. Если файл с таким путём уже есть,
+        он заменяется новой записью.
+        """
+        if file.file in self._by_path:
+            self.remove_file(file.file)
+        self._register(file)
+        for index in self._orders.values():
+            index.insert(file)
+
+    def add_files(self, files: list) -> None:
+        """
+        Добавляет файлы пачкой (как add_file), сортируя каждый порядок
+        один раз. Для обхода каталога и больших изменений.
+        """
+        # Повтор пути внутри пачки: остаётся последняя запись
+        files = list({file.file: file for file in files}.values())
+        for file in files:
+            if file.file in self._by_path:
+                self.remove_file(file.file)
+            self._register(file)
+        for index in self._orders.values():
+            index.extend(files)
+
+    def _register(self, file: File) -> None:
+        self._by_path[file.file] = file
+        self._by_uid[file.uid] = file
+        if file.date is not None:
+            self._by_date[file.date][file.file] = file
+        self.ext_counts[os.path.splitext(file.name)[1].lower()] += 1
+        self.size_sum += file.size
+        self.count += 1
+
+    def remove_file(self, file: str):
+        """
+        Убирает файл из набора по абсолютному пути.
+        Возвращает удалённый File или None.
+        """
+        old = self._by_path.pop(file, None)
+        if old is None:
+            return None
+        self._by_uid.pop(old.uid, None)
+        if old.date is not None:
+            bucket = self._by_date[old.date]
+            bucket.pop(file, None)
+            if not bucket:
+                del self._by_date[old.date]
+        for index in self._orders.values():
+            index.remove(old)
+        ext = os.path.splitext(old.name)[1].lower()
+        self.ext_counts[ext] -= 1
+        if not self.ext_counts[ext]:
+            del self.ext_counts[ext]
+        self.size_sum -= old.size
+        self.count -= 1
+        return old
+
+    def copy(self) -> "FilesData":
+        """Неглубокая копия: контейнеры новые, объекты File общие."""
+        data = FilesData()
+        data.path = self.path
+        data.size_sum = self.size_sum
+        data.count = self.count
+        data.version = self.version
+        data._by_path = dict(self._by_path)
+        data._by_uid = dict(self._by_uid)
+        data._by_date = defaultdict(dict, {
+            day: dict(bucket) for day, bucket in self._by_date.items()
+        })
+        data._orders = {
+            order: index.copy() for order, index in self._orders.items()
+        }
+        data.ext_counts = Counter(self.ext_counts)
+        return data
+
+    def newest(self):
+        """Файл с наибольшим ctime или None для пустого набора."""
+        last = self._orders['ctime'].slice(0, 1, reverse=True)
+        return last[0] if last else None
+
+    def ordered(self, order: str, start: int = 0, stop: int = None,
+                reverse: bool = False) -> list:
+        """Страница [start:stop) файлов в порядке order ('size', 'ctime', 'name')."""
+        return self._orders[order].slice(start, stop, reverse)
+
+    def on_date(self, day) -> list:
+        """Файлы с датой записи day (по имени файла), по порядку имён."""
+        bucket = self._by_date.get(day)
+        if not bucket:
+            return []
+        return sorted(bucket.values(), key=lambda f: f.name)
+
+    def between(self, first, last) -> list:
+        """Файлы с датой записи в диапазоне [first, last] включительно."""
+        days = (last - first).days + 1
+        if days <= 0:
+            return []
+        if days <= len(self._by_date):
+            dates = (first + timedelta(days=i) for i in range(days))
+        else:
+            dates = sorted(d for d in self._by_date if first <= d <= last)
+        result = []
+        for day in dates:
+            result.extend(self.on_date(day))
+        return result
+
+    def order_by_size(self, start: int = 0, stop: int = None, reverse: bool = False):
+        return self.ordered('size', start, stop, reverse)
+
+    def order_by_ctime(self, start: int = 0, stop: int = None, reverse: bool = False):
+        return self.ordered('ctime', start, stop, reverse)
+
+    def order_by_name(self, start: int = 0, stop: int = None, reverse: bool = False):
+        return self.ordered('name', start, stop, reverse)
+
+
+class _Inotify:
+    """
+    Минимальная обёртка над inotify(7) через ctypes.
+    Бросает OSError, если inotify недоступен.
+    """
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = (
+        IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    )
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self) -> None:
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify доступен только в Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self.dirs = {}
 
-    def order_by_size(self):
-        return self.file_list
+    def add_watch(self, path: str) -> None:
+        import ctypes
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch', path)
+        self.dirs[wd] = path
 
-    def order_by_ctime(self):
-        return self.file_list
+    def add_tree(self, path: str) -> None:
+        self.add_watch(path)
+        for address, dirs, files in os.walk(path):
+            for name in dirs:
+                self.add_watch(os.path.join(address, name))
 
-    def order_by_name(self):
-        return self.file_list
+    def read(self, timeout: float) -> list:
+        """
+        Ждёт событий не дольше timeout секунд.
+        Возвращает список (mask, путь).
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = self._EVENT.unpack_from(buf, pos)
+            pos += self._EVENT.size
+            name = buf[pos:pos + length].rstrip(b'\0')
+            pos += length
+            if mask & self.IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            base = self.dirs.get(wd)
+            if base is None and not mask & self.IN_Q_OVERFLOW:
+                continue
+            path = os.path.join(base, os.fsdecode(name)) if name else base
+            events.append((mask, path))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class FileIndex:
+    """
+    Долгоживущий индекс файлов каталога path.
+    Один раз обходит дерево, дальше обновляется по событиям inotify,
+    а если inotify недоступен — периодическим опросом раз в poll_interval.
+    version увеличивается при каждом изменении набора файлов.
+    Свободное место на диске (disk_free, байты) отдельный поток
+    замеряет раз в disk_interval; до первого замера там None.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 30.0,
+                 disk_interval: float = 60.0) -> None:
+        self.path = path
+        self.poll_interval = poll_interval
+        self.disk_interval = disk_interval
+        self.disk_free = None
+        self.version = 0
+        # Выставляется после первого полного обхода
+        self.ready = threading.Event()
+        self.mode = None
+        self._data = FilesData()
+        self._data.path = path
+        self._snapshot = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._disk_thread = None
+        self._inotify = None
+
+    def snapshot(self) -> FilesData:
+        """
+        Возвращает FilesData с текущим состоянием индекса.
+        Копия строится один раз на версию; изменять её нельзя.
+        """
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version != self.version:
+                self._data.version = self.version
+                self._snapshot = self._data.copy()
+            return self._snapshot
+
+    def rescan(self) -> bool:
+        """
+        Полный обход каталога с применением разницы к индексу.
+        Возвращает True, если что-то изменилось.
+        """
+        started = time.perf_counter()
+        found = {}
+        for address, dirs, files in os.walk(self.path):
+            files.sort()
+            for name in files:
+                file = os.path.join(address, name)
+                try:
+                    found[file] = os.stat(file)
+                except OSError:
+                    continue
+        with self._lock:
+            version = self.version
+            data = self._data.copy()
+        # Записи File и сортировка строятся без блокировки: snapshot()
+        # из обработчиков не ждёт обхода большого диска
+        gone = [file for file in data._by_path if file not in found]
+        fresh = [File(file, st) for file, st in found.items()
+                 if _stale(data.get(file), st)]
+        changed = bool(gone or fresh)
+        if changed:
+            _apply_diff(data, gone, fresh)
+            with self._lock:
+                if self.version == version:
+                    self._data = data
+                else:
+                    # Индекс менялся во время обхода: разница применяется к нему
+                    _apply_diff(self._data, gone, fresh)
+                self._bump()
+        metrics.SCAN_SECONDS.observe(time.perf_counter() - started)
+        return changed
+
+    def update_path(self, file: str) -> bool:
+        """Перечитывает один файл; отсутствующий файл удаляется из индекса."""
+        try:
+            st = os.stat(file)
+        except OSError:
+            st = None
+        with self._lock:
+            if st is None or not stat.S_ISREG(st.st_mode):
+                changed = self._data.remove_file(file) is not None
+            else:
+                changed = self._apply_stat(file, st)
+            if changed:
+                self._bump()
+        return changed
+
+    def remove_tree(self, path: str) -> bool:
+        """Удаляет из индекса все файлы внутри каталога path."""
+        prefix = os.path.join(path, '')
+        with self._lock:
+            gone = [f for f in self._data._by_path if f.startswith(prefix)]
+            for file in gone:
+                self._data.remove_file(file)
+            if gone:
+                self._bump()
+        return bool(gone)
+
+    def _bump(self) -> None:
+        """Новая версия индекса; вызывается под _lock."""
+        self.version += 1
+        metrics.INDEXED_FILES.set(self._data.count)
+        metrics.INDEXED_BYTES.set(self._data.size_sum)
+
+    def _apply_stat(self, file: str, st: os.stat_result) -> bool:
+        if not _stale(self._data.get(file), st):
+            return False
+        self._data.add_file(File(file, st))
+        return True
+
+    def start(self, background: bool = False) -> None:
+        """
+        Строит индекс и запускает фоновое слежение за каталогом.
+        С background=True первый обход тоже идёт в фоновом потоке
+        и start возвращается сразу; конец обхода — событие ready.
+        """
+        self._stop.clear()
+        if not background:
+            self._setup()
+        self._thread = threading.Thread(
+            target=self._run, args=(background,), name='file-index',
+            daemon=True)
+        self._thread.start()
+        self._disk_thread = threading.Thread(
+            target=self._sample_disk_loop, name='disk-usage', daemon=True)
+        self._disk_thread.start()
+
+    def _setup(self) -> None:
+        try:
+            self._inotify = _Inotify()
+            self._inotify.add_tree(self.path)
+            self.mode = 'inotify'
+        except OSError as err:
+            logger.warning('inotify недоступен (%s), индекс на опросе', err)
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+            self.mode = 'poll'
+        self.rescan()
+        self.ready.set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        for thread in (self._thread, self._disk_thread):
+            if thread is not None:
+                thread.join()
+        self._thread = self._disk_thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _run(self, setup: bool = False) -> None:
+        if setup:
+            try:
+                self._setup()
+            except Exception:
+                logger.exception('Ошибка построения индекса %s', self.path)
+                if self._inotify is not None:
+                    self._inotify.close()
+                    self._inotify = None
+                self.mode = 'poll'
+                self.ready.set()
+        while not self._stop.is_set():
+            try:
+                if self._inotify is None:
+                    self._stop.wait(self.poll_interval)
+                    if not self._stop.is_set():
+                        self.rescan()
+                else:
+                    self._handle_events(self._inotify.read(timeout=1.0))
+            except Exception:
+                logger.exception('Ошибка обновления индекса %s', self.path)
+                self._stop.wait(1.0)
+
+    def sample_disk(self):
+        """Замеряет свободное место в path; при ошибке оставляет прошлое значение."""
+        try:
+            self.disk_free = shutil.disk_usage(self.path).free
+        except OSError as err:
+            logger.warning('Не удалось узнать свободное место в %s: %s',
+                           self.path, err)
+        return self.disk_free
+
+    def _sample_disk_loop(self) -> None:
+        while not self._stop.is_set():
+            self.sample_disk()
+            self._stop.wait(self.disk_interval)
+
+    def _handle_events(self, events: list) -> None:
+        ino = self._inotify
+        changed = set()
+        for mask, path in events:
+            if mask & ino.IN_Q_OVERFLOW:
+                self.rescan()
+                return
+            if mask & ino.IN_ISDIR:
+                if mask & (ino.IN_CREATE | ino.IN_MOVED_TO):
+                    ino.add_tree(path)
+                    for address, dirs, files in os.walk(path):
+                        changed.update(os.path.join(address, n) for n in files)
+                elif mask & (ino.IN_DELETE | ino.IN_MOVED_FROM):
+                    self.remove_tree(path)
+            elif not mask & ino.IN_DELETE_SELF:
+                changed.add(path)
+        for file in changed:
+            self.update_path(file)
+
+
+def _stale(old: Optional[File], st: os.stat_result) -> bool:
+    """Записи нет в индексе или она не совпадает со stat файла."""
+    return old is None or old.size != st.st_size or old.ctime != st.st_ctime
+
+
+def _apply_diff(data: FilesData, gone: list, fresh: list) -> None:
+    for file in gone:
+        data.remove_file(file)
+    if fresh:
+        data.add_files(fresh)
 
 
 def get_chunks(files: list, chank_len=10) -> list:
@@ -88,26 +692,94 @@ def get_chunks(files: list, chank_len=10) -> list:
     ]
 
 
-files = FilesData()
-files.get_files(path="USB")
-audio_files = [
-    f"{f.name} {f.h_size} {f.h_ctime}" for f in files.file_list
-]
-print(
-    # [f.h_size for f in l.file_list],
-    files.path,
-    sep="\n"
-)
+class CompressionPolicy:
+    """
+    Выбирает способ сжатия файла в zip-архиве по расширению.
+    rules: {'.ext': (compress_type, compresslevel)}. Для расширений
+    не из rules сжимается первый sample_size байт файла: если zlib
+    ужимает пробу хуже чем до threshold от исходного размера, файл
+    кладётся без сжатия (ZIP_STORED), иначе — DEFLATED с level.
+    """
+
+    # Уже сжатые форматы: deflate их почти не уменьшает
+    STORED_EXTENSIONS = (
+        '.mp3', '.m4a', '.ogg', '.opus', '.aac', '.flac', '.wma',
+        '.mp4', '.mkv', '.avi', '.mov', '.webm',
+        '.jpg', '.jpeg', '.png', '.gif', '.webp',
+        '.zip', '.gz', '.bz2', '.xz', '.7z', '.rar',
+    )
+    # Несжатый звук ужимается слабо — хватит быстрого уровня
+    FAST_EXTENSIONS = ('.wav', '.aiff', '.aif')
+
+    def __init__(self, name: str = 'auto', rules: dict = None,
+                 level: int = 6, sample_size: int = 4 * 1024 * 1024,
+                 threshold: float = 0.9) -> None:
+        self.name = name
+        self.level = level
+        self.sample_size = sample_size
+        self.threshold = threshold
+        if rules is None:
+            rules = {ext: (zipfile.ZIP_STORED, None) for ext in self.STORED_EXTENSIONS}
+            rules.update(
+                {ext: (zipfile.ZIP_DEFLATED, 1) for ext in self.FAST_EXTENSIONS})
+        self.rules = rules
+
+    def choose(self, file_path: str) -> tuple:
+        """Возвращает (compress_type, compresslevel) для файла."""
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext in self.rules:
+            return self.rules[ext]
+        return self.sample(file_path)
+
+    def sample(self, file_path: str) -> tuple:
+        with open(file_path, 'rb') as f:
+            data = f.read(self.sample_size)
+        if not data:
+            return zipfile.ZIP_STORED, None
+        ratio = len(zlib.compress(data, 1)) / len(data)
+        if ratio >= self.threshold:
+            return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, self.level
+
+    def open_entry(self, zipf: zipfile.ZipFile, file_path: str):
+        """
+        Открывает на запись запись file_path в архиве zipf с выбранным
+        сжатием. ZipFile.open берёт сжатие из настроек архива, поэтому
+        они выставляются перед каждой записью.
+        """
+        zipf.compression, zipf.compresslevel = self.choose(file_path)
+        # Размер записи заранее не известен zipfile: zip64 включается сам
+        force_zip64 = os.path.getsize(file_path) * 1.05 > zipfile.ZIP64_LIMIT
+        return zipf.open(os.path.basename(file_path), 'w', force_zip64=force_zip64)
+
 
+class _FixedPolicy(CompressionPolicy):
+    """Политика с одним способом сжатия для всех файлов."""
 
-def archive_file(file_path: str, archive_path: str) -> str:
+    def __init__(self, name: str, compress_type: int, level: int = None) -> None:
+        super().__init__(name=name, rules={})
+        self.fixed = (compress_type, level)
+
+    def choose(self, file_path: str) -> tuple:
+        return self.fixed
+
+
+DEFAULT_POLICY = CompressionPolicy()
+POLICIES = {
+    'auto': DEFAULT_POLICY,
+    'deflate': _FixedPolicy('deflate', zipfile.ZIP_DEFLATED),
+    'fast': _FixedPolicy('fast', zipfile.ZIP_DEFLATED, 1),
+    'store': _FixedPolicy('store', zipfile.ZIP_STORED),
+}
+
+
+def archive_file(file_path: str, archive_path: str,
+                 policy: CompressionPolicy = None) -> str:
     """
     Архивирует файл file_path в zip-архив archive_path.
     Возвращает путь к архиву.
     """
-    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        zipf.write(file_path, arcname=os.path.basename(file_path))
-    return archive_path
+    return archive_files([file_path], archive_path, policy)
 
 
 def split_file(file_path: str, part_size: int = 50 * 1024 * 1024) -> list:
@@ -130,12 +802,118 @@ def split_file(file_path: str, part_size: int = 50 * 1024 * 1024) -> list:
     return parts
 
 
-def archive_files(file_paths: list, archive_path: str) -> str:
+def archive_files(file_paths: list, archive_path: str,
+                  policy: CompressionPolicy = None) -> str:
     """
     Архивирует список файлов file_paths в zip-архив archive_path.
+    Способ сжатия каждого файла выбирает policy (по умолчанию DEFAULT_POLICY).
     Возвращает путь к архиву.
     """
-    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+    policy = policy or DEFAULT_POLICY
+    with zipfile.ZipFile(archive_path, 'w') as zipf:
         for file_path in file_paths:
-            zipf.write(file_path, arcname=os.path.basename(file_path))
+            compress_type, compresslevel = policy.choose(file_path)
+            zipf.write(file_path, arcname=os.path.basename(file_path),
+                       compress_type=compress_type, compresslevel=compresslevel)
     return archive_path
+
+
+class _SplitWriter(io.RawIOBase):
+    """
+    Файлоподобный приёмник, который режет записываемый поток на части
+    по part_size байт: {base_path}.part0, .part1, ...
+    Готовые части складываются в ready, текущая пишется во временный файл.
+    """
+
+    def __init__(self, base_path: str, part_size: int) -> None:
+        super().__init__()
+        self.base_path = base_path
+        self.part_size = part_size
+        self.index = 0
+        self.ready = []
+        self._pos = 0
+        self._size = 0
+        self._tmp_path = f"{base_path}.tmp"
+        self._file = open(self._tmp_path, 'wb')
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        written = len(view)
+        while view:
+            if self._size >= self.part_size:
+                self._rollover()
+            n = min(len(view), self.part_size - self._size)
+            self._file.write(view[:n])
+            self._size += n
+            self._pos += n
+            view = view[n:]
+        return written
+
+    def _rollover(self) -> None:
+        self._file.close()
+        part_path = f"{self.base_path}.part{self.index}"
+        os.replace(self._tmp_path, part_path)
+        self.ready.append(part_path)
+        self.index += 1
+        self._size = 0
+        self._file = open(self._tmp_path, 'wb')
+
+    def finish(self) -> str:
+        """
+        Закрывает последнюю часть и возвращает её путь. Если поток
+        уместился в одну часть, она получает имя base_path без .partN.
+        """
+        self._file.close()
+        if self.index == 0:
+            last_path = self.base_path
+        else:
+            last_path = f"{self.base_path}.part{self.index}"
+        os.replace(self._tmp_path, last_path)
+        return last_path
+
+    def discard(self) -> None:
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def stream_archive_parts(file_paths: list, archive_path: str,
+                         part_size: int = 50 * 1024 * 1024,
+                         chunk_size: int = 1024 * 1024,
+                         policy: CompressionPolicy = None):
+    """
+    Архивирует file_paths в zip, сразу нарезая поток архива на части
+    по part_size байт. Генератор отдаёт пути частей по мере готовности
+    и не пишет следующую часть, пока не запрошена; после отдачи часть
+    можно удалить. Если архив уместился в part_size, отдаётся один
+    файл archive_path, иначе archive_path.part0, .part1, ...
+    Склеенные части дают обычный zip-архив. Сжатие выбирает policy.
+    """
+    policy = policy or DEFAULT_POLICY
+    sink = _SplitWriter(archive_path, part_size)
+    finished = False
+    try:
+        with zipfile.ZipFile(sink, 'w') as zipf:
+            for file_path in file_paths:
+                with open(file_path, 'rb') as src, policy.open_entry(zipf, file_path) as dest:
+                    while True:
+                        chunk = src.read(chunk_size)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        while sink.ready:
+                            yield sink.ready.pop(0)
+        while sink.ready:
+            yield sink.ready.pop(0)
+        last_path = sink.finish()
+        finished = True
+        yield last_path
+    finally:
+        if not finished:
+            sink.discard()
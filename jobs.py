@@ -0,0 +1,174 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from storage import DownloadJobs
+from workers import JobCancelled, get_worker_pool
+
+logger = logging.getLogger(__name__)
+
+# Завершённые задания хранятся неделю, потом удаляются при старте
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+
+
+class DownloadWorker:
+    """
+    Выполняет задания DownloadJobs в фоне, по задаче на задание.
+    send_item(bot, job, item, ack) отправляет один элемент и вызывает
+    ack(name, file_id, version) после каждой доставленной части; уже
+    подтверждённые части лежат в item['parts'], а версия, из которой они
+    собраны, запоминается с первой частью и лежит в item['version']. Ошибка элемента отмечается в базе,
+    и задание идёт дальше. finish(bot, job, items) сообщает итог,
+    в том числе отменённого задания.
+    slot(job) — асинхронный контекст, внутри которого выполняется задание
+    (очередь и ограничение одновременных заданий).
+    version(path) — текущая версия файла; если к продолжению она не совпала
+    с item['version'], элемент отправляется с первой части.
+    plan(items) делит неотправленные элементы на пакеты; пакет из
+    нескольких элементов уходит одним send_group(bot, job, items),
+    до parallel пакетов одновременно.
+    После перезапуска start() продолжает незавершённые задания
+    с первой неподтверждённой части.
+    """
+
+    def __init__(self, store: DownloadJobs,
+                 send_item: Callable[..., Awaitable],
+                 finish: Callable[..., Awaitable],
+                 slot: Optional[Callable] = None,
+                 send_group: Optional[Callable[..., Awaitable]] = None,
+                 plan: Optional[Callable[[list], list]] = None,
+                 parallel: int = 1,
+                 version: Optional[Callable[[str], object]] = None) -> None:
+        self._store = store
+        self._send_item = send_item
+        self._finish = finish
+        self._slot = slot or (lambda job: contextlib.nullcontext())
+        self._send_group = send_group
+        self._plan = plan if send_group is not None else None
+        self._parallel = max(parallel, 1)
+        self._version = version
+        self._bot = None
+        self._tasks = {}
+
+    def start(self, bot) -> None:
+        self._bot = bot
+        self._store.prune(time.time() - JOB_RETENTION_SECONDS)
+        for job_id in self._store.unfinished():
+            if job_id not in self._tasks:
+                logger.info("Продолжаю задание отправки %s", job_id)
+                self._spawn(job_id)
+
+    async def stop(self) -> None:
+        """Останавливает задачи; задания остаются незавершёнными до следующего start()."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._bot = None
+
+    def submit(self, chat_id: int, user_id: int, user_name: str, label: str,
+               paths: list, message_id: Optional[int] = None) -> int:
+        job_id = self._store.create(chat_id, user_id, user_name, label, paths, message_id)
+        if self._bot is not None:
+            self._spawn(job_id)
+        return job_id
+
+    def cancel(self, chat_id: int) -> int:
+        """Отменяет незавершённые задания чата."""
+        job_ids = self._store.unfinished(chat_id)
+        for job_id in job_ids:
+            self._store.set_status(job_id, 'cancelled')
+            task = self._tasks.get(job_id)
+            if task is not None:
+                task.cancel()
+        return len(job_ids)
+
+    async def wait(self, job_id: int) -> None:
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _spawn(self, job_id: int) -> None:
+        task = asyncio.get_running_loop().create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _run(self, job_id: int) -> None:
+        job = self._store.get(job_id)
+        if job is None or job['status'] not in ('pending', 'running'):
+            return
+        try:
+            status = await self._run_items(job_id, job)
+        except asyncio.CancelledError:
+            job = self._store.get(job_id)
+            if job is None or job['status'] != 'cancelled':
+                # Остановка бота: задание продолжится после start()
+                raise
+            # Отмена задания обработана: итог ещё нужно отправить
+            asyncio.current_task().uncancel()
+            logger.info("Задание отправки %s отменено", job_id)
+            status = 'cancelled'
+        if status is None:
+            return
+        try:
+            await self._finish(self._bot, self._store.get(job_id), self._store.items(job_id))
+        except Exception:
+            logger.exception("Задание %s: не удалось сообщить итог", job_id)
+
+    async def _run_items(self, job_id: int, job: dict) -> Optional[str]:
+        """Отправляет элементы задания и возвращает его итоговый статус."""
+        async with self._slot(job):
+            job = self._store.get(job_id)
+            if job is None or job['status'] not in ('pending', 'running'):
+                # Задание отменили, пока оно ждало очереди
+                return None
+            self._store.set_status(job_id, 'running')
+            pending = [i for i in self._store.items(job_id) if i['status'] == 'pending']
+            batches = self._plan(pending) if self._plan else [[i] for i in pending]
+            limit = asyncio.Semaphore(self._parallel)
+            status = 'done'
+            try:
+                async with asyncio.TaskGroup() as group:
+                    for batch in batches:
+                        group.create_task(self._run_batch(job, batch, limit))
+            except* JobCancelled:
+                logger.info("Задание отправки %s отменено", job_id)
+                status = 'cancelled'
+            self._store.set_status(job_id, status)
+            return status
+
+    async def _run_batch(self, job: dict, batch: list, limit: asyncio.Semaphore) -> None:
+        job_id = job['id']
+        async with limit:
+            try:
+                if len(batch) == 1:
+                    item = await self._check_version(job_id, batch[0])
+                    ack = functools.partial(self._store.ack_part, job_id, item['seq'])
+                    await self._send_item(self._bot, job, item, ack)
+                else:
+                    await self._send_group(self._bot, job, batch)
+            except JobCancelled:
+                raise
+            except Exception as err:
+                logger.exception("Задание %s: не отправлено: %s", job_id,
+                                 ', '.join(item['path'] for item in batch))
+                for item in batch:
+                    self._store.finish_item(job_id, item['seq'], 'failed', str(err))
+            else:
+                for item in batch:
+                    self._store.finish_item(job_id, item['seq'], 'done')
+
+    async def _check_version(self, job_id: int, item: dict) -> dict:
+        if self._version is None or not item['parts']:
+            return item
+        version = await get_worker_pool().run_io(self._version, item['path'])
+        if version == item['version']:
+            return item
+        # Части собраны из прежней версии файла: смешивать их с новыми нельзя
+        logger.info("Задание %s: %s изменился, отправка с первой части",
+                    job_id, item['path'])
+        self._store.reset_item(job_id, item['seq'])
+        return dict(item, parts=[], version=None)
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    """
+    Следит за задержкой event loop. Задача-пульс засыпает на interval
+    секунд и меряет, насколько позже проснулась (usb_bot_loop_lag_seconds);
+    задержка от threshold считается остановкой loop и попадает в
+    usb_bot_loop_stalls_total и usb_bot_loop_stall_seconds. Фоновый поток
+    замечает пульс, которого нет дольше threshold, и пишет в лог стек
+    потока loop — то место, где сейчас выполняется блокирующий вызов.
+    """
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05) -> None:
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._beats = 0
+        self._reported = -1
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Запускается из работающего event loop."""
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._beat = now
+            self._beats += 1
+            metrics.LOOP_LAG_SECONDS.observe(lag)
+            if lag >= self.threshold:
+                self.stalls += 1
+                metrics.LOOP_STALLS.inc()
+                metrics.LOOP_STALL_SECONDS.observe(lag)
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self.interval):
+            behind = time.monotonic() - self._beat - self.interval
+            # Стек пишется один раз за остановку: пока нет нового пульса
+            if behind < self.threshold or self._reported == self._beats:
+                continue
+            self._reported = self._beats
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame else 'стек недоступен\n'
+            logger.warning("Event loop занят больше %.3f с, сейчас выполняется:\n%s",
+                           behind, stack.rstrip())
@@ -0,0 +1,245 @@
+"""
+Метрики бота в текстовом формате Prometheus (exposition format 0.0.4).
+Счётчики, измерители и гистограммы с метками, общий реестр REGISTRY
+и HTTP-сервер /metrics в фоновом потоке. Без внешних зависимостей.
+"""
+import bisect
+import contextlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+# Границы корзин гистограмм по умолчанию, сек
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+REGISTRY = []
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 registry: Optional[list] = REGISTRY) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f'{self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}')
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        """Пары (имя с метками, значение) для вывода."""
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name + _format_labels(self.labelnames, key), value
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type}']
+        lines += [f'{name} {_format_value(value)}' for name, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """Измеритель; set_function задаёт значение, вычисляемое при каждом чтении."""
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._function = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def value(self, **labels) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self._function is None:
+            yield from super().samples()
+            return
+        try:
+            yield self.name, self._function()
+        except Exception:
+            # Метрика, которую сейчас не посчитать, просто не выводится
+            return
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry: Optional[list] = REGISTRY) -> None:
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return sum(state[0]) if state else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(s[0]), s[1])) for key, s in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="{}"'.format(_format_value(bound))
+                yield (self.name + '_bucket'
+                       + _format_labels(self.labelnames, key, le)), cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield self.name + '_sum' + labels, total
+            yield self.name + '_count' + labels, cumulative
+
+
+def render(registry: list = REGISTRY) -> str:
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render(self.server.registry).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def start_http_server(port: int, addr: str = '127.0.0.1',
+                      registry: list = REGISTRY) -> ThreadingHTTPServer:
+    """Отдаёт метрики на http://addr:port/metrics из фонового потока."""
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+# Метрики бота
+
+HANDLER_SECONDS = Histogram(
+    'usb_bot_handler_seconds', 'Время работы обработчика обновления', ['handler'])
+HANDLER_ERRORS = Counter(
+    'usb_bot_handler_errors_total', 'Исключения в обработчиках', ['handler'])
+SCAN_SECONDS = Histogram(
+    'usb_bot_scan_seconds', 'Длительность полного обхода MOUNT_PATH')
+INDEXED_FILES = Gauge(
+    'usb_bot_indexed_files', 'Файлов в индексе MOUNT_PATH')
+INDEXED_BYTES = Gauge(
+    'usb_bot_indexed_bytes', 'Суммарный размер файлов в индексе')
+UPLOAD_FILES = Counter(
+    'usb_bot_upload_files_total',
+    'Отправленные файлы по способу: direct, local, cached, album, archived, split', ['path'])
+UPLOAD_BYTES = Counter(
+    'usb_bot_upload_bytes_total', 'Переданные в Bot API байты по способу отправки', ['path'])
+UPLOAD_SECONDS = Histogram(
+    'usb_bot_upload_seconds', 'Время отправки одного файла', ['path'])
+DOWNLOAD_WAIT_SECONDS = Histogram(
+    'usb_bot_download_wait_seconds',
+    'Ожидание места в очереди отправок: single — один файл, bulk — группа', ['kind'])
+DOWNLOAD_WAITING = Gauge(
+    'usb_bot_download_waiting', 'Запросов в очереди отправок', ['kind'])
+UPLOAD_RETRIES = Counter(
+    'usb_bot_upload_retries_total',
+    'Повторы отправки: retry_after — флуд-лимит Telegram, network — сетевая ошибка',
+    ['reason'])
+UPLOAD_THROUGHPUT = Gauge(
+    'usb_bot_upload_bytes_per_second', 'Средняя скорость загрузки, пока идут отправки')
+ARCHIVE_BUILDS = Counter(
+    'usb_bot_archive_builds_total',
+    'Запросы архива: built — новая сборка, joined — к идущей, reused — к готовой',
+    ['result'])
+ARCHIVE_JOBS_PENDING = Gauge(
+    'usb_bot_archive_jobs_pending', 'Архиваций в пуле: выполняются и ждут')
+WORKSPACE_USED_BYTES = Gauge(
+    'usb_bot_workspace_used_bytes', 'Занято архивами в WORKSPACE_DIR (с резервом)')
+LOOP_LAG_SECONDS = Histogram(
+    'usb_bot_loop_lag_seconds', 'Опоздание пульса event loop',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+LOOP_STALLS = Counter(
+    'usb_bot_loop_stalls_total', 'Остановки event loop дольше LOOP_STALL_THRESHOLD')
+LOOP_STALL_SECONDS = Histogram(
+    'usb_bot_loop_stall_seconds', 'Длительность остановок event loop')
+TMP_FREE_BYTES = Gauge(
+    'usb_bot_tmp_free_bytes', 'Свободно во временном каталоге')
+TMP_USED_BYTES = Gauge(
+    'usb_bot_tmp_used_bytes', 'Занято во временном каталоге')
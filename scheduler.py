@@ -0,0 +1,286 @@
+import asyncio
+import contextlib
+import heapq
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Awaitable, Callable, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+from storage import MenuDeletions
+
+logger = logging.getLogger(__name__)
+
+
+class MenuScheduler:
+    """
+    Одна задача на все отложенные удаления меню вместо задачи на сообщение.
+    Сроки лежат в куче и дублируются в MenuDeletions, поэтому переживают
+    перезапуск. Ключ — (chat_id, message_id): повторное планирование того же
+    сообщения (меню отредактировали) переносит срок, а не добавляет таймер.
+    Устаревшие элементы кучи пропускаются при извлечении.
+    """
+
+    def __init__(self, store: MenuDeletions) -> None:
+        self._store = store
+        self._heap = []
+        self._due = {}
+        self._delete = None
+        self._wakeup = None
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def schedule(self, chat_id: int, message_id: int, delay: float) -> None:
+        """Удалить сообщение через delay секунд; прежний срок отменяется."""
+        self._push((chat_id, message_id), time.time() + delay)
+
+    def cancel(self, chat_id: int, message_id: int) -> None:
+        if self._due.pop((chat_id, message_id), None) is not None:
+            self._store.forget(chat_id, message_id)
+
+    def start(self, delete: Callable[..., Awaitable]) -> None:
+        """
+        Загружает сохранённые сроки и запускает задачу удаления.
+        delete(chat_id=..., message_id=...) — обычно bot.delete_message.
+        """
+        self._delete = delete
+        for chat_id, message_id, due in self._store.all():
+            key = (chat_id, message_id)
+            self._due[key] = due
+            heapq.heappush(self._heap, (due, key))
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _push(self, key: tuple, due: float) -> None:
+        self._due[key] = due
+        self._store.put(key[0], key[1], due)
+        heapq.heappush(self._heap, (due, key))
+        # Куча чистится, когда устаревших элементов становится больше живых
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(d, k) for k, d in self._due.items()]
+            heapq.heapify(self._heap)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _pop_due(self, now: float) -> list:
+        ready = []
+        while self._heap and self._heap[0][0] <= now:
+            due, key = heapq.heappop(self._heap)
+            if self._due.get(key) != due:
+                continue
+            del self._due[key]
+            self._store.forget(*key)
+            ready.append(key)
+        return ready
+
+    def _next_delay(self, now: float) -> Optional[float]:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return max(self._heap[0][0] - now, 0) if self._heap else None
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            for chat_id, message_id in self._pop_due(now):
+                try:
+                    await self._delete(chat_id=chat_id, message_id=message_id)
+                except Exception as err:
+                    # Сообщение уже удалено или недоступно
+                    logger.debug("Меню %s/%s не удалено: %s", chat_id, message_id, err)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._next_delay(time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+
+# Классы запросов FairScheduler в порядке приоритета
+SINGLE, BULK = 'single', 'bulk'
+PRIORITIES = (SINGLE, BULK)
+
+
+class FairScheduler:
+    """
+    Очередь отправок с ограничениями: не больше slots одновременно всего
+    и per_user на одного пользователя. Свободное место получает сначала
+    запрос одного файла (SINGLE), потом пакет (BULK); внутри класса
+    пользователи обслуживаются по кругу, а не в порядке прихода, так что
+    длинная очередь одного не задерживает остальных.
+    """
+
+    def __init__(self, slots: int = 8, per_user: int = 2) -> None:
+        self.slots = max(slots, 1)
+        self.per_user = max(per_user, 1)
+        self.active = 0
+        self._by_user = Counter()
+        # класс -> {user: очередь future}; порядок ключей — очередь обхода
+        self._waiting = {kind: OrderedDict() for kind in PRIORITIES}
+
+    def running(self, user=None) -> int:
+        return self.active if user is None else self._by_user[user]
+
+    def waiting(self, kind: Optional[str] = None) -> int:
+        kinds = PRIORITIES if kind is None else (kind,)
+        return sum(not fut.done()
+                   for k in kinds
+                   for queue in self._waiting[k].values()
+                   for fut in queue)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user, kind: str = BULK):
+        """Асинхронный контекст: ждёт место для user и держит его до выхода."""
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting[kind].setdefault(user, deque()).append(fut)
+        self._dispatch()
+        metrics.DOWNLOAD_WAITING.inc(kind=kind)
+        try:
+            with metrics.DOWNLOAD_WAIT_SECONDS.time(kind=kind):
+                await fut
+        except asyncio.CancelledError:
+            # Место могли выдать в момент отмены — его нужно вернуть
+            if fut.done() and not fut.cancelled():
+                self._release(user)
+            raise
+        finally:
+            metrics.DOWNLOAD_WAITING.dec(kind=kind)
+        try:
+            yield
+        finally:
+            self._release(user)
+
+    def _release(self, user) -> None:
+        self.active -= 1
+        self._by_user[user] -= 1
+        if self._by_user[user] <= 0:
+            del self._by_user[user]
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.active < self.slots:
+            picked = self._pick()
+            if picked is None:
+                return
+            user, fut = picked
+            self.active += 1
+            self._by_user[user] += 1
+            fut.set_result(None)
+
+    def _pick(self):
+        for kind in PRIORITIES:
+            queue = self._waiting[kind]
+            for user in list(queue):
+                futures = queue[user]
+                while futures and futures[0].done():
+                    futures.popleft()
+                if not futures:
+                    del queue[user]
+                    continue
+                if self._by_user[user] >= self.per_user:
+                    continue
+                fut = futures.popleft()
+                if futures:
+                    queue.move_to_end(user)
+                else:
+                    del queue[user]
+                return user, fut
+        return None
+
+
+class TokenBucket:
+    """
+    Ограничение скорости rate единиц в секунду (для отправки — байт/с).
+    acquire(n) ждёт, пока накопится n (но не больше capacity): больший
+    запрос уводит запас в минус, и следующие вызовы ждут, пока долг
+    не вернётся. rate <= 0 — без ограничения.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            self._refill()
+            need = min(amount, self.capacity)
+            if self._tokens < need:
+                await asyncio.sleep((need - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= amount
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений с порядком внутри чата: обновления
+    разных чатов идут одновременно (всего до max_concurrent_updates),
+    одного чата — по одному в порядке прихода. Так состояние
+    ConversationHandler и user_data чата меняет один обработчик за раз.
+    Место из max_concurrent_updates берётся уже после очереди чата:
+    обновления, ждущие свой чат, не занимают места других чатов.
+    """
+
+    # Семафор BaseUpdateProcessor берётся до do_process_update, поэтому
+    # ограничивать он не должен: места выдаёт _slots внутри блокировки чата
+    UNBOUNDED = 2 ** 30
+
+    def __init__(self, max_concurrent_updates: int = 64) -> None:
+        self._limit = max_concurrent_updates
+        super().__init__(max_concurrent_updates)
+        self._semaphore = asyncio.BoundedSemaphore(self.UNBOUNDED)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # ключ чата -> [Lock, сколько обновлений его ждут или держат]
+        self._chats = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        # Настоящий предел, а не размер ничего не ограничивающего семафора
+        return self._limit
+
+    @staticmethod
+    def chat_key(update):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, 'effective_user', None)
+        return ('user', user.id) if user is not None else None
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self.chat_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,276 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """
+    Открывает базу состояния бота (SQLite).
+    Соединение общее для потоков, доступ к нему защищают сами хранилища.
+    """
+    if db_path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+class FileIdCache:
+    """
+    Кэш file_id, которые Telegram вернул после загрузки файла.
+    Ключ — (путь, вариант), где вариант 'raw' для самого файла
+    и 'zip:<политика сжатия>' для архива из частей. Запись действительна,
+    пока у файла не изменились размер и mtime; устаревшая запись
+    удаляется при чтении.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self._conn = connect(db_path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS file_ids ('
+                ' path TEXT NOT NULL,'
+                ' variant TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' mtime_ns INTEGER NOT NULL,'
+                ' parts TEXT NOT NULL,'
+                ' PRIMARY KEY (path, variant))'
+            )
+
+    def get(self, path: str, size: int, mtime_ns: int,
+            variant: str = 'raw') -> Optional[list]:
+        """
+        Возвращает список (имя файла, file_id) или None.
+        Для 'raw' в списке один элемент, для архива — части по порядку.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT size, mtime_ns, parts FROM file_ids'
+                ' WHERE path = ? AND variant = ?',
+                (path, variant)
+            ).fetchone()
+            if row is None:
+                return None
+            if (row[0], row[1]) != (size, mtime_ns):
+                with self._conn:
+                    self._conn.execute(
+                        'DELETE FROM file_ids WHERE path = ?', (path,))
+                return None
+        return [tuple(part) for part in json.loads(row[2])]
+
+    def put(self, path: str, size: int, mtime_ns: int, parts: list,
+            variant: str = 'raw') -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO file_ids'
+                ' (path, variant, size, mtime_ns, parts)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (path, variant, size, mtime_ns, json.dumps(parts))
+            )
+
+    def forget(self, path: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM file_ids WHERE path = ?', (path,))
+
+
+class MenuDeletions:
+    """
+    Отложенные удаления меню: (chat_id, message_id) -> срок (unix-время).
+    На одно сообщение — одна запись, новое планирование заменяет срок.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self._conn = connect(db_path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS menu_deletions ('
+                ' chat_id INTEGER NOT NULL,'
+                ' message_id INTEGER NOT NULL,'
+                ' due REAL NOT NULL,'
+                ' PRIMARY KEY (chat_id, message_id))'
+            )
+
+    def put(self, chat_id: int, message_id: int, due: float) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO menu_deletions (chat_id, message_id, due)'
+                ' VALUES (?, ?, ?)',
+                (chat_id, message_id, due)
+            )
+
+    def forget(self, chat_id: int, message_id: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM menu_deletions WHERE chat_id = ? AND message_id = ?',
+                (chat_id, message_id)
+            )
+
+    def all(self) -> list:
+        """Все записи (chat_id, message_id, due) по возрастанию срока."""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT chat_id, message_id, due FROM menu_deletions ORDER BY due'
+            ).fetchall()
+
+
+class DownloadJobs:
+    """
+    Задания на отправку группы файлов. Задание — чат, пользователь,
+    подпись и сообщение «Загружаю…»; элементы — файлы по порядку.
+    У элемента хранятся уже подтверждённые части архива (имя, file_id),
+    их число — курсор, с которого отправка продолжается после сбоя,
+    и версия, под которую эти части собраны (размер, mtime, политика
+    сжатия, размер части): с другой версией части не продолжаются.
+    Статусы задания: pending, running, done, cancelled;
+    элемента: pending, done, failed.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self._conn = connect(db_path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS download_jobs ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' chat_id INTEGER NOT NULL,'
+                ' user_id INTEGER NOT NULL,'
+                ' user_name TEXT NOT NULL,'
+                ' label TEXT NOT NULL,'
+                ' message_id INTEGER,'
+                ' status TEXT NOT NULL,'
+                ' updated REAL NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS download_items ('
+                ' job_id INTEGER NOT NULL,'
+                ' seq INTEGER NOT NULL,'
+                ' path TEXT NOT NULL,'
+                ' status TEXT NOT NULL,'
+                ' parts TEXT NOT NULL,'
+                ' error TEXT,'
+                ' version TEXT,'
+                ' PRIMARY KEY (job_id, seq))'
+            )
+            columns = [row[1] for row in self._conn.execute(
+                'PRAGMA table_info(download_items)')]
+            if 'version' not in columns:
+                # База от прежней версии бота
+                self._conn.execute('ALTER TABLE download_items ADD COLUMN version TEXT')
+
+    def create(self, chat_id: int, user_id: int, user_name: str, label: str,
+               paths: list, message_id: Optional[int] = None) -> int:
+        with self._lock, self._conn:
+            job_id = self._conn.execute(
+                'INSERT INTO download_jobs'
+                ' (chat_id, user_id, user_name, label, message_id, status, updated)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (chat_id, user_id, user_name, label, message_id, 'pending', time.time())
+            ).lastrowid
+            self._conn.executemany(
+                'INSERT INTO download_items (job_id, seq, path, status, parts)'
+                " VALUES (?, ?, ?, 'pending', '[]')",
+                [(job_id, seq, path) for seq, path in enumerate(paths)]
+            )
+        return job_id
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT id, chat_id, user_id, user_name, label, message_id, status,'
+                ' (SELECT COUNT(*) FROM download_items WHERE job_id = id)'
+                ' FROM download_jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'chat_id', 'user_id', 'user_name', 'label', 'message_id', 'status',
+                'items')
+        return dict(zip(keys, row))
+
+    def items(self, job_id: int) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT seq, path, status, parts, error, version FROM download_items'
+                ' WHERE job_id = ? ORDER BY seq', (job_id,)
+            ).fetchall()
+        return [
+            {'seq': seq, 'path': path, 'status': status,
+             'parts': [tuple(part) for part in json.loads(parts)], 'error': error,
+             'version': json.loads(version) if version else None}
+            for seq, path, status, parts, error, version in rows
+        ]
+
+    def unfinished(self, chat_id: Optional[int] = None) -> list:
+        """id заданий в статусе pending/running, по порядку создания."""
+        query = "SELECT id FROM download_jobs WHERE status IN ('pending', 'running')"
+        args = ()
+        if chat_id is not None:
+            query += ' AND chat_id = ?'
+            args = (chat_id,)
+        with self._lock:
+            return [row[0] for row in self._conn.execute(query + ' ORDER BY id', args)]
+
+    def set_status(self, job_id: int, status: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE download_jobs SET status = ?, updated = ? WHERE id = ?',
+                (status, time.time(), job_id)
+            )
+
+    def ack_part(self, job_id: int, seq: int, name: str, file_id: str,
+                 version=None) -> None:
+        """
+        Часть элемента seq доставлена; курсор элемента сдвигается на неё.
+        С первой частью запоминается version — из какой версии файла
+        собраны части (любое JSON-значение).
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT parts, version FROM download_items WHERE job_id = ? AND seq = ?',
+                (job_id, seq)
+            ).fetchone()
+            parts = json.loads(row[0])
+            stored = row[1]
+            if not parts and version is not None:
+                stored = json.dumps(version)
+            parts.append([name, file_id])
+            self._conn.execute(
+                'UPDATE download_items SET parts = ?, version = ? WHERE job_id = ? AND seq = ?',
+                (json.dumps(parts), stored, job_id, seq)
+            )
+
+    def reset_item(self, job_id: int, seq: int) -> None:
+        """Файл изменился: подтверждённые части и их версия отбрасываются."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE download_items SET parts = '[]', version = NULL"
+                ' WHERE job_id = ? AND seq = ?',
+                (job_id, seq)
+            )
+
+    def finish_item(self, job_id: int, seq: int, status: str,
+                    error: Optional[str] = None) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE download_items SET status = ?, error = ?'
+                ' WHERE job_id = ? AND seq = ?',
+                (status, error, job_id, seq)
+            )
+
+    def prune(self, older_than: float) -> int:
+        """Удаляет завершённые задания, не менявшиеся с older_than (unix-время)."""
+        with self._lock, self._conn:
+            ids = [row[0] for row in self._conn.execute(
+                "SELECT id FROM download_jobs"
+                " WHERE status IN ('done', 'cancelled') AND updated < ?",
+                (older_than,)
+            )]
+            self._conn.executemany(
+                'DELETE FROM download_items WHERE job_id = ?', [(i,) for i in ids])
+            self._conn.executemany(
+                'DELETE FROM download_jobs WHERE id = ?', [(i,) for i in ids])
+        return len(ids)
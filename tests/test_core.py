@@ -1,14 +1,59 @@
+import contextlib
+import types
+import functools
+import json
 import os
 import tempfile
 import unittest
-from core import FilesData, archive_file, split_file, archive_files
-from usb_bot import is_user_allowed, make_greeting, is_safe_path, is_file_accessible, log_download, check_env_vars, clean_old_archives, ARCHIVE_SEMAPHORE
+import zipfile
+from core import (
+    File, FilesData, FileIndex, CompressionPolicy, archive_file, split_file,
+    archive_files, stream_archive_parts, parse_name_stamp, DEFAULT_POLICY,
+    POLICIES,
+)
+from usb_bot import is_user_allowed, make_greeting, is_safe_path, is_file_accessible, log_download, check_env_vars
 from unittest.mock import patch, MagicMock, AsyncMock
 import datetime
 import logging
 import time
+import threading
+from collections import Counter
 import asyncio
 from telegram import InlineKeyboardButton
+import metrics
+import usb_bot
+import workers
+from archives import ArchiveBuilds
+from jobs import DownloadWorker
+from scheduler import BULK, SINGLE, FairScheduler, MenuScheduler, TokenBucket
+from storage import DownloadJobs, FileIdCache, MenuDeletions
+from workers import JobCancelled, WorkerPool
+from uploads import UploadEngine
+from workspace import Workspace, WorkspaceFull
+
+
+def setUpModule():
+    # Кэш file_id в памяти, чтобы тесты не писали в state.sqlite3
+    usb_bot.FILE_ID_CACHE = FileIdCache(':memory:')
+    usb_bot.MENU_SCHEDULER = MenuScheduler(MenuDeletions(':memory:'))
+    # Сборки архивов не переживают отправку, иначе тесты делили бы части
+    usb_bot.ARCHIVE_BUILDS = ArchiveBuilds(ttl=0)
+    usb_bot.DOWNLOAD_WORKER = DownloadWorker(
+        DownloadJobs(':memory:'), usb_bot.send_job_item, usb_bot.finish_download_job)
+    # Флуд-лимиты Telegram не замедляют тесты
+    usb_bot.UPLOAD_ENGINE = UploadEngine(chat_rate=0, global_rate=0)
+    # Архивация в потоках: тестам не нужны отдельные процессы
+    workers._pool = WorkerPool(cpu_workers=0)
+
+
+def sent_message(file_id):
+    """Ответ Telegram на send_document с заданным file_id."""
+    return MagicMock(audio=None, document=MagicMock(file_id=file_id))
+
+
+def index_of(files_data):
+    """Подменяет общий индекс файлов готовым FilesData."""
+    return MagicMock(snapshot=MagicMock(return_value=files_data))
 
 
 class TestFilesData(unittest.TestCase):
@@ -30,6 +75,82 @@ class TestFilesData(unittest.TestCase):
         names = sorted([f.name for f in files.file_list])
         self.assertEqual(names, ['a.txt', 'b.mp3'])
 
+    def test_file_single_stat_and_lazy_format(self):
+        with patch('core.os.stat', wraps=os.stat) as stat_mock:
+            f = File(self.file1)
+        self.assertEqual(stat_mock.call_count, 1)
+        self.assertFalse(hasattr(f, '__dict__'))
+        self.assertIsNone(f._h_size)
+        self.assertEqual(f.h_size, '5B')
+        self.assertIs(f.h_size, f._h_size)
+        self.assertEqual(f.dir, self.test_dir.name)
+
+    def test_sorted_orders(self):
+        files = FilesData()
+        for name, size_, ctime in [('b', 3, 20.0), ('c', 1, 10.0), ('a', 2, 30.0)]:
+            f = MagicMock(file=f'/usb/{name}', size=size_, ctime=ctime)
+            f.name = name
+            files.add_file(f)
+        self.assertEqual([f.name for f in files.order_by_name()], ['a', 'b', 'c'])
+        self.assertEqual([f.name for f in files.order_by_size()], ['c', 'a', 'b'])
+        self.assertEqual([f.name for f in files.order_by_ctime(reverse=True)], ['a', 'b', 'c'])
+        self.assertEqual([f.name for f in files.order_by_ctime(1, 3, reverse=True)], ['b', 'c'])
+        self.assertEqual(files.order_by_size(5, 10, reverse=True), [])
+        files.remove_file('/usb/a')
+        self.assertEqual([f.name for f in files.order_by_name()], ['b', 'c'])
+        self.assertEqual(files.size_sum, 4)
+
+    def test_bulk_load_100k(self):
+        from benchmarks.files import synthetic_stats
+        files = [File(path, st) for path, st in synthetic_stats(100000)]
+        files.sort(key=lambda f: f.uid)
+        data = FilesData()
+        # Пачка сортируется целиком, без вставок по одной
+        with patch('core.SortedIndex.insert', side_effect=AssertionError):
+            started = time.perf_counter()
+            data.add_files(files)
+            self.assertLess(time.perf_counter() - started, 5.0)
+        self.assertEqual(data.count, 100000)
+        sizes = [f.size for f in data.ordered('size')]
+        self.assertEqual(sizes, sorted(sizes))
+        self.assertEqual(data.ordered('ctime', 0, 1, reverse=True)[0], max(files, key=lambda f: f.ctime))
+        # Повторная запись того же пути заменяет прежнюю
+        newer = File(files[0].file, os.stat_result((0o100644, 0, 1, 1, 0, 0, 1, 0, 0, 0)))
+        data.add_files([newer])
+        self.assertEqual(data.count, 100000)
+        self.assertIs(data.ordered('size', 0, 1)[0], newer)
+
+    def test_date_buckets(self):
+        names = [
+            '20240428-170000.mp3', '20240428-090000.mp3',
+            '20240421.mp3', 'notes.txt', '20241399-000000.mp3',
+        ]
+        files = FilesData()
+        for name in names:
+            path = os.path.join(self.test_dir.name, name)
+            with open(path, 'w') as f:
+                f.write('x')
+            files.add_file(File(path))
+        sunday = datetime.date(2024, 4, 28)
+        self.assertEqual(
+            [f.name for f in files.on_date(sunday)],
+            ['20240428-090000.mp3', '20240428-170000.mp3']
+        )
+        self.assertEqual(files.get(os.path.join(self.test_dir.name, '20240428-170000.mp3')).stamp,
+                         datetime.datetime(2024, 4, 28, 17, 0))
+        self.assertEqual(len(files.between(datetime.date(2024, 4, 1), sunday)), 3)
+        self.assertEqual(files.on_date(datetime.date(2024, 4, 21))[0].stamp, None)
+        files.remove_file(os.path.join(self.test_dir.name, '20240421.mp3'))
+        self.assertEqual(files.on_date(datetime.date(2024, 4, 21)), [])
+
+    def test_stamp_after_other_digits(self):
+        sunday = datetime.date(2024, 9, 15)
+        self.assertEqual(parse_name_stamp('REC_123456789_20240915.mp3'), (sunday, None))
+        self.assertEqual(parse_name_stamp('ZOOM0001_12345678_20240915.wav'), (sunday, None))
+        self.assertEqual(parse_name_stamp('ZOOM0001_12345678_20240915-093000.wav'),
+                         (sunday, datetime.datetime(2024, 9, 15, 9, 30)))
+        self.assertEqual(parse_name_stamp('123456789.mp3'), (None, None))
+
     def test_archive_file(self):
         archive_path = os.path.join(self.test_dir.name, 'archive.zip')
         archive_file(self.file1, archive_path)
@@ -37,6 +158,73 @@ class TestFilesData(unittest.TestCase):
         # Проверяем, что zip-файл не пустой
         self.assertGreater(os.path.getsize(archive_path), 0)
 
+    def test_stream_archive_parts(self):
+        import zipfile
+        data = os.urandom(600 * 1024)
+        src = os.path.join(self.test_dir.name, 'rec.mp3')
+        with open(src, 'wb') as f:
+            f.write(data)
+        archive_path = os.path.join(self.test_dir.name, 'rec.mp3.zip')
+        joined = b''
+        names = []
+        for part in stream_archive_parts([src], archive_path, part_size=100 * 1024, chunk_size=16 * 1024):
+            # На диске одновременно не больше готовой части и текущей
+            self.assertLessEqual(len(os.listdir(self.test_dir.name)), 5)
+            names.append(os.path.basename(part))
+            with open(part, 'rb') as f:
+                joined += f.read()
+            os.remove(part)
+        self.assertGreater(len(names), 3)
+        self.assertEqual(names[0], 'rec.mp3.zip.part0')
+        self.assertTrue(all(n.startswith('rec.mp3.zip.part') for n in names))
+        import io
+        with zipfile.ZipFile(io.BytesIO(joined)) as zf:
+            self.assertEqual(zf.read('rec.mp3'), data)
+
+    def test_stream_archive_single_part(self):
+        archive_path = os.path.join(self.test_dir.name, 'a.zip')
+        parts = list(stream_archive_parts([self.file1, self.file2], archive_path))
+        self.assertEqual(parts, [archive_path])
+        import zipfile
+        with zipfile.ZipFile(archive_path) as zf:
+            self.assertEqual(sorted(zf.namelist()), ['a.txt', 'b.mp3'])
+
+    def test_compression_policy(self):
+        import zipfile
+        policy = CompressionPolicy(sample_size=1024)
+        text = os.path.join(self.test_dir.name, 'notes.log')
+        with open(text, 'w') as f:
+            f.write('20240428-170000 запись службы\n' * 200)
+        noise = os.path.join(self.test_dir.name, 'noise.bin')
+        with open(noise, 'wb') as f:
+            f.write(os.urandom(4096))
+        self.assertEqual(policy.choose(self.file2), (zipfile.ZIP_STORED, None))
+        self.assertEqual(policy.choose('rec.WAV'), (zipfile.ZIP_DEFLATED, 1))
+        self.assertEqual(policy.choose(text), (zipfile.ZIP_DEFLATED, 6))
+        self.assertEqual(policy.choose(noise), (zipfile.ZIP_STORED, None))
+        archive_path = os.path.join(self.test_dir.name, 'mixed.zip')
+        archive_files([self.file2, text, noise], archive_path, policy)
+        with zipfile.ZipFile(archive_path) as zf:
+            types = {i.filename: i.compress_type for i in zf.infolist()}
+            self.assertEqual(zf.read('noise.bin'), open(noise, 'rb').read())
+        self.assertEqual(types, {
+            'b.mp3': zipfile.ZIP_STORED,
+            'notes.log': zipfile.ZIP_DEFLATED,
+            'noise.bin': zipfile.ZIP_STORED,
+        })
+        # Потоковая архивация частями выбирает сжатие так же
+        sizes = {}
+        for name in ('store', 'fast'):
+            archive_path = os.path.join(self.test_dir.name, f'{name}.zip')
+            list(stream_archive_parts([text], archive_path, 1 << 20, policy=POLICIES[name]))
+            with zipfile.ZipFile(archive_path) as zf:
+                info = zf.getinfo('notes.log')
+                self.assertEqual(zf.read('notes.log'), open(text, 'rb').read())
+            sizes[name] = (info.compress_type, info.compress_size)
+        self.assertEqual(sizes['store'][0], zipfile.ZIP_STORED)
+        self.assertEqual(sizes['fast'][0], zipfile.ZIP_DEFLATED)
+        self.assertLess(sizes['fast'][1], sizes['store'][1])
+
     def test_split_file(self):
         # Создаём файл 120 байт
         big_file = os.path.join(self.test_dir.name, 'big.bin')
@@ -50,6 +238,76 @@ class TestFilesData(unittest.TestCase):
             os.remove(p)
 
 
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.path = self.test_dir.name
+        with open(os.path.join(self.path, 'a.mp3'), 'w') as f:
+            f.write('hello')
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def wait_for(self, index, count, timeout=5.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if index.snapshot().count == count:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_rescan_tracks_changes(self):
+        index = FileIndex(self.path)
+        self.assertTrue(index.rescan())
+        self.assertEqual(index.version, 1)
+        self.assertFalse(index.rescan())
+        self.assertEqual(index.version, 1)
+        os.mkdir(os.path.join(self.path, 'sub'))
+        with open(os.path.join(self.path, 'sub', 'b.mp3'), 'w') as f:
+            f.write('world')
+        self.assertTrue(index.rescan())
+        snapshot = index.snapshot()
+        self.assertEqual(snapshot.count, 2)
+        self.assertEqual(snapshot.size_sum, 10)
+        self.assertEqual(snapshot.version, 2)
+        os.remove(os.path.join(self.path, 'a.mp3'))
+        index.rescan()
+        self.assertEqual([f.name for f in index.snapshot().file_list], ['b.mp3'])
+
+    def test_snapshot_reused_until_change(self):
+        index = FileIndex(self.path)
+        index.rescan()
+        self.assertIs(index.snapshot(), index.snapshot())
+        index.remove_tree(self.path)
+        self.assertEqual(index.snapshot().count, 0)
+
+    def test_watcher_picks_up_new_files(self):
+        index = FileIndex(self.path)
+        index.start()
+        try:
+            self.assertEqual(index.snapshot().count, 1)
+            os.mkdir(os.path.join(self.path, 'sub'))
+            with open(os.path.join(self.path, 'sub', 'b.mp3'), 'w') as f:
+                f.write('world')
+            self.assertTrue(self.wait_for(index, 2))
+            os.remove(os.path.join(self.path, 'a.mp3'))
+            self.assertTrue(self.wait_for(index, 1))
+        finally:
+            index.stop()
+
+    def test_polling_fallback(self):
+        index = FileIndex(self.path, poll_interval=0.05)
+        with patch('core._Inotify', side_effect=OSError('нет inotify')):
+            index.start()
+        try:
+            self.assertEqual(index.mode, 'poll')
+            with open(os.path.join(self.path, 'b.mp3'), 'w') as f:
+                f.write('world')
+            self.assertTrue(self.wait_for(index, 2))
+        finally:
+            index.stop()
+
+
 class TestUserFilter(unittest.TestCase):
     def test_user_allowed_empty(self):
         # FILTERED_USERS пустой — разрешить всем
@@ -63,25 +321,43 @@ class TestUserFilter(unittest.TestCase):
 
 
 class TestGreeting(unittest.TestCase):
-    @patch('psutil.disk_usage')
-    def test_make_greeting(self, mock_disk):
-        # Мокаем disk_usage
-        mock_disk.return_value = MagicMock(free=10 * 1024 ** 3)
-        # Мокаем файлы
+    def test_make_greeting(self):
         now = datetime.datetime.now().timestamp()
-        files = MagicMock()
-        files.file_list = [
-            MagicMock(name='a.txt', ctime=now - 100),
-            MagicMock(name='b.mp3', ctime=now)
-        ]
+        files = FilesData()
+        for name, ctime in (('a.txt', now - 100), ('b.mp3', now)):
+            f = MagicMock(file='/tmp/' + name, uid=name, size=1024,
+                          ctime=ctime, date=None)
+            f.name = name
+            files.add_file(f)
         msg = make_greeting(
-            'Тест', files, '/tmp',
+            'Тест', files, 10 * 1024 ** 3,
             datetime.datetime.now() - datetime.timedelta(hours=1)
         )
         self.assertIn('Привет, Тест!', msg)
         self.assertIn('Файлов в папке: 2', msg)
+        self.assertIn('.txt: 1', msg)
         self.assertIn('10.00 ГБ', msg)
         self.assertIn('Аптайм бота: 1:00:00', msg)
+        self.assertIn('b.mp3', msg)
+
+    def test_greeting_stats_follow_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ('a.mp3', 'b.mp3', 'c.txt'):
+                with open(os.path.join(tmpdir, name), 'wb') as f:
+                    f.write(b'x' * 10)
+            index = FileIndex(tmpdir)
+            index.rescan()
+            self.assertIsNotNone(index.sample_disk())
+            files = index.snapshot()
+            self.assertEqual(files.ext_counts, {'.mp3': 2, '.txt': 1})
+            self.assertEqual(files.size_sum, 30)
+            os.remove(os.path.join(tmpdir, 'c.txt'))
+            index.update_path(os.path.join(tmpdir, 'c.txt'))
+            files = index.snapshot()
+            self.assertEqual(files.ext_counts, {'.mp3': 2})
+            self.assertEqual(files.newest().name,
+                             max(files.file_list, key=lambda f: f.ctime).name)
+            self.assertIsNone(FilesData().newest())
 
 
 class TestDateFilter(unittest.TestCase):
@@ -147,43 +423,1154 @@ class TestCheckEnvVars(unittest.TestCase):
             check_env_vars()
 
 
-class TestArchiveSemaphore(unittest.IsolatedAsyncioTestCase):
-    async def test_archive_semaphore_limit(self):
-        # Проверяем, что одновременно не может быть больше 20 задач
-        sem = ARCHIVE_SEMAPHORE
-        max_concurrent = 0
-        current = 0
-        lock = asyncio.Lock()
-        async def task():
-            nonlocal max_concurrent, current
-            async with sem:
-                async with lock:
-                    current += 1
-                    if current > max_concurrent:
-                        max_concurrent = current
-                await asyncio.sleep(0.1)
-                async with lock:
-                    current -= 1
-        tasks = [asyncio.create_task(task()) for _ in range(25)]
+class TestFairScheduler(unittest.IsolatedAsyncioTestCase):
+    async def test_total_and_per_user_limits(self):
+        sched = FairScheduler(slots=3, per_user=2)
+        peak_total = 0
+        peak_user = Counter()
+        running = Counter()
+
+        async def task(user):
+            nonlocal peak_total
+            async with sched.slot(user):
+                running[user] += 1
+                peak_total = max(peak_total, sum(running.values()))
+                peak_user[user] = max(peak_user[user], running[user])
+                await asyncio.sleep(0.01)
+                running[user] -= 1
+        await asyncio.gather(*(task(user) for user in [1] * 10 + [2] * 5))
+        self.assertLessEqual(peak_total, 3)
+        self.assertEqual(max(peak_user.values()), 2)
+        self.assertEqual(sched.running(), 0)
+        self.assertEqual(sched.waiting(), 0)
+
+    async def test_single_before_bulk_and_round_robin(self):
+        sched = FairScheduler(slots=1, per_user=1)
+        order = []
+        gate = asyncio.Event()
+
+        async def task(user, kind):
+            async with sched.slot(user, kind):
+                order.append((user, kind))
+                await gate.wait()
+        # Место занято пакетом пользователя 1, дальше все ждут
+        tasks = [asyncio.create_task(task(1, BULK))]
+        await asyncio.sleep(0)
+        for user, kind in [(1, BULK), (1, BULK), (2, BULK), (3, SINGLE)]:
+            tasks.append(asyncio.create_task(task(user, kind)))
+        await asyncio.sleep(0)
+        self.assertEqual(sched.waiting(), 4)
+        gate.set()
         await asyncio.gather(*tasks)
-        self.assertLessEqual(max_concurrent, 20)
+        self.assertEqual(order, [(1, BULK), (3, SINGLE), (1, BULK), (2, BULK), (1, BULK)])
+
+    async def test_cancelled_waiter_frees_queue(self):
+        sched = FairScheduler(slots=1, per_user=1)
+        async with sched.slot(1):
+            waiter = asyncio.create_task(sched.slot(2).__aenter__())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+        self.assertEqual(sched.running(), 0)
+        async with sched.slot(3):
+            self.assertEqual(sched.running(3), 1)
+
+    async def test_token_bucket_limits_rate(self):
+        bucket = TokenBucket(rate=1000, capacity=100)
+        started = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire(100)
+        # Запаса хватает на первый вызов, остальные ждут по 0.1 с
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        await TokenBucket(rate=0).acquire(10 ** 9)
+
+
+class TestFileIdCache(unittest.TestCase):
+    def test_get_put_and_invalidate(self):
+        cache = FileIdCache(':memory:')
+        self.assertIsNone(cache.get('/usb/a.mp3', 10, 1))
+        cache.put('/usb/a.mp3', 10, 1, [('a.mp3', 'id-a')])
+        cache.put('/usb/a.mp3', 10, 1, [('a.mp3.zip', 'id-z')], variant='zip:auto')
+        self.assertEqual(cache.get('/usb/a.mp3', 10, 1), [('a.mp3', 'id-a')])
+        # Файл изменился — все записи по нему сбрасываются
+        self.assertIsNone(cache.get('/usb/a.mp3', 11, 2))
+        self.assertIsNone(cache.get('/usb/a.mp3', 10, 1, variant='zip:auto'))
+
+    def test_persistent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, 'state.sqlite3')
+            FileIdCache(db_path).put('/usb/a.mp3', 10, 1, [('a.mp3', 'id-a')])
+            self.assertEqual(FileIdCache(db_path).get('/usb/a.mp3', 10, 1), [('a.mp3', 'id-a')])
+
+
+class TestSendFileCached(unittest.IsolatedAsyncioTestCase):
+    async def test_second_send_reuses_file_id(self):
+        from usb_bot import send_file, send_archive
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'a.txt')
+            with open(path, 'wb') as f:
+                f.write(b'hello')
+            context = MagicMock()
+            context.bot.send_document = AsyncMock(return_value=sent_message('id-a'))
+            user = MagicMock(id=1, first_name='Test')
+            await send_file(context, 1, user, path)
+            await send_file(context, 1, user, path)
+            first, second = context.bot.send_document.await_args_list
+            self.assertNotIsInstance(first.kwargs['document'], str)
+            self.assertEqual(second.kwargs['document'], 'id-a')
+            # Архив тоже собирается только один раз
+            with patch('workers.stream_archive_parts', wraps=stream_archive_parts) as archive:
+                await send_archive(context, 1, user, path)
+                await send_archive(context, 1, user, path)
+            self.assertEqual(archive.call_count, 1)
+
+
+    async def test_rejected_file_id_is_uploaded_again(self):
+        import telegram
+        from usb_bot import send_file, send_archive
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'a.txt')
+            with open(path, 'wb') as f:
+                f.write(b'hello')
+            st = os.stat(path)
+            cache = usb_bot.get_file_id_cache()
+            cache.put(path, st.st_size, st.st_mtime_ns, [('a.txt', 'old-id')])
+            context = MagicMock()
+            context.bot.send_document = AsyncMock(side_effect=[
+                telegram.error.BadRequest('wrong file identifier'), sent_message('new-id')])
+            user = MagicMock(id=1, first_name='Test')
+            await send_file(context, 1, user, path)
+            first, second = context.bot.send_document.await_args_list
+            self.assertEqual(first.kwargs['document'], 'old-id')
+            self.assertNotIsInstance(second.kwargs['document'], str)
+            self.assertEqual(cache.get(path, st.st_size, st.st_mtime_ns), [('a.txt', 'new-id')])
+            # Часть архива с отклонённым file_id собирается и загружается заново
+            variant = f'zip:{usb_bot.ARCHIVE_POLICY.name}'
+            cache.put(path, st.st_size, st.st_mtime_ns, [('a.txt.zip', 'old-zip')],
+                      variant=variant)
+            context.bot.send_document = AsyncMock(side_effect=[
+                telegram.error.BadRequest('wrong file identifier'), sent_message('new-zip')])
+            await send_archive(context, 1, user, path)
+            self.assertEqual(context.bot.send_document.await_count, 2)
+            self.assertEqual(cache.get(path, st.st_size, st.st_mtime_ns, variant=variant),
+                             [('a.txt.zip', 'new-zip')])
+
+    async def test_message_without_file_id_not_cached(self):
+        from usb_bot import send_file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'b.txt')
+            with open(path, 'wb') as f:
+                f.write(b'hello')
+            context = MagicMock()
+            context.bot.send_document = AsyncMock(
+                return_value=MagicMock(audio=None, document=None))
+            await send_file(context, 1, MagicMock(id=1, first_name='Test'), path)
+            st = os.stat(path)
+            self.assertIsNone(usb_bot.get_file_id_cache().get(path, st.st_size, st.st_mtime_ns))
+
+
+class TestWorkerPool(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.test_dir.name, 'big.wav')
+        with open(self.src, 'wb') as f:
+            f.write(os.urandom(24 * 1024 * 1024))
+        self.archive_path = os.path.join(self.test_dir.name, 'big.wav.zip')
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    async def test_handlers_respond_during_archive(self):
+        from benchmarks.webhook import WebhookHarness
+        files_data = FilesData()
+        files_data.add_file(File(self.src))
+        big = files_data.file_list[0]
+        index = index_of(files_data)
+        index.disk_free = None
+        store = DownloadJobs(':memory:')
+        worker = DownloadWorker(store, usb_bot.send_job_item, usb_bot.finish_download_job)
+
+        def calls(method):
+            return [c for c in harness.api.calls if c[0] == method]
+
+        with patch('usb_bot.get_file_index', return_value=index), \
+                patch('usb_bot.schedule_menu_deletion'), \
+                patch('usb_bot.DOWNLOAD_WORKER', worker), \
+                patch('usb_bot.MAX_FILE_SIZE', 1024 * 1024), \
+                patch('usb_bot.is_safe_path', return_value=True), \
+                patch.dict(os.environ, {'FILTERED_USERS': ''}):
+            async with WebhookHarness() as harness:
+                worker.start(harness.app.bot)
+                record = harness.api.record
 
+                def slow_record(method, params):
+                    if method == 'sendDocument':
+                        time.sleep(0.05)
+                    record(method, params)
+                harness.api.record = slow_record
+                await harness.command('/usb')
+                await asyncio.to_thread(harness.api.wait_for, 'sendMessage')
+                await harness.click(f'file_to_download:{big.uid}:{big.tag}')
+                await asyncio.to_thread(harness.api.wait_for, 'sendDocument')
+                # Пока архив отправляется, тот же чат получает ответы
+                self.assertLess(await harness.click(str(usb_bot.ONE)), 1.0)
+                # «Выход» отменяет отправку и убирает «загружаю...»
+                await harness.click(str(usb_bot.TWO))
+                await asyncio.wait_for(worker.wait(1), timeout=10)
+                job = store.get(1)
+                self.assertEqual(job['status'], 'cancelled')
+                deleted = [int(c[2]['message_id']) for c in calls('deleteMessage')]
+                self.assertIn(job['message_id'], deleted)
+                self.assertLess(len(calls('sendDocument')), 20)
+                self.assertFalse(any('Загрузка завершена' in c[2].get('text', '')
+                                     for c in calls('sendMessage')))
+            await worker.stop()
 
-class TestCleanOldArchives(unittest.TestCase):
-    def test_clean_old_archives(self):
+    async def test_process_pool_parts_and_dead_worker(self):
+        import signal
+        from concurrent.futures.process import BrokenProcessPool
+        pool = WorkerPool(cpu_workers=1, io_workers=2)
+        self.addCleanup(pool.shutdown)
+        # Обычная сборка в процессе пула: части через очередь Manager
+        parts = [part async for part in pool.archive_parts([self.src], self.archive_path, 8 * 1024 * 1024)]
+        self.assertGreater(len(parts), 1)
+        with open(self.archive_path, 'wb') as archive:
+            for part in parts:
+                with open(part, 'rb') as f:
+                    archive.write(f.read())
+                os.remove(part)
+        with zipfile.ZipFile(self.archive_path) as zipf:
+            self.assertIsNone(zipf.testzip())
+        # Процесс пула убит посреди сборки: генератор падает, а не ждёт вечно
+        stream = pool.archive_parts([self.src], self.archive_path, 8 * 1024 * 1024)
+        os.remove(await stream.__anext__())
+        for pid in list(pool.cpu._processes):
+            os.kill(pid, signal.SIGKILL)
+        with self.assertRaises(BrokenProcessPool):
+            await asyncio.wait_for(stream.__anext__(), 10)
+        self.assertEqual(pool.pending, 0)
+        # Следующая архивация получает новый пул процессов
+        parts = [part async for part in pool.archive_parts([self.src], self.archive_path, 8 * 1024 * 1024)]
+        for part in parts:
+            os.remove(part)
+        self.assertGreater(len(parts), 1)
+
+    async def test_cancel_and_queue_limit(self):
+        from workers import QueueFull
+        pool = WorkerPool(cpu_workers=0, max_jobs=1, max_queued=0)
+        self.addCleanup(pool.shutdown)
+        stream = pool.archive_parts([self.src], self.archive_path, 4 * 1024 * 1024, owner=7)
+        first = await stream.__anext__()
+        os.remove(first)
+        with self.assertRaises(QueueFull):
+            await pool.archive_parts([self.src], self.archive_path, 1).__anext__()
+        self.assertEqual(pool.cancel(7), 1)
+        with self.assertRaises(JobCancelled):
+            await stream.__anext__()
+        self.assertEqual(pool.pending, 0)
+        self.assertEqual(os.listdir(self.test_dir.name), ['big.wav'])
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def test_suite_smoke(self):
+        from benchmarks import suite
+        report = suite.run([30], archive_mb=1, repeat=1)
+        names = [r['name'] for r in report['results']]
+        self.assertEqual(names, [
+            'get_files', 'index_rescan', 'render_one_page', 'render_six_keyboard',
+            'archive_files', 'split_file', 'stream_archive_parts',
+        ])
+        self.assertEqual(report['results'][0]['files'], 30)
+
+
+class TestStartup(unittest.TestCase):
+    # Бюджеты холодного старта, сек; на медленной машине можно поднять
+    IMPORT_BUDGET = float(os.getenv('IMPORT_BUDGET', '3'))
+    STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', '5'))
+
+    def test_import_has_no_side_effects(self):
+        import subprocess
+        import sys
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         with tempfile.TemporaryDirectory() as tmpdir:
-            old_file = os.path.join(tmpdir, 'old.zip')
-            new_file = os.path.join(tmpdir, 'new.zip')
-            with open(old_file, 'w') as f:
-                f.write('old')
-            with open(new_file, 'w') as f:
-                f.write('new')
-            # Сделаем старый файл старше 2 часов
-            old_time = time.time() - 7200
-            os.utime(old_file, (old_time, old_time))
-            clean_old_archives(tmpdir, max_age_seconds=3600)
-            self.assertFalse(os.path.exists(old_file))
-            self.assertTrue(os.path.exists(new_file))
+            os.mkdir(os.path.join(tmpdir, 'USB'))
+            with open(os.path.join(tmpdir, 'USB', 'a.mp3'), 'w') as f:
+                f.write('x')
+            proc = subprocess.run(
+                [sys.executable, '-c', 'import core; print(hasattr(core, "files"))'],
+                cwd=tmpdir, capture_output=True, text=True, check=True,
+                env=dict(os.environ, PYTHONPATH=root),
+            )
+        self.assertEqual(proc.stdout, 'False\n')
+
+    def test_index_first_scan_in_background(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = FileIndex(tmpdir)
+            release = threading.Event()
+            rescan = index.rescan
+            with patch.object(index, 'rescan',
+                              side_effect=lambda: release.wait(5) and rescan()):
+                index.start(background=True)
+                try:
+                    self.assertFalse(index.ready.is_set())
+                    release.set()
+                    self.assertTrue(index.ready.wait(5))
+                finally:
+                    index.stop()
+
+    def test_snapshot_not_blocked_by_first_scan(self):
+        from benchmarks.suite import make_tree
+        built = threading.Event()
+
+        class SlowFile(File):
+            __slots__ = ()
+
+            def __init__(self, *args):
+                built.set()
+                # Записи большого диска строятся долго
+                time.sleep(0.005)
+                super().__init__(*args)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            make_tree(tmpdir, 400)
+            index = FileIndex(tmpdir)
+            with patch('core.File', SlowFile):
+                index.start(background=True)
+                try:
+                    self.assertTrue(built.wait(5))
+                    started = time.perf_counter()
+                    self.assertEqual(index.snapshot().count, 0)
+                    self.assertLess(time.perf_counter() - started, 0.2)
+                    self.assertFalse(index.ready.is_set())
+                    self.assertTrue(index.ready.wait(10))
+                    self.assertEqual(index.snapshot().count, 400)
+                finally:
+                    index.stop()
+
+    def test_startup_budget(self):
+        from benchmarks import startup
+        from benchmarks.suite import make_tree
+        self.assertLess(startup.import_time()['process_s'], self.IMPORT_BUDGET)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            make_tree(tmpdir, 2000)
+            self.assertLess(startup.first_get_updates(tmpdir), self.STARTUP_BUDGET)
+
+
+class TestWebhook(unittest.IsolatedAsyncioTestCase):
+    def test_webhook_options_from_env(self):
+        with patch.multiple(usb_bot, WEBHOOK_URL='https://bot.example.com/tg/hook',
+                            WEBHOOK_PATH=None, WEBHOOK_SECRET_TOKEN='s3cret'):
+            opts = usb_bot.webhook_options()
+        self.assertEqual(opts['url_path'], 'tg/hook')
+        self.assertEqual(opts['secret_token'], 's3cret')
+        self.assertEqual(opts['allowed_updates'], ['message', 'callback_query'])
+
+    def test_check_env_vars_archive_policy(self):
+        env = {'TELEGRAM_TOKEN': 'token', 'MOUNT_PATH': '/tmp', 'BOT_MODE': 'polling',
+               'ARCHIVE_POLICY': 'zstd'}
+        with patch.dict(os.environ, env):
+            with self.assertRaises(RuntimeError):
+                check_env_vars()
+            os.environ['ARCHIVE_POLICY'] = 'fast'
+            check_env_vars()
+
+    def test_check_env_vars_webhook(self):
+        env = {'TELEGRAM_TOKEN': 'token', 'MOUNT_PATH': '/tmp', 'BOT_MODE': 'webhook'}
+        with patch.dict(os.environ, env):
+            os.environ.pop('WEBHOOK_URL', None)
+            with self.assertRaises(RuntimeError):
+                check_env_vars()
+
+    async def test_updates_over_local_webhook(self):
+        from benchmarks.webhook import WebhookHarness
+        index = index_of(FilesData())
+        index.disk_free = None
+        with patch('usb_bot.get_file_index', return_value=index), \
+                patch('usb_bot.schedule_menu_deletion'), \
+                patch.dict(os.environ, {'FILTERED_USERS': ''}):
+            async with WebhookHarness(secret_token='s3cret') as harness:
+                method, _, params = harness.api.wait_for('setWebhook')
+                self.assertEqual(params['secret_token'], 's3cret')
+                self.assertEqual(json.loads(params['allowed_updates']),
+                                 ['message', 'callback_query'])
+                response = await harness.post({}, secret_token='wrong')
+                self.assertEqual(response.status_code, 403)
+                response = await harness.command('/usb')
+                self.assertEqual(response.status_code, 200)
+                await asyncio.to_thread(harness.api.wait_for, 'sendMessage')
+                latency = await harness.click(str(usb_bot.ONE))
+                self.assertLess(latency, 2.0)
+                await asyncio.to_thread(harness.api.wait_for, 'editMessageText')
+
+
+class TestConcurrentUpdates(unittest.IsolatedAsyncioTestCase):
+    async def test_chat_order_and_parallel_chats(self):
+        from scheduler import ChatUpdateProcessor
+        processor = ChatUpdateProcessor(max_concurrent_updates=16)
+        events = []
+
+        async def handle(chat_id, n):
+            events.append(('start', chat_id, n))
+            await asyncio.sleep(0.05)
+            events.append(('end', chat_id, n))
+
+        def update(chat_id):
+            return types.SimpleNamespace(effective_chat=types.SimpleNamespace(id=chat_id))
+        started = time.monotonic()
+        await asyncio.gather(*(
+            processor.process_update(update(chat_id), handle(chat_id, n))
+            for n in range(4) for chat_id in (1, 2, 3)))
+        # 12 обновлений по 50 мс: чаты параллельно, внутри чата по очереди
+        self.assertLess(time.monotonic() - started, 0.45)
+        for chat_id in (1, 2, 3):
+            chat_events = [(kind, n) for kind, c, n in events if c == chat_id]
+            self.assertEqual(chat_events, [(kind, n) for n in range(4)
+                                           for kind in ('start', 'end')])
+        self.assertEqual(processor._chats, {})
+
+    async def test_queued_chat_does_not_hold_slots(self):
+        from scheduler import ChatUpdateProcessor
+        processor = ChatUpdateProcessor(max_concurrent_updates=3)
+        self.assertEqual(processor.max_concurrent_updates, 3)
+        done = {}
+
+        async def handle(chat_id, n, delay):
+            await asyncio.sleep(delay)
+            done[chat_id, n] = time.monotonic()
+
+        def update(chat_id):
+            return types.SimpleNamespace(effective_chat=types.SimpleNamespace(id=chat_id))
+        started = time.monotonic()
+        # У первого чата в очереди больше обновлений, чем мест всего
+        slow = [asyncio.create_task(processor.process_update(update(1), handle(1, n, 0.25)))
+                for n in range(4)]
+        await asyncio.sleep(0.01)
+        await processor.process_update(update(2), handle(2, 0, 0.01))
+        self.assertLess(done[2, 0] - started, 0.2)
+        await asyncio.gather(*slow)
+        self.assertEqual(sorted(done), [(1, 0), (1, 1), (1, 2), (1, 3), (2, 0)])
+
+    async def test_simulated_users_over_webhook(self):
+        from benchmarks.webhook import WebhookHarness
+        index = index_of(FilesData())
+        index.disk_free = None
+        gate = asyncio.Event()
+        handled = []
+        real_one = usb_bot.one
+
+        async def slow_one(update, context):
+            user_id = update.effective_user.id
+            handled.append(user_id)
+            if user_id == 1:
+                # Долгий обработчик первого пользователя
+                await gate.wait()
+            return await real_one(update, context)
+
+        async def wait_until(condition):
+            for _ in range(200):
+                if condition():
+                    return
+                await asyncio.sleep(0.02)
+            self.fail('обновления не обработаны')
+
+        with patch('usb_bot.get_file_index', return_value=index), \
+                patch('usb_bot.schedule_menu_deletion'), \
+                patch('usb_bot.one', slow_one), \
+                patch.dict(os.environ, {'FILTERED_USERS': ''}):
+            async with WebhookHarness() as harness:
+                for user_id in range(1, 6):
+                    harness.user_id = user_id
+                    await harness.command('/usb')
+                harness.user_id = 1
+                await harness.post({'callback_query': {
+                    'id': 'slow', 'from': harness._user(), 'chat_instance': '1',
+                    'data': str(usb_bot.ONE),
+                    'message': {'message_id': 1, 'date': int(time.time()),
+                                'chat': {'id': 1, 'type': 'private'}}}})
+                await wait_until(lambda: handled == [1])
+                # Пока первый занят, остальные пользователи получают ответы
+                for user_id in range(2, 6):
+                    harness.user_id = user_id
+                    await harness.click(str(usb_bot.ONE))
+                self.assertEqual(handled, [1, 2, 3, 4, 5])
+                # Второе нажатие первого ждёт конца первого
+                harness.user_id = 1
+                await harness.post({'callback_query': {
+                    'id': 'queued', 'from': harness._user(), 'chat_instance': '1',
+                    'data': str(usb_bot.ONE),
+                    'message': {'message_id': 1, 'date': int(time.time()),
+                                'chat': {'id': 1, 'type': 'private'}}}})
+                await asyncio.sleep(0.1)
+                self.assertEqual(handled.count(1), 1)
+                gate.set()
+                await wait_until(lambda: handled.count(1) == 2)
+                await wait_until(lambda: 'queued' in [
+                    c[2]['callback_query_id'] for c in harness.api.calls
+                    if c[0] == 'answerCallbackQuery'])
+                answered = [c[2]['callback_query_id'] for c in harness.api.calls
+                            if c[0] == 'answerCallbackQuery']
+                self.assertLess(answered.index('slow'), answered.index('queued'))
+
+
+class TestLoopWatchdog(unittest.IsolatedAsyncioTestCase):
+    async def test_stall_is_counted_and_logged(self):
+        from loopwatch import LoopWatchdog
+        watchdog = LoopWatchdog(threshold=0.05, interval=0.01)
+        stalls = metrics.LOOP_STALLS.value()
+        lags = metrics.LOOP_LAG_SECONDS.count()
+
+        def blocking_call():
+            time.sleep(0.3)
+        watchdog.start()
+        try:
+            await asyncio.sleep(0.05)
+            with self.assertLogs('loopwatch', logging.WARNING) as logs:
+                blocking_call()
+                await asyncio.sleep(0.05)
+        finally:
+            await watchdog.stop()
+        self.assertEqual(watchdog.stalls, 1)
+        self.assertEqual(metrics.LOOP_STALLS.value(), stalls + 1)
+        self.assertGreater(metrics.LOOP_LAG_SECONDS.count(), lags + 2)
+        # В логе — стек блокирующего вызова, и только один раз за остановку
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('blocking_call', logs.output[0])
+
+
+class TestUploadEngine(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrency_per_chat_and_global(self):
+        engine = UploadEngine(concurrency=3, per_chat=2, chat_rate=0, global_rate=0)
+        running = Counter()
+        peaks = Counter()
+
+        async def upload(chat_id):
+            running[chat_id] += 1
+            running['all'] += 1
+            peaks[chat_id] = max(peaks[chat_id], running[chat_id])
+            peaks['all'] = max(peaks['all'], running['all'])
+            await asyncio.sleep(0.01)
+            running[chat_id] -= 1
+            running['all'] -= 1
+            return chat_id
+
+        results = await asyncio.gather(*(
+            engine.send(chat, functools.partial(upload, chat), size=10)
+            for chat in [1] * 6 + [2] * 6))
+        self.assertEqual(results, [1] * 6 + [2] * 6)
+        self.assertEqual(peaks[1], 2)
+        self.assertEqual(peaks['all'], 3)
+        stats = engine.stats()
+        self.assertEqual((stats['files'], stats['bytes']), (12, 120))
+        self.assertGreater(stats['bytes_per_second'], 0)
+
+    async def test_retry_after_pauses_chat(self):
+        import telegram
+        # Пауза соблюдается и без ограничения скорости чата
+        engine = UploadEngine(concurrency=1, chat_rate=0, global_rate=0,
+                              retry_delay=0)
+        calls = []
+
+        async def flooded():
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                await asyncio.sleep(0.02)
+                raise telegram.error.RetryAfter(0.2)
+            return 'ok'
+
+        async def other_chat():
+            await asyncio.sleep(0.05)
+            # Единственное общее место не занято ждущим чатом
+            await engine.send(2, AsyncMock(return_value='ok'))
+            return time.monotonic()
+        started = time.monotonic()
+        # Вторая отправка в тот же чат запущена одновременно с первой
+        results = await asyncio.gather(engine.send(1, flooded),
+                                       engine.send(1, flooded), other_chat())
+        self.assertEqual(results[:2], ['ok', 'ok'])
+        self.assertLess(results[2] - started, 0.2)
+        self.assertEqual(len(calls), 3)
+        self.assertGreaterEqual(calls[1] - started, 0.2)
+        self.assertGreaterEqual(calls[2] - started, 0.2)
+        self.assertEqual(engine.retries, 1)
+        retries = metrics.UPLOAD_RETRIES.value(reason='network')
+        flaky = AsyncMock(side_effect=[telegram.error.TimedOut(), 'ok'])
+        self.assertEqual(await engine.send(2, flaky), 'ok')
+        self.assertEqual(metrics.UPLOAD_RETRIES.value(reason='network'), retries + 1)
+        bad = AsyncMock(side_effect=telegram.error.BadRequest('нет'))
+        with self.assertRaises(telegram.error.BadRequest):
+            await engine.send(2, bad)
+        self.assertEqual(bad.await_count, 1)
+
+
+    async def test_files_read_inside_upload_slot(self):
+        from usb_bot import send_file
+        engine = UploadEngine(concurrency=1, chat_rate=0, global_rate=0)
+        in_memory = []
+        peak = []
+        real_read = usb_bot.read_upload
+
+        async def read_upload(path):
+            in_memory.append(path)
+            peak.append(len(in_memory))
+            return await real_read(path)
+
+        async def send_document(**kwargs):
+            await asyncio.sleep(0.01)
+            in_memory.pop()
+            return sent_message(None)
+        context = MagicMock()
+        context.bot.send_document = send_document
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for n in range(4):
+                paths.append(os.path.join(tmpdir, f'{n}.txt'))
+                with open(paths[-1], 'wb') as f:
+                    f.write(b'x' * 100)
+            with patch('usb_bot.UPLOAD_ENGINE', engine), \
+                    patch('usb_bot.read_upload', read_upload):
+                await asyncio.gather(*(
+                    send_file(context, n, MagicMock(id=1, first_name='Test'), path)
+                    for n, path in enumerate(paths)))
+        # Загрузки в очереди к UploadEngine ещё не держат файл в памяти
+        self.assertEqual(len(peak), 4)
+        self.assertEqual(max(peak), 1)
+
+
+class TestAlbums(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def make_items(self, names, size=1000):
+        items = []
+        for seq, name in enumerate(names):
+            path = os.path.join(self.tmpdir.name, name)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size if name != 'big.bin' else 6000))
+            items.append({'seq': seq, 'path': path, 'status': 'pending', 'parts': ()})
+        return items
+
+    def test_plan_groups_by_type_and_size(self):
+        names = [f'a{i}.mp3' for i in range(12)] + ['b0.txt', 'b1.txt', 'b2.txt', 'big.bin']
+        items = self.make_items(names)
+        with patch('usb_bot.MAX_FILE_SIZE', 5000):
+            batches = usb_bot.plan_job_items(items)
+            self.assertEqual([len(b) for b in batches], [10, 2, 3, 1])
+            self.assertTrue(all(p['path'].endswith('.mp3') for p in batches[1]))
+            # Начатый архив и альбом сверх ALBUM_MAX_BYTES идут по одному
+            items[0]['parts'] = (('a0.zip.part0', 'id0'),)
+            with patch('usb_bot.ALBUM_MAX_BYTES', 2500):
+                batches = usb_bot.plan_job_items(items)
+        self.assertEqual([len(b) for b in batches], [1, 2, 2, 2, 2, 2, 1, 2, 1, 1])
+
+    async def test_job_sent_as_albums(self):
+        from benchmarks.startup import FakeBotApi
+        api = FakeBotApi()
+        threading.Thread(target=api.serve_forever, daemon=True).start()
+        self.addCleanup(api.server_close)
+        self.addCleanup(api.shutdown)
+        names = [f'a{i}.mp3' for i in range(12)] + ['b0.txt', 'b1.txt', 'b2.txt']
+        paths = [item['path'] for item in self.make_items(names)]
+        finish = AsyncMock()
+        worker = DownloadWorker(
+            DownloadJobs(':memory:'), usb_bot.send_job_item, finish,
+            send_group=usb_bot.send_job_album, plan=usb_bot.plan_job_items, parallel=3)
+        with patch.multiple(usb_bot, FILE_ID_CACHE=FileIdCache(':memory:')), \
+                patch('usb_bot.log_download'):
+            app = usb_bot.build_application(token='123:albums', base_url=api.url)
+            async with app:
+                worker.start(app.bot)
+                await worker.wait(worker.submit(1, 2, 'Тест', 'все', paths))
+                after = len(api.calls)
+                await worker.wait(worker.submit(1, 2, 'Тест', 'все', paths))
+        albums = [c[2] for c in api.calls if c[0] == 'sendMediaGroup']
+        self.assertEqual(len(albums), 6)
+        self.assertFalse([c for c in api.calls if c[0] in ('sendAudio', 'sendDocument')])
+        first = sorted(len(json.loads(a['media'])) for a in albums[:3])
+        self.assertEqual(first, [2, 3, 10])
+        self.assertEqual([i['status'] for i in finish.await_args.args[2]], ['done'] * 15)
+        # Повторная отправка — по file_id, без загрузки файлов
+        for call in api.calls[after:]:
+            if call[0] == 'sendMediaGroup':
+                media = json.loads(call[2]['media'])
+                self.assertTrue(all(m['media'].startswith('file') for m in media))
+
+
+class TestLocalBotApi(unittest.IsolatedAsyncioTestCase):
+    async def send_via_local_api(self, mount_path, server_mount):
+        from benchmarks.startup import FakeBotApi
+        api = FakeBotApi()
+        threading.Thread(target=api.serve_forever, daemon=True).start()
+        try:
+            with patch.multiple(usb_bot, TELEGRAM_API_LOCAL=True,
+                                TELEGRAM_API_MOUNT_PATH=server_mount,
+                                MOUNT_PATH=mount_path,
+                                FILE_ID_CACHE=FileIdCache(':memory:')), \
+                    patch('usb_bot.log_download'):
+                app = usb_bot.build_application(token='123:local', base_url=api.url)
+                async with app:
+                    context = MagicMock(bot=app.bot)
+                    path = os.path.join(mount_path, 'sub', 'a.mp3')
+                    await usb_bot.send_file(context, 1, MagicMock(), path)
+                    await usb_bot.send_file(context, 1, MagicMock(), path)
+            return [c for c in api.calls if c[0] == 'sendAudio']
+        finally:
+            api.shutdown()
+            api.server_close()
+
+    def make_file(self, tmpdir):
+        os.mkdir(os.path.join(tmpdir, 'sub'))
+        with open(os.path.join(tmpdir, 'sub', 'a.mp3'), 'wb') as f:
+            f.write(b'x' * 1000)
+
+    async def test_send_by_path_when_mount_is_shared(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.make_file(tmpdir)
+            calls = await self.send_via_local_api(tmpdir, '/srv/usb')
+        self.assertEqual(calls[0][2]['audio'], 'file:///srv/usb/sub/a.mp3')
+        # Повторная отправка идёт по file_id из ответа сервера
+        self.assertRegex(calls[1][2]['audio'], r'^file\d+$')
+
+    async def test_upload_when_mount_is_not_shared(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.make_file(tmpdir)
+            calls = await self.send_via_local_api(tmpdir, None)
+        # Файл ушёл multipart-загрузкой, а не путём
+        self.assertNotIn('audio', calls[0][2])
+        self.assertEqual(len(calls), 2)
+
+    def test_file_uri_outside_mount(self):
+        with patch.multiple(usb_bot, TELEGRAM_API_LOCAL=True,
+                            TELEGRAM_API_MOUNT_PATH='/srv/usb', MOUNT_PATH='/mnt/usb'):
+            self.assertIsNone(usb_bot.bot_api_file_uri('/etc/passwd'))
+            self.assertEqual(usb_bot.bot_api_file_uri('/mnt/usb/a.mp3'),
+                             'file:///srv/usb/a.mp3')
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    def test_render_format(self):
+        registry = []
+        uploads = metrics.Counter('t_uploads_total', 'Отправки', ['path'], registry=registry)
+        latency = metrics.Histogram('t_seconds', 'Задержка', buckets=(0.1, 1), registry=registry)
+        uploads.inc(path='direct')
+        uploads.inc(2, path='split')
+        latency.observe(0.05)
+        latency.observe(0.1)
+        latency.observe(3)
+        text = metrics.render(registry)
+        self.assertIn('# TYPE t_uploads_total counter', text)
+        self.assertIn('t_uploads_total{path="split"} 2', text)
+        self.assertIn('t_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('t_seconds_bucket{le="1"} 2', text)
+        self.assertIn('t_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('t_seconds_count 3', text)
+        with self.assertRaises(ValueError):
+            uploads.inc()
+
+    async def test_error_handler_records_latency(self):
+        @usb_bot.error_handler
+        async def boom(update, context):
+            raise RuntimeError('boom')
+
+        before = metrics.HANDLER_SECONDS.count(handler='boom')
+        errors = metrics.HANDLER_ERRORS.value(handler='boom')
+        update = MagicMock()
+        update.callback_query = AsyncMock()
+        await boom(update, MagicMock())
+        self.assertEqual(metrics.HANDLER_SECONDS.count(handler='boom'), before + 1)
+        self.assertEqual(metrics.HANDLER_ERRORS.value(handler='boom'), errors + 1)
+
+    async def test_upload_paths(self):
+        from usb_bot import send_archive
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'b.bin')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(300 * 1024))
+            context = MagicMock()
+            context.bot.send_document = AsyncMock(return_value=sent_message('id-b'))
+            split = metrics.UPLOAD_FILES.value(path='split')
+            sent_bytes = metrics.UPLOAD_BYTES.value(path='split')
+            with patch('usb_bot.MAX_FILE_SIZE', 100 * 1024):
+                await send_archive(context, 1, MagicMock(), path)
+        parts = context.bot.send_document.await_count
+        self.assertGreater(parts, 1)
+        self.assertEqual(metrics.UPLOAD_FILES.value(path='split'), split + parts)
+        self.assertGreater(metrics.UPLOAD_BYTES.value(path='split'), sent_bytes + 300 * 1024)
+
+    def test_metrics_endpoint(self):
+        import urllib.request
+        server = usb_bot.start_metrics(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+        with urllib.request.urlopen(url, timeout=5) as response:
+            text = response.read().decode()
+        self.assertIn('usb_bot_tmp_free_bytes ', text)
+        self.assertIn('usb_bot_archive_jobs_pending 0', text)
+        self.assertIn('# TYPE usb_bot_handler_seconds histogram', text)
+
+
+class TestMenuScheduler(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = MenuDeletions(':memory:')
+        self.scheduler = MenuScheduler(self.store)
+        self.delete = AsyncMock()
+
+    async def asyncTearDown(self):
+        await self.scheduler.stop()
+
+    async def test_reschedule_replaces_deadline(self):
+        self.scheduler.start(self.delete)
+        for _ in range(100):
+            self.scheduler.schedule(1, 10, 0.05)
+        self.scheduler.schedule(1, 10, 0.3)
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(len(self.store.all()), 1)
+        await asyncio.sleep(0.15)
+        self.delete.assert_not_awaited()
+        await asyncio.sleep(0.3)
+        self.delete.assert_awaited_once_with(chat_id=1, message_id=10)
+        self.assertEqual(self.store.all(), [])
+
+    async def test_cancel(self):
+        self.scheduler.start(self.delete)
+        self.scheduler.schedule(1, 10, 0.05)
+        self.scheduler.schedule(1, 11, 0.05)
+        self.scheduler.cancel(1, 10)
+        await asyncio.sleep(0.2)
+        self.delete.assert_awaited_once_with(chat_id=1, message_id=11)
+
+    async def test_deadlines_survive_restart(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = os.path.join(tmpdir, 'state.sqlite3')
+            MenuScheduler(MenuDeletions(db)).schedule(5, 50, 0.05)
+            # Новый процесс: сроки читаются из базы
+            self.scheduler = MenuScheduler(MenuDeletions(db))
+            self.scheduler.start(self.delete)
+            await asyncio.sleep(0.2)
+        self.delete.assert_awaited_once_with(chat_id=5, message_id=50)
+
+    async def test_failed_delete_does_not_stop_scheduler(self):
+        self.delete.side_effect = [RuntimeError('уже удалено'), None]
+        self.scheduler.start(self.delete)
+        self.scheduler.schedule(1, 1, 0.01)
+        self.scheduler.schedule(1, 2, 0.05)
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.delete.await_count, 2)
+
+
+class TestDownloadJobs(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.db = os.path.join(self.tmpdir.name, 'state.sqlite3')
+        self.finish = AsyncMock()
+
+    async def test_resume_after_restart_from_last_acked_part(self):
+        blocked = asyncio.Event()
+
+        async def crashing_send(bot, job, item, ack):
+            ack('a.zip.part0', 'id0')
+            ack('a.zip.part1', 'id1')
+            blocked.set()
+            await asyncio.Event().wait()
+
+        worker = DownloadWorker(DownloadJobs(self.db), crashing_send, self.finish)
+        worker.start(MagicMock())
+        job_id = worker.submit(1, 2, 'Тест', 'все', ['/usb/a.wav', '/usb/b.mp3'], 10)
+        await blocked.wait()
+        await worker.stop()
+        # Новый процесс: задание подхватывается с третьей части первого файла
+        seen = []
+
+        async def send(bot, job, item, ack):
+            seen.append((item['path'], [p[1] for p in item['parts']]))
+
+        worker = DownloadWorker(DownloadJobs(self.db), send, self.finish)
+        worker.start(MagicMock())
+        await worker.wait(job_id)
+        self.assertEqual(seen, [('/usb/a.wav', ['id0', 'id1']), ('/usb/b.mp3', [])])
+        job, items = self.finish.await_args.args[1:]
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual([i['status'] for i in items], ['done', 'done'])
+
+    async def test_resume_restarts_changed_file(self):
+        blocked = asyncio.Event()
+        versions = {'/usb/a.wav': [100, 1, 'auto', 50]}
+        checked = []
+
+        def version(path):
+            checked.append(path)
+            return versions[path]
+
+        async def crashing_send(bot, job, item, ack):
+            # Версия приходит со сборкой первой части, а не из submit
+            ack('a.zip.part0', 'id0', [100, 1, 'auto', 50])
+            ack('a.zip.part1', 'id1', [100, 1, 'auto', 50])
+            blocked.set()
+            await asyncio.Event().wait()
+
+        store = DownloadJobs(self.db)
+        worker = DownloadWorker(store, crashing_send, self.finish, version=version)
+        worker.start(MagicMock())
+        job_id = worker.submit(1, 2, 'Тест', 'все', ['/usb/a.wav'])
+        self.assertIsNone(store.items(job_id)[0]['version'])
+        await blocked.wait()
+        await worker.stop()
+        self.assertEqual(checked, [])
+        self.assertEqual(store.items(job_id)[0]['version'], [100, 1, 'auto', 50])
+        # Пока бот стоял, запись изменилась: старые части к новым не подходят
+        versions['/usb/a.wav'] = [200, 2, 'auto', 50]
+        seen = []
+
+        async def send(bot, job, item, ack):
+            seen.append(list(item['parts']))
+            ack('a.zip.part0', 'new0', [200, 2, 'auto', 50])
+
+        worker = DownloadWorker(DownloadJobs(self.db), send, self.finish, version=version)
+        worker.start(MagicMock())
+        await worker.wait(job_id)
+        self.assertEqual(checked, ['/usb/a.wav'])
+        self.assertEqual(seen, [[]])
+        item = store.items(job_id)[0]
+        self.assertEqual(item['parts'], [('a.zip.part0', 'new0')])
+        self.assertEqual(item['version'], [200, 2, 'auto', 50])
+
+    def test_old_database_gets_version_column(self):
+        import sqlite3
+        conn = sqlite3.connect(self.db)
+        conn.execute('CREATE TABLE download_items (job_id INTEGER NOT NULL,'
+                     ' seq INTEGER NOT NULL, path TEXT NOT NULL, status TEXT NOT NULL,'
+                     ' parts TEXT NOT NULL, error TEXT, PRIMARY KEY (job_id, seq))')
+        conn.commit()
+        conn.close()
+        store = DownloadJobs(self.db)
+        job_id = store.create(1, 2, 'Тест', 'все', ['/usb/a.wav'])
+        store.ack_part(job_id, 0, 'a.zip.part0', 'id0', [1, 2])
+        # Версия запоминается только с первой частью
+        store.ack_part(job_id, 0, 'a.zip.part1', 'id1', [3, 4])
+        self.assertEqual(store.items(job_id)[0]['version'], [1, 2])
+
+    async def test_failed_item_does_not_stop_batch(self):
+        async def send(bot, job, item, ack):
+            if item['seq'] == 0:
+                raise RuntimeError('нет связи')
+
+        worker = DownloadWorker(DownloadJobs(self.db), send, self.finish)
+        worker.start(MagicMock())
+        job_id = worker.submit(1, 2, 'Тест', 'все', ['/usb/a.mp3', '/usb/b.mp3'])
+        await worker.wait(job_id)
+        items = self.finish.await_args.args[2]
+        self.assertEqual([i['status'] for i in items], ['failed', 'done'])
+        self.assertEqual(items[0]['error'], 'нет связи')
+
+    async def test_cancel(self):
+        started = asyncio.Event()
+
+        async def send(bot, job, item, ack):
+            started.set()
+            await asyncio.Event().wait()
+
+        store = DownloadJobs(self.db)
+        worker = DownloadWorker(store, send, self.finish)
+        worker.start(MagicMock())
+        job_id = worker.submit(1, 2, 'Тест', 'все', ['/usb/a.mp3'])
+        await started.wait()
+        self.assertEqual(worker.cancel(1), 1)
+        await worker.wait(job_id)
+        self.assertEqual(store.get(job_id)['status'], 'cancelled')
+        self.assertEqual(store.unfinished(), [])
+
+    async def test_archive_part_retry_and_resume(self):
+        from usb_bot import send_archive
+        import telegram
+        path = os.path.join(self.tmpdir.name, 'c.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(300 * 1024))
+        messages = [sent_message(f'id{i}') for i in range(10)]
+        context = MagicMock()
+        # Первая попытка второй части падает по таймауту и повторяется одна
+        context.bot.send_document = AsyncMock(
+            side_effect=[messages[0], telegram.error.TimedOut(), *messages[1:]])
+        acked = []
+        versions = []
+
+        def on_part(name, file_id, version):
+            acked.append((name, file_id))
+            versions.append(version)
+
+        with patch('usb_bot.MAX_FILE_SIZE', 100 * 1024), \
+                patch('usb_bot.PART_RETRY_DELAY', 0), \
+                patch('usb_bot.FILE_ID_CACHE', FileIdCache(':memory:')):
+            await send_archive(context, 1, MagicMock(), path, on_part=on_part)
+            parts = len(acked)
+            # Версия частей — ключ их сборки: размер, mtime, политика, размер части
+            st = os.stat(path)
+            self.assertEqual(set(map(tuple, versions)),
+                             {(st.st_size, st.st_mtime_ns, usb_bot.ARCHIVE_POLICY.name, 100 * 1024)})
+            self.assertGreater(parts, 2)
+            self.assertEqual(context.bot.send_document.await_count, parts + 1)
+            # Продолжение после сбоя: первые две части не отправляются снова
+            context.bot.send_document = AsyncMock(side_effect=messages)
+            with patch('usb_bot.FILE_ID_CACHE', FileIdCache(':memory:')):
+                await send_archive(context, 1, MagicMock(), path, done_parts=acked[:2])
+        self.assertEqual(context.bot.send_document.await_count, parts - 2)
+        names = [c.kwargs['filename'] for c in context.bot.send_document.await_args_list]
+        self.assertEqual(names, [name for name, _ in acked[2:]])
+
+
+class TestArchiveBuilds(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'big.bin')
+        with open(self.path, 'wb') as f:
+            f.write(os.urandom(400 * 1024))
+
+    async def collect(self, builds, owner=None, delay=0.0):
+        names = []
+        stream = builds.parts(self.path, 100 * 1024, DEFAULT_POLICY, owner=owner)
+        async with contextlib.aclosing(stream):
+            async for part in stream:
+                names.append(os.path.basename(part))
+                await asyncio.sleep(delay)
+        return names
+
+    async def test_concurrent_requests_share_one_build(self):
+        builds = ArchiveBuilds(ttl=60)
+        with patch('workers.stream_archive_parts', wraps=stream_archive_parts) as archive:
+            first, second = await asyncio.gather(
+                self.collect(builds, owner=1, delay=0.01),
+                self.collect(builds, owner=2, delay=0.01))
+            self.assertEqual(archive.call_count, 1)
+            self.assertEqual(first, second)
+            self.assertGreater(len(first), 1)
+            # Готовые части ещё живы: следующий запрос не собирает архив заново
+            reused = metrics.ARCHIVE_BUILDS.value(result='reused')
+            self.assertEqual(await self.collect(builds), first)
+            self.assertEqual(archive.call_count, 1)
+            self.assertEqual(metrics.ARCHIVE_BUILDS.value(result='reused'), reused + 1)
+        workdir = next(iter(builds._builds.values())).workdir
+        with patch('archives.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(await builds.sweep(), 1)
+        self.assertFalse(os.path.exists(workdir))
+
+    async def test_cancel_one_reader(self):
+        builds = ArchiveBuilds(ttl=60)
+        first = asyncio.create_task(self.collect(builds, owner=1, delay=0.05))
+        second = asyncio.create_task(self.collect(builds, owner=2, delay=0.01))
+        await asyncio.sleep(0.02)
+        self.assertEqual(builds.cancel(1), 1)
+        with self.assertRaises(JobCancelled):
+            await first
+        self.assertGreater(len(await second), 1)
+
+    async def test_idle_build_evicted_for_budget(self):
+        other = os.path.join(self.tmpdir.name, 'other.bin')
+        with open(other, 'wb') as f:
+            f.write(os.urandom(400 * 1024))
+        workspace = Workspace(os.path.join(self.tmpdir.name, 'ws'),
+                              budget=1536 * 1024, wait=0.05)
+        builds = ArchiveBuilds(ttl=60, workspace=workspace)
+        first = await self.collect(builds)
+        stream = builds.parts(other, 100 * 1024, DEFAULT_POLICY)
+        async with contextlib.aclosing(stream):
+            part = await stream.__anext__()
+            # Готовая сборка без читателей уступила место
+            self.assertEqual(len(workspace), 1)
+            self.assertTrue(part.startswith(workspace.root))
+            # Читаемую сборку вытеснить нельзя: новая архивация получает отказ
+            with self.assertRaises(WorkspaceFull):
+                await self.collect(builds)
+        # Брошенная сборка освобождает место, очередь дождётся его
+        workspace.wait = 5
+        self.assertEqual(await self.collect(builds), first)
+
+    async def test_abandoned_build_is_dropped(self):
+        builds = ArchiveBuilds(ttl=60)
+        stream = builds.parts(self.path, 100 * 1024, DEFAULT_POLICY)
+        part = await stream.__anext__()
+        workdir = os.path.dirname(part)
+        await stream.aclose()
+        self.assertEqual(len(builds), 0)
+        for _ in range(50):
+            if not os.path.exists(workdir):
+                break
+            await asyncio.sleep(0.05)
+        self.assertFalse(os.path.exists(workdir))
+
+
+class TestWorkspace(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    async def lease(self, workspace, size, evicted=None):
+        lease = await workspace.reserve(size, on_evict=lambda: evicted.append(size))
+        with open(os.path.join(lease.path, 'part'), 'wb') as f:
+            f.write(b'x' * size)
+        await workspace.commit(lease)
+        return lease
+
+    async def test_lru_eviction_skips_pinned(self):
+        workspace = Workspace(self.tmpdir.name, budget=3000, wait=0)
+        evicted = []
+        first = await self.lease(workspace, 1000, evicted)
+        second = await self.lease(workspace, 1001, evicted)
+        workspace.pin(first)
+        # Нужна тысяча байт: первый каталог закреплён, удаляется второй
+        third = await self.lease(workspace, 1002, evicted)
+        self.assertEqual(evicted, [1001])
+        self.assertFalse(os.path.exists(second.path))
+        self.assertTrue(os.path.exists(first.path))
+        workspace.unpin(first)
+        # Теперь дольше всех не использовался третий
+        workspace.pin(first)
+        workspace.unpin(first)
+        await self.lease(workspace, 1003, evicted)
+        self.assertEqual(evicted, [1001, 1002])
+        self.assertFalse(os.path.exists(third.path))
+        self.assertLessEqual(workspace.used, 3000)
+
+    async def test_refuses_or_waits_when_full(self):
+        workspace = Workspace(self.tmpdir.name, budget=1000, wait=0.05)
+        with self.assertRaises(WorkspaceFull):
+            await workspace.reserve(1001)
+        busy = await workspace.reserve(800)
+        with self.assertRaises(WorkspaceFull):
+            await workspace.reserve(500)
+        # Место освобождается, пока запрос стоит в очереди
+        workspace.wait = 5
+        waiter = asyncio.create_task(workspace.reserve(500))
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+        await workspace.remove(busy)
+        lease = await asyncio.wait_for(waiter, 1)
+        self.assertEqual(workspace.used, lease.size)
+        self.assertIsInstance(WorkspaceFull(), workers.QueueFull)
+
+    async def test_written_part_of_reservation_counted_once(self):
+        workspace = Workspace(self.tmpdir.name, wait=0)
+        with patch('workspace.shutil.disk_usage', return_value=MagicMock(free=10000)) as usage:
+            lease = await workspace.reserve(6000)
+            with self.assertRaises(WorkspaceFull):
+                await workspace.reserve(5000)
+            # Записано 4000 байт: на диске их уже нет в free, из резерва
+            # вычитается только незаписанный остаток
+            with open(os.path.join(lease.path, 'part'), 'wb') as f:
+                f.write(b'x' * 4000)
+            usage.return_value = MagicMock(free=6000)
+            with self.assertRaises(WorkspaceFull):
+                await workspace.reserve(4001)
+            await workspace.reserve(4000)
+
+    def test_start_removes_leftovers_only(self):
+        leftover = os.path.join(self.tmpdir.name, 'lease-old')
+        os.mkdir(leftover)
+        other = os.path.join(self.tmpdir.name, 'keep.zip')
+        open(other, 'w').close()
+        Workspace(self.tmpdir.name).start()
+        self.assertFalse(os.path.exists(leftover))
+        self.assertTrue(os.path.exists(other))
 
 
 class TestSafePathEdgeCases(unittest.TestCase):
@@ -240,7 +1627,8 @@ class TestErrorHandlerUX(unittest.IsolatedAsyncioTestCase):
         update.callback_query = AsyncMock()
         update.callback_query.data = 'file_to_download:/not/exist.mp3'
         # is_safe_path и is_file_accessible всегда False
-        with patch('usb_bot.is_safe_path', return_value=False), \
+        with patch('usb_bot.get_file_index', return_value=index_of(FilesData())), \
+             patch('usb_bot.is_safe_path', return_value=False), \
              patch('usb_bot.is_file_accessible', return_value=False):
             await seven(update, context)
         update.callback_query.answer.assert_any_await(
@@ -248,6 +1636,43 @@ class TestErrorHandlerUX(unittest.IsolatedAsyncioTestCase):
         )
 
 
+class TestFileCallbackIds(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.files = FilesData()
+        for sub in ('a', 'b'):
+            os.mkdir(os.path.join(self.test_dir.name, sub))
+            path = os.path.join(self.test_dir.name, sub, '20240428-170000.mp3')
+            with open(path, 'w') as f:
+                f.write(sub * 10)
+            self.files.add_file(File(path))
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def test_duplicate_names_get_distinct_short_ids(self):
+        uids = {f.uid for f in self.files.file_list}
+        self.assertEqual(len(uids), 2)
+        for f in self.files.file_list:
+            self.assertIs(self.files.by_uid(f.uid), f)
+            self.assertLessEqual(len(f"file_to_download:{f.uid}:{f.tag}".encode()), 64)
+
+    async def test_stale_button(self):
+        from usb_bot import seven
+        f = self.files.file_list[0]
+        update = MagicMock()
+        update.effective_user = MagicMock(id=1)
+        update.callback_query = AsyncMock()
+        update.callback_query.data = f'file_to_download:{f.uid}:00000000'
+        context = MagicMock(user_data={'six_files_page': 0})
+        with patch('usb_bot.get_file_index', return_value=index_of(self.files)):
+            await seven(update, context)
+        update.callback_query.answer.assert_any_await(
+            'Файл изменился, список обновлён.', show_alert=False
+        )
+        context.bot.send_message.assert_not_called()
+
+
 class TestChurchEmojiForSundayEvening(unittest.IsolatedAsyncioTestCase):
     async def test_church_emoji_for_sunday_evening(self):
         from usb_bot import six
@@ -273,10 +1698,11 @@ class TestChurchEmojiForSundayEvening(unittest.IsolatedAsyncioTestCase):
         file_obj.h_size = "10 МБ"
         file_obj.file = file_name
         file_obj.ctime = datetime.datetime.combine(last_sunday, datetime.time(17, 0)).timestamp()
+        file_obj.date, file_obj.stamp = parse_name_stamp(file_name)
         from core import FilesData
         files_data = FilesData()
-        files_data.file_list = [file_obj]
-        with patch('usb_bot.FilesData', return_value=files_data):
+        files_data.add_file(file_obj)
+        with patch('usb_bot.get_file_index', return_value=index_of(files_data)):
             await six(update, context)
             args, kwargs = update.callback_query.edit_message_text.call_args
             # reply_markup - объект InlineKeyboardMarkup, ищем 💒 в тексте кнопок
@@ -314,10 +1740,11 @@ class TestChurchAndArchiveEmoji(unittest.IsolatedAsyncioTestCase):
         file_obj.h_size = "50 МБ"
         file_obj.file = file_name
         file_obj.ctime = datetime.datetime.combine(last_sunday, datetime.time(17, 0)).timestamp()
+        file_obj.date, file_obj.stamp = parse_name_stamp(file_name)
         from core import FilesData
         files_data = FilesData()
-        files_data.file_list = [file_obj]
-        with patch('usb_bot.FilesData', return_value=files_data):
+        files_data.add_file(file_obj)
+        with patch('usb_bot.get_file_index', return_value=index_of(files_data)):
             await six(update, context)
             args, kwargs = update.callback_query.edit_message_text.call_args
             markup = kwargs.get('reply_markup')
@@ -329,6 +1756,49 @@ class TestChurchAndArchiveEmoji(unittest.IsolatedAsyncioTestCase):
             self.assertTrue(found, 'Смайлики 💒 и 📦 не найдены вместе в кнопке для большого воскресного файла!')
 
 
+class TestSwitchOrder(unittest.IsolatedAsyncioTestCase):
+    async def test_switch_order_cycles(self):
+        from usb_bot import switch_order
+        files_data = FilesData()
+        for name, size_ in [('a.mp3', 1), ('b.mp3', 2)]:
+            f = MagicMock(file=f'/usb/{name}', size=size_, ctime=float(size_), h_size=f'{size_}B')
+            f.name = name
+            files_data.add_file(f)
+        context = MagicMock(user_data={'page': 3})
+        update = MagicMock()
+        update.effective_user = MagicMock(id=1)
+        update.callback_query = AsyncMock()
+        with patch('usb_bot.get_file_index', return_value=index_of(files_data)):
+            await switch_order(update, context)
+        self.assertEqual(context.user_data['order'], 'name')
+        self.assertEqual(context.user_data['page'], 0)
+        kwargs = update.callback_query.edit_message_text.call_args.kwargs
+        self.assertLess(kwargs['text'].index('a.mp3'), kwargs['text'].index('b.mp3'))
+        texts = [btn.text for row in kwargs['reply_markup'].inline_keyboard for btn in row]
+        self.assertIn('Сортировка: 🔤 по имени', texts)
+
+
+class TestRenderCache(unittest.TestCase):
+    def test_render_cached_until_snapshot_changes(self):
+        from usb_bot import render_cached, RENDER_CACHE
+        calls = []
+
+        def render(files, page, order):
+            calls.append(page)
+            return object()
+
+        files = FilesData()
+        first = render_cached(render, files, 0, 'ctime')
+        self.assertIs(render_cached(render, files, 0, 'ctime'), first)
+        render_cached(render, files, 1, 'ctime')
+        self.assertEqual(calls, [0, 1])
+        newer = files.copy()
+        newer.version += 1
+        self.assertIsNot(render_cached(render, newer, 0, 'ctime'), first)
+        self.assertEqual(calls, [0, 1, 0])
+        self.assertEqual(len(RENDER_CACHE), 1)
+
+
 class TestDownloadSpecificFile(unittest.IsolatedAsyncioTestCase):
     async def test_download_specific_file(self):
         from usb_bot import seven
@@ -347,19 +1817,21 @@ class TestDownloadSpecificFile(unittest.IsolatedAsyncioTestCase):
         file_obj.file = file_path
         file_obj.size = os.path.getsize(file_path)
         file_obj.h_size = '11B'
+        file_obj.uid = 'uid1'
+        file_obj.tag = 'tag1'
         files_data = MagicMock()
-        files_data.file_list = [file_obj]
+        files_data.by_uid.side_effect = {'uid1': file_obj}.get
         update = MagicMock()
         update.effective_user = MagicMock(id=1)
         update.callback_query = AsyncMock()
-        update.callback_query.data = f'file_to_download:{file_name}'
+        update.callback_query.data = 'file_to_download:uid1:tag1'
         update.callback_query.answer = AsyncMock()
         context = MagicMock()
-        context.bot.send_document = AsyncMock()
+        context.bot.send_document = AsyncMock(return_value=sent_message('doc-id'))
         context.bot.send_audio = AsyncMock()
         context.bot.send_message = AsyncMock()
         context.bot.delete_message = AsyncMock()
-        with patch('usb_bot.FilesData', return_value=files_data), \
+        with patch('usb_bot.get_file_index', return_value=index_of(files_data)), \
              patch('usb_bot.is_safe_path', return_value=True), \
              patch('usb_bot.is_file_accessible', return_value=True):
             await seven(update, context)
@@ -389,19 +1861,21 @@ class TestDownloadSpecificFile(unittest.IsolatedAsyncioTestCase):
         file_obj.file = file_path
         file_obj.size = os.path.getsize(file_path)
         file_obj.h_size = '11B'
+        file_obj.uid = 'uid1'
+        file_obj.tag = 'tag1'
         files_data = MagicMock()
-        files_data.file_list = [file_obj]
+        files_data.by_uid.side_effect = {'uid1': file_obj}.get
         update = MagicMock()
         update.effective_user = MagicMock(id=1)
         update.callback_query = AsyncMock()
-        update.callback_query.data = f'file_to_download:{file_name}'
+        update.callback_query.data = 'file_to_download:uid1:tag1'
         update.callback_query.answer = AsyncMock()
         context = MagicMock()
-        context.bot.send_document = AsyncMock()
+        context.bot.send_document = AsyncMock(return_value=sent_message('doc-id'))
         context.bot.send_audio = AsyncMock()
         context.bot.send_message = AsyncMock()
         context.bot.delete_message = AsyncMock()
-        with patch('usb_bot.FilesData', return_value=files_data), \
+        with patch('usb_bot.get_file_index', return_value=index_of(files_data)), \
              patch('usb_bot.is_safe_path', return_value=True), \
              patch('usb_bot.is_file_accessible', return_value=True):
             await seven(update, context)
@@ -432,38 +1906,76 @@ class TestDownloadSpecificFile(unittest.IsolatedAsyncioTestCase):
         file_obj.file = file_path
         file_obj.size = os.path.getsize(file_path)
         file_obj.h_size = '49MB'
+        file_obj.uid = 'uid1'
+        file_obj.tag = 'tag1'
         files_data = MagicMock()
-        files_data.file_list = [file_obj]
+        files_data.by_uid.side_effect = {'uid1': file_obj}.get
         update = MagicMock()
-        update.effective_user = MagicMock(id=1)
+        update.effective_user = MagicMock(id=1, first_name='Test')
+        update.effective_chat.id = 1
         update.callback_query = AsyncMock()
-        update.callback_query.data = f'file_to_download:{file_name}'
+        update.callback_query.data = 'file_to_download:uid1:tag1'
         update.callback_query.answer = AsyncMock()
         context = MagicMock()
-        context.bot.send_document = AsyncMock()
+        context.bot.send_document = AsyncMock(return_value=sent_message('doc-id'))
         context.bot.send_audio = AsyncMock()
-        context.bot.send_message = AsyncMock()
+        context.bot.send_message = AsyncMock(return_value=MagicMock(message_id=5))
         context.bot.delete_message = AsyncMock()
-        # Мокаем архивирование и split_file
-        fake_archive = file_path + '.zip'
-        fake_part = fake_archive + '.part0'
-        with open(fake_archive, 'wb') as fa:
-            fa.write(b'1' * (MAX_FILE_SIZE + 1))
-        with open(fake_part, 'wb') as fp:
-            fp.write(b'2' * (MAX_FILE_SIZE // 2))
-        with patch('usb_bot.FilesData', return_value=files_data), \
+        worker = DownloadWorker(DownloadJobs(':memory:'), usb_bot.send_job_item,
+                                usb_bot.finish_download_job)
+        worker.start(context.bot)
+        with patch('usb_bot.get_file_index', return_value=index_of(files_data)), \
              patch('usb_bot.is_safe_path', return_value=True), \
              patch('usb_bot.is_file_accessible', return_value=True), \
-             patch('usb_bot.archive_files', side_effect=lambda files, archive_path: os.rename(fake_archive, archive_path)), \
-             patch('usb_bot.split_file', return_value=[fake_part]):
+             patch('usb_bot.DOWNLOAD_WORKER', worker):
             await seven(update, context)
+            # Архив отправляется в фоне заданием DownloadWorker
+            await worker.wait(1)
         context.bot.send_document.assert_awaited()
+        context.bot.delete_message.assert_any_await(
+            chat_id=update.effective_chat.id, message_id=5)
         # Новый способ проверки: ищем нужную инструкцию в любом из вызовов send_message
         calls = context.bot.send_message.await_args_list
         assert any('Инструкция по склейке' in str(call.kwargs.get('text', '')) for call in calls)
         os.remove(file_path)
-        if os.path.exists(fake_part):
-            os.remove(fake_part)
+
+    async def test_download_specific_file_server_busy(self):
+        """
+        Проверяет, что при переполненной очереди архивации в итоге загрузки сказано «Сервер занят».
+        """
+        from usb_bot import seven, MAX_FILE_SIZE, SERVER_BUSY_TEXT
+        from unittest.mock import MagicMock, AsyncMock, patch
+        from workspace import WorkspaceFull
+        with tempfile.NamedTemporaryFile(delete=False) as tf:
+            tf.write(b'0' * (MAX_FILE_SIZE + 1024))
+            file_path = tf.name
+        self.addCleanup(os.remove, file_path)
+        file_obj = MagicMock(file=file_path, size=os.path.getsize(file_path),
+                             h_size='49MB', uid='uid1', tag='tag1')
+        file_obj.name = os.path.basename(file_path)
+        files_data = MagicMock()
+        files_data.by_uid.side_effect = {'uid1': file_obj}.get
+        update = MagicMock()
+        update.effective_user = MagicMock(id=1, first_name='Test')
+        update.effective_chat.id = 1
+        update.callback_query = AsyncMock()
+        update.callback_query.data = 'file_to_download:uid1:tag1'
+        context = MagicMock()
+        context.bot.send_message = AsyncMock(return_value=MagicMock(message_id=5))
+        context.bot.delete_message = AsyncMock()
+        worker = DownloadWorker(DownloadJobs(':memory:'), usb_bot.send_job_item,
+                                usb_bot.finish_download_job)
+        worker.start(context.bot)
+        busy = AsyncMock(side_effect=WorkspaceFull("нет места во временном каталоге"))
+        with patch('usb_bot.get_file_index', return_value=index_of(files_data)), \
+             patch('usb_bot.is_safe_path', return_value=True), \
+             patch('usb_bot.is_file_accessible', return_value=True), \
+             patch('usb_bot.send_archive', busy), \
+             patch('usb_bot.DOWNLOAD_WORKER', worker):
+            await seven(update, context)
+            await worker.wait(1)
+        texts = [call.kwargs.get('text', '') for call in context.bot.send_message.await_args_list]
+        self.assertIn(f"Не удалось отправить:\n{file_obj.name}: {SERVER_BUSY_TEXT}", texts)
 
 
 if __name__ == '__main__':
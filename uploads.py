@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+import telegram
+from cachetools import LRUCache
+
+import metrics
+from scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class UploadEngine:
+    """
+    Все отправки в Telegram проходят через send(): не больше concurrency
+    одновременно и per_chat в один чат; сообщения ограничены скоростью
+    chat_rate на чат и global_rate на бота (с всплесками *_burst),
+    байты — bandwidth в секунду (0 — без ограничения). RetryAfter
+    останавливает весь чат на указанное Telegram время, сетевые ошибки
+    повторяются с удвоением паузы. stats() — достигнутая скорость.
+    """
+
+    def __init__(self, concurrency: int = 8, per_chat: int = 3,
+                 chat_rate: float = 1.0, chat_burst: int = 20,
+                 global_rate: float = 25.0, global_burst: int = 30,
+                 bandwidth: float = 0, attempts: int = 3,
+                 retry_delay: float = 2.0) -> None:
+        self.per_chat = max(per_chat, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self._slots = asyncio.Semaphore(max(concurrency, 1))
+        self._messages = TokenBucket(global_rate, global_burst)
+        self._bytes = TokenBucket(bandwidth)
+        # chat_id -> _ChatState
+        self._chats = LRUCache(maxsize=1024)
+        self._active = 0
+        self._busy_since = None
+        self._busy = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.retries = 0
+
+    def _chat(self, chat_id) -> "_ChatState":
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatState(
+                self.per_chat, TokenBucket(self.chat_rate, self.chat_burst))
+        return chat
+
+    async def send(self, chat_id, send: Callable[[], Awaitable], size: int = 0,
+                   messages: int = 1, attempts: int = None,
+                   retry_delay: float = None):
+        """
+        Вызывает send() — запрос, отправляющий messages сообщений и size
+        байт в чат chat_id — с учётом ограничений и повторов.
+        BadRequest не повторяется. Паузы между попытками ждутся
+        без общего места, чтобы чат под флуд-лимитом не задерживал другие.
+        """
+        attempts = attempts or self.attempts
+        retry_delay = self.retry_delay if retry_delay is None else retry_delay
+        chat = self._chat(chat_id)
+        for attempt in range(1, attempts + 1):
+            pause = 0.0
+            async with chat.slots:
+                await chat.rate.acquire(messages)
+                await self._acquire_slot(chat)
+                try:
+                    await self._messages.acquire(messages)
+                    await self._bytes.acquire(size)
+                    self._start()
+                    try:
+                        result = await send()
+                    except telegram.error.BadRequest:
+                        raise
+                    except telegram.error.RetryAfter as err:
+                        if attempt == attempts:
+                            raise
+                        self._retry('retry_after')
+                        # Лимит общий для чата: ждут и другие его отправки
+                        chat.block(err.retry_after)
+                        logger.warning("Telegram просит подождать %s с (чат %s)",
+                                       err.retry_after, chat_id)
+                    except telegram.error.NetworkError as err:
+                        if attempt == attempts:
+                            raise
+                        self._retry('network')
+                        logger.warning("Повтор отправки (%s/%s): %s", attempt, attempts, err)
+                        pause = retry_delay * 2 ** (attempt - 1)
+                    else:
+                        self.files += messages
+                        self.bytes += size
+                        return result
+                    finally:
+                        self._stop()
+                finally:
+                    self._slots.release()
+            await asyncio.sleep(pause)
+
+    async def _acquire_slot(self, chat: "_ChatState") -> None:
+        """Занимает общее место, когда чат не на паузе; паузу ждёт без места."""
+        while True:
+            await chat.wait_unblocked()
+            await self._slots.acquire()
+            # Пока ждали места, чат мог попасть под RetryAfter
+            if chat.blocked_until <= time.monotonic():
+                return
+            self._slots.release()
+
+    def stats(self) -> dict:
+        """Сколько отправлено и с какой скоростью, пока шли отправки."""
+        busy = self._busy
+        if self._busy_since is not None:
+            busy += time.monotonic() - self._busy_since
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'busy_seconds': round(busy, 3),
+            'bytes_per_second': round(self.bytes / busy) if busy else 0,
+        }
+
+    def _retry(self, reason: str) -> None:
+        self.retries += 1
+        metrics.UPLOAD_RETRIES.inc(reason=reason)
+
+    def _start(self) -> None:
+        if self._active == 0:
+            self._busy_since = time.monotonic()
+        self._active += 1
+
+    def _stop(self) -> None:
+        self._active -= 1
+        if self._active == 0:
+            self._busy += time.monotonic() - self._busy_since
+            self._busy_since = None
+
+
+class _ChatState:
+    """Ограничения одного чата и срок, до которого Telegram запретил в него писать."""
+
+    def __init__(self, slots: int, rate: TokenBucket) -> None:
+        self.slots = asyncio.Semaphore(slots)
+        self.rate = rate
+        self.blocked_until = 0.0
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def wait_unblocked(self) -> None:
+        while (delay := self.blocked_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
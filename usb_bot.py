@@ -2,11 +2,20 @@
 
 import os
 import logging
-from time import sleep
 from typing import Optional
 import telegram
+from cachetools import LRUCache
 from dotenv import load_dotenv
-from core import FilesData, build_table, archive_files, split_file
+import metrics
+from core import POLICIES, FileIndex, build_table
+from archives import ArchiveBuilds
+from jobs import DownloadWorker
+from loopwatch import LoopWatchdog
+from scheduler import BULK, SINGLE, ChatUpdateProcessor, FairScheduler, MenuScheduler
+from uploads import UploadEngine
+from storage import DownloadJobs, FileIdCache, MenuDeletions
+from workers import QueueFull, get_worker_pool
+from workspace import Workspace
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     Application,
@@ -18,15 +27,17 @@ from telegram.ext import (
     CallbackContext,
     ConversationHandler,
 )
+import contextlib
 import functools
 import traceback
 import datetime
 import html
+import shutil
 import tempfile
-import glob
+import types
+import urllib.parse
 import time
 import asyncio
-import re
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
@@ -36,6 +47,38 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
 MOUNT_PATH = os.getenv('MOUNT_PATH')
 FILTERED_USERS = os.getenv('FILTERED_USERS')
+INDEX_POLL_INTERVAL = float(os.getenv('INDEX_POLL_INTERVAL', '30'))
+DISK_SAMPLE_INTERVAL = float(os.getenv('DISK_SAMPLE_INTERVAL', '60'))
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес вебхука, например https://bot.example.com/telegram
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+# Путь, который слушает бот; по умолчанию — путь из WEBHOOK_URL
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+# Сертификат и ключ, если TLS завершается на самом боте, а не на прокси
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY')
+# Свой сервер Bot API (telegram-bot-api), например http://bot-api:8081/bot
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+TELEGRAM_API_FILE_URL = os.getenv('TELEGRAM_API_FILE_URL')
+# Сервер запущен с --local: принимает файлы до 2 ГБ и читает их с диска по пути
+TELEGRAM_API_LOCAL = os.getenv('TELEGRAM_API_LOCAL', '').lower() in ('1', 'true', 'yes')
+# Путь, под которым сервер Bot API видит MOUNT_PATH; пусто — диск не общий
+TELEGRAM_API_MOUNT_PATH = os.getenv('TELEGRAM_API_MOUNT_PATH')
+# Порт страницы /metrics (формат Prometheus); пусто — метрики не отдаются
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_ADDR = os.getenv('METRICS_ADDR', '127.0.0.1')
+# Сторож event loop: меряет задержку и пишет стек вызова, заблокировавшего
+# loop дольше LOOP_STALL_THRESHOLD секунд
+LOOP_WATCHDOG = os.getenv('LOOP_WATCHDOG', '').lower() in ('1', 'true', 'yes')
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '0.1'))
+STATE_DB_PATH = os.getenv(
+    'STATE_DB_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state.sqlite3')
+)
 
 # Enable logging
 logging.basicConfig(
@@ -52,14 +95,96 @@ START_ROUTES, END_ROUTES = range(2)
 # Callback data
 ONE, TWO, THREE, FOUR, FITH, SIX = range(6)
 
-MAX_FILE_SIZE = 48 * 1024 * 1024  # 48 МБ
+# Больше этого размера файлы уходят архивом по частям: 48 МБ для публичного
+# Bot API, 2000 МБ для своего сервера в режиме --local
+MAX_FILE_SIZE = int(os.getenv(
+    'MAX_FILE_SIZE',
+    str((2000 if TELEGRAM_API_LOCAL else 48) * 1024 * 1024)
+))
+AUDIO_EXTENSIONS = ['.mp3', '.wav', '.ogg', '.m4a']
+# Политика сжатия архивов: auto (по расширению), deflate, fast, store.
+# Неизвестное имя отвергает check_env_vars; до него действует auto
+ARCHIVE_POLICY = POLICIES.get(os.getenv('ARCHIVE_POLICY', 'auto'), POLICIES['auto'])
 PAGE_SIZE = 10
 SIX_FILES_PAGE_SIZE = 8
+# Порядок списка файлов: ключ FilesData -> (подпись кнопки, по убыванию)
+LIST_ORDERS = {
+    'ctime': ("🕑 сначала новые", True),
+    'name': ("🔤 по имени", False),
+    'size': ("📏 сначала большие", True),
+}
 
 # Глобальная переменная для аптайма
 BOT_START_TIME = datetime.datetime.now()
-ARCHIVE_SEMAPHORE = asyncio.Semaphore(20)
+# Очередь отправок: всего одновременно и на одного пользователя
+MAX_ACTIVE_DOWNLOADS = int(os.getenv('MAX_ACTIVE_DOWNLOADS', '8'))
+PER_USER_DOWNLOADS = int(os.getenv('PER_USER_DOWNLOADS', '2'))
+# Мелкие файлы группы уходят альбомами send_media_group: до ALBUM_SIZE
+# файлов одного типа и не больше ALBUM_MAX_MB вместе, PARALLEL_ALBUMS сразу
+ALBUM_SIZE = 10
+ALBUM_MAX_BYTES = int(os.getenv('ALBUM_MAX_MB', '50')) * 1024 * 1024
+PARALLEL_ALBUMS = int(os.getenv('PARALLEL_ALBUMS', '3'))
+# Отправки в Telegram: одновременно всего и в один чат
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', '8'))
+UPLOAD_PER_CHAT = int(os.getenv('UPLOAD_PER_CHAT', '3'))
+# Сообщений в секунду в один чат и от бота всего, с допустимыми всплесками
+# (флуд-лимиты Telegram); 0 — без ограничения
+CHAT_SEND_RATE = float(os.getenv('CHAT_SEND_RATE', '1'))
+CHAT_SEND_BURST = int(os.getenv('CHAT_SEND_BURST', '20'))
+GLOBAL_SEND_RATE = float(os.getenv('GLOBAL_SEND_RATE', '25'))
+GLOBAL_SEND_BURST = int(os.getenv('GLOBAL_SEND_BURST', '30'))
+# Общий предел скорости загрузки в Bot API, МБ/с; 0 — без ограничения
+UPLOAD_RATE_MB = float(os.getenv('UPLOAD_RATE_MB', '0'))
+DOWNLOAD_SCHEDULER: Optional[FairScheduler] = None
+UPLOAD_ENGINE: Optional[UploadEngine] = None
+WATCHDOG: Optional[LoopWatchdog] = None
 MENU_LIFETIME_SECONDS = 15 * 60  # 15 минут
+# Обновлений в обработке одновременно; обновления одного чата всё равно по очереди
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+# Бот обрабатывает только команду /usb и нажатия кнопок
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+# Общий индекс файлов MOUNT_PATH, создаётся при первом обращении
+FILE_INDEX: Optional[FileIndex] = None
+# Кэш file_id загруженных файлов, открывается при первом обращении
+FILE_ID_CACHE: Optional[FileIdCache] = None
+# Отложенные удаления меню, сохраняются в STATE_DB_PATH
+MENU_SCHEDULER: Optional[MenuScheduler] = None
+# Фоновая отправка групп файлов, задания сохраняются в STATE_DB_PATH
+DOWNLOAD_WORKER: Optional[DownloadWorker] = None
+# Общие сборки архивов; готовые части хранятся ARCHIVE_TTL секунд
+ARCHIVE_BUILDS: Optional[ArchiveBuilds] = None
+ARCHIVE_TTL = float(os.getenv('ARCHIVE_TTL', '600'))
+# Каталог архивов и частей и его бюджет, МБ (0 — пока есть место на диске);
+# при нехватке места новая архивация ждёт WORKSPACE_WAIT сек, потом отказ
+WORKSPACE_DIR = os.getenv('WORKSPACE_DIR') or os.path.join(tempfile.gettempdir(), 'usb_bot')
+WORKSPACE_BUDGET_MB = int(os.getenv('WORKSPACE_BUDGET_MB', '0'))
+WORKSPACE_MIN_FREE_MB = int(os.getenv('WORKSPACE_MIN_FREE_MB', '512'))
+WORKSPACE_WAIT = float(os.getenv('WORKSPACE_WAIT', '60'))
+WORKSPACE: Optional[Workspace] = None
+# Попыток на одну часть при сетевых ошибках и пауза перед первым повтором (сек)
+PART_ATTEMPTS = int(os.getenv('PART_ATTEMPTS', '3'))
+PART_RETRY_DELAY = float(os.getenv('PART_RETRY_DELAY', '2'))
+# Готовые страницы списка и клавиатуры выбора файла для текущего снимка индекса
+RENDER_CACHE = LRUCache(maxsize=int(os.getenv('RENDER_CACHE_SIZE', '256')))
+_render_snapshot = None
+
+SERVER_BUSY_TEXT = "Сервер занят архивацией других файлов. Попробуйте позже."
+
+ARCHIVE_DONE_TEXT = (
+    "<b>Загрузка завершена!</b>\n"
+    "<i>Если архив был разбит на части, скачайте все части в одну папку.</i>\n\n"
+    "<b>📁 Инструкция по склейке и распаковке:</b>\n"
+    "<pre>\n"
+    "<b>🐧 Linux/macOS:</b>\n"
+    "<code>cat archive.zip.part* > archive.zip\nunzip archive.zip</code>\n\n"
+    "<b>🖥 Windows (PowerShell):</b>\n"
+    "<code>Get-Content archive.zip.part* -Encoding Byte -ReadCount 0 | Set-Content archive.zip -Encoding Byte\nExpand-Archive archive.zip</code>\n\n"
+    "<b>🐍 Windows (cmd):</b>\n"
+    "<code>copy /b archive.zip.part* archive.zip</code>\n\n"
+    "<b>🐍 Универсально (Python):</b>\n"
+    "<code>python -c \"with open('archive.zip','wb') as w: i=0\nwhile True:\n f='archive.zip.part'+str(i)\n if not __import__('os').path.exists(f): break\n w.write(open(f,'rb').read()); i+=1\"\nunzip archive.zip</code>\n"
+    "</pre>"
+)
 
 
 class ChatData:
@@ -105,12 +230,97 @@ def is_user_allowed(user_id: int) -> bool:
     return str(user_id) in allowed
 
 
+def get_file_index() -> FileIndex:
+    """
+    Возвращает общий индекс файлов MOUNT_PATH.
+    При первом вызове запускает его; первый обход каталога идёт в фоне,
+    до его конца снимок индекса может быть неполным (см. FileIndex.ready).
+    """
+    global FILE_INDEX
+    if FILE_INDEX is None:
+        FILE_INDEX = FileIndex(MOUNT_PATH, poll_interval=INDEX_POLL_INTERVAL,
+                               disk_interval=DISK_SAMPLE_INTERVAL)
+        FILE_INDEX.start(background=True)
+    return FILE_INDEX
+
+
+def get_download_scheduler() -> FairScheduler:
+    """
+    Общая очередь отправок: один файл (seven) идёт раньше групп,
+    пользователи обслуживаются по очереди. Архивацию дополнительно
+    ограничивает пул (MAX_ARCHIVE_JOBS, CPU_WORKERS).
+    """
+    global DOWNLOAD_SCHEDULER
+    if DOWNLOAD_SCHEDULER is None:
+        DOWNLOAD_SCHEDULER = FairScheduler(MAX_ACTIVE_DOWNLOADS, PER_USER_DOWNLOADS)
+    return DOWNLOAD_SCHEDULER
+
+
+def get_upload_engine() -> UploadEngine:
+    global UPLOAD_ENGINE
+    if UPLOAD_ENGINE is None:
+        UPLOAD_ENGINE = UploadEngine(
+            concurrency=UPLOAD_CONCURRENCY, per_chat=UPLOAD_PER_CHAT,
+            chat_rate=CHAT_SEND_RATE, chat_burst=CHAT_SEND_BURST,
+            global_rate=GLOBAL_SEND_RATE, global_burst=GLOBAL_SEND_BURST,
+            bandwidth=UPLOAD_RATE_MB * 1024 * 1024)
+    return UPLOAD_ENGINE
+
+
+def job_slot(job: dict):
+    """Место в очереди отправок для задания DownloadWorker; один файл — как SINGLE."""
+    kind = SINGLE if job['items'] == 1 else BULK
+    return get_download_scheduler().slot(job['user_id'], kind)
+
+
+def get_menu_scheduler() -> MenuScheduler:
+    global MENU_SCHEDULER
+    if MENU_SCHEDULER is None:
+        MENU_SCHEDULER = MenuScheduler(MenuDeletions(STATE_DB_PATH))
+    return MENU_SCHEDULER
+
+
+def get_download_worker() -> DownloadWorker:
+    global DOWNLOAD_WORKER
+    if DOWNLOAD_WORKER is None:
+        DOWNLOAD_WORKER = DownloadWorker(
+            DownloadJobs(STATE_DB_PATH), send_job_item, finish_download_job,
+            slot=job_slot, send_group=send_job_album, plan=plan_job_items,
+            parallel=PARALLEL_ALBUMS, version=archive_version)
+    return DOWNLOAD_WORKER
+
+
+def get_workspace() -> Workspace:
+    global WORKSPACE
+    if WORKSPACE is None:
+        WORKSPACE = Workspace(WORKSPACE_DIR, budget=WORKSPACE_BUDGET_MB * 1024 * 1024,
+                              min_free=WORKSPACE_MIN_FREE_MB * 1024 * 1024,
+                              wait=WORKSPACE_WAIT)
+    return WORKSPACE
+
+
+def get_archive_builds() -> ArchiveBuilds:
+    global ARCHIVE_BUILDS
+    if ARCHIVE_BUILDS is None:
+        ARCHIVE_BUILDS = ArchiveBuilds(ttl=ARCHIVE_TTL, workspace=get_workspace())
+    return ARCHIVE_BUILDS
+
+
+def get_file_id_cache() -> FileIdCache:
+    global FILE_ID_CACHE
+    if FILE_ID_CACHE is None:
+        FILE_ID_CACHE = FileIdCache(STATE_DB_PATH)
+    return FILE_ID_CACHE
+
+
 def error_handler(func):
     @functools.wraps(func)
     async def wrapper(update, context, *args, **kwargs):
+        started = time.perf_counter()
         try:
             return await func(update, context, *args, **kwargs)
         except Exception as err:
+            metrics.HANDLER_ERRORS.inc(handler=func.__name__)
             user = None
             if hasattr(update, 'effective_user') and update.effective_user:
                 user = update.effective_user
@@ -139,22 +349,42 @@ def error_handler(func):
             except Exception:
                 pass
             return ConversationHandler.END
+        finally:
+            metrics.HANDLER_SECONDS.observe(
+                time.perf_counter() - started, handler=func.__name__)
     return wrapper
 
 
-def make_greeting(user_first_name, files, mount_path, bot_start_time):
-    import psutil
+def get_last_sunday(today: Optional[datetime.date] = None) -> datetime.date:
+    """Сегодня, если сегодня воскресенье, иначе последнее прошедшее воскресенье."""
+    today = today or datetime.date.today()
+    if today.weekday() == 6:
+        return today
+    return today - datetime.timedelta(days=(today.weekday() + 1) % 7 or 7)
+
+
+def is_church_service(f, last_sunday: datetime.date) -> bool:
+    """Запись сделана в последнее воскресенье с 16:00 до 19:00."""
+    stamp = f.stamp
+    return stamp is not None and stamp.date() == last_sunday and 16 <= stamp.hour < 19
+
+
+def make_greeting(user_first_name, files, disk_free, bot_start_time):
+    """
+    Приветствие для /usb. Все числа берутся из готовых агрегатов индекса
+    (files.count, files.ext_counts, files.newest()) и фонового замера
+    диска disk_free, поэтому время не зависит от числа файлов.
+    """
     import datetime
-    from collections import Counter
     today = datetime.date.today().strftime('%d.%m.%Y')
-    ext_counter = Counter(os.path.splitext(
-        f.name)[1].lower() for f in files.file_list)
     ext_info = ', '.join(
-        ('{}: {}'.format(k or '[без расширения]', v) for k, v in ext_counter.items()))
-    disk = psutil.disk_usage(mount_path)
-    free_gb = disk.free / (1024 ** 3)
-    if files.file_list:
-        last_file = max(files.file_list, key=lambda f: f.ctime)
+        ('{}: {}'.format(k or '[без расширения]', v) for k, v in files.ext_counts.items()))
+    if disk_free is None:
+        free_info = '—'
+    else:
+        free_info = f"{disk_free / (1024 ** 3): .2f} ГБ"
+    last_file = files.newest()
+    if last_file is not None:
         last_file_info = '{}\n({})'.format(
             last_file.name,
             datetime.datetime.fromtimestamp(
@@ -167,13 +397,120 @@ def make_greeting(user_first_name, files, mount_path, bot_start_time):
     return (
         f"👋 Привет, {user_first_name}!\n\n"
         f"📅 Сегодня: {today}\n"
-        f"📁 Файлов в папке: {len(files.file_list)} ({ext_info})\n"
-        f"💾 Свободно на диске: {free_gb: .2f} ГБ\n"
+        f"📁 Файлов в папке: {files.count} ({ext_info}), {files.h_size_sum}\n"
+        f"💾 Свободно на диске: {free_info}\n"
         f"🕑 Аптайм бота: {uptime_str}\n\n"
         f"🆕 Последний файл: \n{last_file_info}"
     )
 
 
+def render_files_page(files, page: int, order: str):
+    """Текст (HTML) и клавиатура страницы page списка файлов."""
+    total_files = files.count
+    start = page * PAGE_SIZE
+    end = start + PAGE_SIZE
+    page_files = files.ordered(order, start, end, reverse=LIST_ORDERS[order][1])
+    audio_files = [
+        (f.name, f.h_size) for f in page_files
+    ]
+    files_table = build_table(audio_files, "name", "size")
+    futter_table = build_table(
+        [("full size :", files.h_size_sum,)], "all files :", files.count
+    )
+    files_table_html = html.escape(str(files_table))
+    futter_table_html = html.escape(str(futter_table))
+    message = f'<pre>{files_table_html}\n{futter_table_html}</pre>'
+    keyboard = []
+    # Формируем кнопки пагинации в один ряд
+    pagination_row = []
+    if page > 0:
+        pagination_row.append(InlineKeyboardButton("◀️", callback_data="prev_page"))
+    if end < total_files:
+        pagination_row.append(InlineKeyboardButton("▶️", callback_data="next_page"))
+    if pagination_row:
+        keyboard.append(pagination_row)
+    keyboard += [
+        [InlineKeyboardButton(f"Сортировка: {LIST_ORDERS[order][0]}", callback_data="switch_order")],
+        [InlineKeyboardButton("📥 Скачать всё", callback_data=str(THREE))],
+        [InlineKeyboardButton("📅 Скачать за сегодня", callback_data="download_today")],
+        [InlineKeyboardButton("💒 Скачать за последнее воскресенье", callback_data="download_last_sunday")],
+        [InlineKeyboardButton("🎼 Скачать конкретный файл", callback_data=str(SIX))],
+        [
+            InlineKeyboardButton("🚪 Выход", callback_data=str(TWO))
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    return message, reply_markup
+
+
+def render_file_picker(files, page: int, order: str, last_sunday: datetime.date):
+    """
+    Текст и клавиатура страницы page выбора файла: 📦 у файлов больше
+    MAX_FILE_SIZE, 💒 у записей службы в последнее воскресенье.
+    """
+    total_files = files.count
+    start = page * SIX_FILES_PAGE_SIZE
+    end = start + SIX_FILES_PAGE_SIZE
+    page_files = files.ordered(order, start, end, reverse=LIST_ORDERS[order][1])
+    # Формируем кнопки файлов с иконкой архиватора для больших файлов и 💒 для воскресных 16:00-19:00
+    file_buttons = []
+    for f in page_files:
+        name = str(f.name)
+        size = int(f.size)
+        h_size = str(f.h_size)
+        icons = []
+        is_archive = size > MAX_FILE_SIZE
+        if is_church_service(f, last_sunday):
+            icons.append('💒')
+        if is_archive:
+            icons.append('📦')
+        icon_str = f" {' '.join(icons)}" if icons else ""
+        file_buttons.append([
+            InlineKeyboardButton(
+                f"{name} ({h_size}){icon_str}",
+                callback_data=f"file_to_download:{f.uid}:{f.tag}"
+            )
+        ])
+    # Кнопки пагинации файлов в один ряд
+    pagination_row = []
+    if page > 0:
+        pagination_row.append(InlineKeyboardButton("◀️", callback_data="six_prev_page"))
+    if end < total_files:
+        pagination_row.append(InlineKeyboardButton("▶️", callback_data="six_next_page"))
+    if pagination_row:
+        file_buttons.append(pagination_row)
+    # Кнопки возврата
+    file_buttons += [
+        [
+            InlineKeyboardButton("🔙 Назад", callback_data=str(ONE)),
+            InlineKeyboardButton("🚪 Выход", callback_data=str(TWO))
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(file_buttons)
+    # Вычисляем номер страницы и всего страниц
+    total_pages = (total_files + SIX_FILES_PAGE_SIZE - 1) // SIX_FILES_PAGE_SIZE
+    page_number = page + 1 if total_pages > 0 else 1
+    text = f"Выберите файл для скачивания:\nСтраница {page_number} из {total_pages}"
+    return text, reply_markup
+
+
+def render_cached(render, files, page: int, order: str, *args):
+    """
+    Возвращает render(files, page, order, *args) из RENDER_CACHE.
+    Ключ — (версия индекса, вид, страница, порядок, ...); при смене
+    снимка индекса кэш сбрасывается целиком.
+    """
+    global _render_snapshot
+    if files is not _render_snapshot:
+        RENDER_CACHE.clear()
+        _render_snapshot = files
+    key = (files.version, render.__name__, page, order) + args
+    result = RENDER_CACHE.get(key)
+    if result is None:
+        result = RENDER_CACHE[key] = render(files, page, order, *args)
+    return result
+
+
 # старт
 @error_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -185,9 +522,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
     context.chat_data.start_message = update.message.id
     logger.info("User %s started the conversation.", user.first_name)
-    files = FilesData()
-    files.get_files(path=MOUNT_PATH)
-    message = make_greeting(user.first_name, files, MOUNT_PATH, BOT_START_TIME)
+    index = get_file_index()
+    files = index.snapshot()
+    message = make_greeting(
+        user.first_name, files, index.disk_free, BOT_START_TIME)
+    if not index.ready.is_set():
+        message += "\n\n⏳ Индекс файлов ещё строится, список может быть неполным."
     keyboard = [
         [InlineKeyboardButton("👀 Посмотреть файлы", callback_data=str(ONE))],
         [InlineKeyboardButton("🚪 Выход", callback_data=str(TWO))],
@@ -197,7 +537,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         message,
         reply_markup=reply_markup)
     # Планируем удаление меню через 15 минут
-    asyncio.create_task(schedule_menu_deletion(context, sent_message.chat_id, sent_message.message_id))
+    schedule_menu_deletion(sent_message.chat_id, sent_message.message_id)
     return START_ROUTES
 
 
@@ -213,51 +553,17 @@ async def one(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     page = context.user_data.get('page', 0)
-    files = FilesData()
-    files.get_files(path=MOUNT_PATH)
-    total_files = len(files.file_list)
-    # Сортируем файлы от самых новых к старым
-    files.file_list.sort(key=lambda f: f.ctime, reverse=True)
-    start = page * PAGE_SIZE
-    end = start + PAGE_SIZE
-    page_files = files.file_list[start:end]
-    audio_files = [
-        (f.name, f.h_size) for f in page_files
-    ]
-    files_table = build_table(audio_files, "name", "size")
-    futter_table = build_table(
-        [("full size :", files.h_size_sum,)], "all files :", files.count
-    )
-    files_table_html = html.escape(str(files_table))
-    futter_table_html = html.escape(str(futter_table))
-    message = f'<pre>{files_table_html}\n{futter_table_html}</pre>'
-    keyboard = []
-    # Формируем кнопки пагинации в один ряд
-    pagination_row = []
-    if page > 0:
-        pagination_row.append(InlineKeyboardButton("◀️", callback_data="prev_page"))
-    if end < total_files:
-        pagination_row.append(InlineKeyboardButton("▶️", callback_data="next_page"))
-    if pagination_row:
-        keyboard.append(pagination_row)
-    keyboard += [
-        [InlineKeyboardButton("📥 Скачать всё", callback_data=str(THREE))],
-        [InlineKeyboardButton("📅 Скачать за сегодня", callback_data="download_today")],
-        [InlineKeyboardButton("💒 Скачать за последнее воскресенье", callback_data="download_last_sunday")],
-        [InlineKeyboardButton("🎼 Скачать конкретный файл", callback_data=str(SIX))],
-        [
-            InlineKeyboardButton("🚪 Выход", callback_data=str(TWO))
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    order = context.user_data.get('order', 'ctime')
+    files = get_file_index().snapshot()
+    message, reply_markup = render_cached(render_files_page, files, page, order)
     try:
         sent = await query.edit_message_text(
             text=message,
             parse_mode=telegram.constants.ParseMode.HTML,
             reply_markup=reply_markup
         )
-        # Планируем удаление меню через 15 минут
-        asyncio.create_task(schedule_menu_deletion(context, sent.chat_id, sent.message_id))
+        # Переносим удаление меню на 15 минут от последнего показа
+        schedule_menu_deletion(sent.chat_id, sent.message_id)
     except telegram.error.BadRequest as err:
         if "Message is not modified" in str(err):
             pass
@@ -279,6 +585,17 @@ async def prev_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return await one(update, context)
 
 
+# переключение порядка сортировки списка файлов
+@error_handler
+async def switch_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    orders = list(LIST_ORDERS)
+    order = context.user_data.get('order', 'ctime')
+    context.user_data['order'] = orders[(orders.index(order) + 1) % len(orders)]
+    context.user_data['page'] = 0
+    context.user_data['six_files_page'] = 0
+    return await one(update, context)
+
+
 # обработчик скачивания файлов за сегодня
 @error_handler
 async def download_today(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -288,14 +605,8 @@ async def download_today(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "⛔️ Доступ запрещён.", show_alert=False
         )
         return ConversationHandler.END
-    files = FilesData()
-    files.get_files(path=MOUNT_PATH)
-    today = datetime.date.today()
-    today_str = today.strftime('%Y%m%d')
-    today_files = [
-        f for f in files.file_list
-        if re.search(rf'{today_str}', f.name)
-    ]
+    files = get_file_index().snapshot()
+    today_files = files.on_date(datetime.date.today())
     return await send_files_group(update, context, today_files, "за сегодня")
 
 
@@ -308,18 +619,8 @@ async def download_last_sunday(update: Update, context: ContextTypes.DEFAULT_TYP
             "⛔️ Доступ запрещён.", show_alert=False
         )
         return START_ROUTES
-    files = FilesData()
-    files.get_files(path=MOUNT_PATH)
-    today = datetime.date.today()
-    if today.weekday() == 6:
-        last_sunday = today
-    else:
-        last_sunday = today - datetime.timedelta(days=(today.weekday() + 1) % 7 or 7)
-    last_sunday_str = last_sunday.strftime('%Y%m%d')
-    sunday_files = [
-        f for f in files.file_list
-        if re.search(rf'{last_sunday_str}', f.name)
-    ]
+    files = get_file_index().snapshot()
+    sunday_files = files.on_date(get_last_sunday())
     if not sunday_files:
         await update.callback_query.answer(
             "Нет файлов за последнее воскресенье.", show_alert=False
@@ -328,109 +629,180 @@ async def download_last_sunday(update: Update, context: ContextTypes.DEFAULT_TYP
     return await send_files_group(update, context, sunday_files, "за последнее воскресенье")
 
 
-# универсальная функция отправки группы файлов (до 10 за раз)
+# универсальная функция отправки группы файлов: ставит задание в очередь
 async def send_files_group(update, context, file_objs, label):
-    async with ARCHIVE_SEMAPHORE:
-        query = update.callback_query
-        await query.answer()
-        if not file_objs:
-            await update.callback_query.answer(
-                f"Нет файлов {label}.", show_alert=False
-            )
-            # Оставляем меню открытым
-            return await one(update, context)
-        loading_message = await context.bot.send_message(
-            text=f"Загружаю файлы {label}...",
-            chat_id=update.effective_chat.id
+    query = update.callback_query
+    await query.answer()
+    if not file_objs:
+        await update.callback_query.answer(
+            f"Нет файлов {label}.", show_alert=False
         )
+        # Оставляем меню открытым
+        return await one(update, context)
+    loading_message = await context.bot.send_message(
+        text=f"Загружаю файлы {label}...",
+        chat_id=update.effective_chat.id
+    )
+    user = update.effective_user
+    get_download_worker().submit(
+        update.effective_chat.id, user.id, user.first_name, label,
+        [f.file for f in file_objs], loading_message.message_id
+    )
+    return START_ROUTES
+
+
+async def send_job_item(bot, job, item, ack):
+    """Отправляет один файл задания DownloadWorker; части архива подтверждаются через ack."""
+    context = types.SimpleNamespace(bot=bot)
+    user = types.SimpleNamespace(id=job['user_id'], first_name=job['user_name'])
+    if os.path.getsize(item['path']) <= MAX_FILE_SIZE:
+        await send_file(context, job['chat_id'], user, item['path'])
+    else:
+        # Архивируем и отправляем архив/части, начиная с неподтверждённой
         try:
-            archive_sent = False
-            for f in file_objs:
-                try:
-                    file_size = os.path.getsize(f.file)
-                    if file_size <= MAX_FILE_SIZE:
-                        # Отправляем как аудио (если mp3/wav) или как документ
-                        ext = os.path.splitext(f.file)[1].lower()
-                        if ext in ['.mp3', '.wav', '.ogg', '.m4a']:
-                            await context.bot.send_audio(
-                                chat_id=update.effective_chat.id,
-                                audio=open(f.file, "rb"),
-                                filename=os.path.basename(f.file)
-                            )
-                        else:
-                            await context.bot.send_document(
-                                chat_id=update.effective_chat.id,
-                                document=open(f.file, "rb"),
-                                filename=os.path.basename(f.file)
-                            )
-                        log_download(update.effective_user, f.file)
-                    else:
-                        # Архивируем и отправляем архив/части
-                        with tempfile.TemporaryDirectory() as tmpdir:
-                            archive_path = os.path.join(tmpdir, f"{os.path.basename(f.file)}.zip")
-                            archive_files([f.file], archive_path)
-                            archive_size = os.path.getsize(archive_path)
-                            if archive_size <= MAX_FILE_SIZE:
-                                send_files = [archive_path]
-                            else:
-                                send_files = split_file(archive_path, MAX_FILE_SIZE)
-                            for part in send_files:
-                                await context.bot.send_document(
-                                    chat_id=update.effective_chat.id,
-                                    document=open(part, "rb"),
-                                    filename=os.path.basename(part)
-                                )
-                                log_download(update.effective_user, part)
-                                archive_sent = True
-                except Exception as err:
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"Ошибка при отправке файла {os.path.basename(f.file)}: {err}"
-                    )
-            await context.bot.delete_message(
-                chat_id=update.effective_chat.id,
-                message_id=loading_message.message_id
-            )
-            if archive_sent:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=(
-                        "<b>Загрузка завершена!</b>\n"
-                        "<i>Если архив был разбит на части, скачайте все части в одну папку.</i>\n\n"
-                        "<b>📁 Инструкция по склейке и распаковке:</b>\n"
-                        "<pre>\n"
-                        "<b>🐧 Linux/macOS:</b>\n"
-                        "<code>cat archive.zip.part* > archive.zip\nunzip archive.zip</code>\n\n"
-                        "<b>🖥 Windows (PowerShell):</b>\n"
-                        "<code>Get-Content archive.zip.part* -Encoding Byte -ReadCount 0 | Set-Content archive.zip -Encoding Byte\nExpand-Archive archive.zip</code>\n\n"
-                        "<b>🐍 Windows (cmd):</b>\n"
-                        "<code>copy /b archive.zip.part* archive.zip</code>\n\n"
-                        "<b>🐍 Универсально (Python):</b>\n"
-                        "<code>python -c \"with open('archive.zip','wb') as w: i=0\nwhile True:\n f='archive.zip.part'+str(i)\n if not __import__('os').path.exists(f): break\n w.write(open(f,'rb').read()); i+=1\"\nunzip archive.zip</code>\n"
-                        "</pre>"
-                    ),
-                    parse_mode=telegram.constants.ParseMode.HTML
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Загрузка завершена!"
-                )
-        except Exception as err:
-            try:
-                await context.bot.edit_message_text(
-                    message_id=loading_message.message_id,
-                    chat_id=loading_message.chat_id,
-                    text=f"упс, что-то пошло не так: \n{err}"
-                )
-            except telegram.error.BadRequest as berr:
-                if "Message is not modified" in str(berr):
-                    pass
-                else:
-                    raise
-            logger.error(err)
-            return START_ROUTES
-        return START_ROUTES
+            await send_archive(context, job['chat_id'], user, item['path'],
+                               done_parts=item['parts'], on_part=ack)
+        except QueueFull as err:
+            # Текст ошибки попадёт в итог задания, причина остаётся в журнале
+            raise QueueFull(SERVER_BUSY_TEXT) from err
+
+
+def build_version(st: os.stat_result) -> list:
+    """От чего зависят части архива: размер, mtime, политика, размер части (ключ сборки без пути)."""
+    return [st.st_size, st.st_mtime_ns, ARCHIVE_POLICY.name, MAX_FILE_SIZE]
+
+
+def archive_version(file_path) -> Optional[list]:
+    """Текущая версия частей архива файла; None, если файла нет."""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return build_version(st)
+
+
+def is_audio_file(file_path) -> bool:
+    return os.path.splitext(file_path)[1].lower() in AUDIO_EXTENSIONS
+
+
+def plan_job_items(items: list) -> list:
+    """
+    Делит элементы задания на пакеты DownloadWorker: мелкие файлы —
+    альбомами одного типа (аудио отдельно от документов, как требует
+    Telegram), крупные и начатые архивы — по одному.
+    """
+    batches = []
+    # тип -> [элементы, байты] текущего альбома
+    albums = {}
+    for item in items:
+        try:
+            size = os.path.getsize(item['path'])
+        except OSError:
+            # Ошибку покажет отправка по одному
+            size = None
+        if size is None or size > min(MAX_FILE_SIZE, ALBUM_MAX_BYTES) or item['parts']:
+            batches.append([item])
+            continue
+        kind = 'audio' if is_audio_file(item['path']) else 'document'
+        album = albums.get(kind)
+        if album is None or len(album[0]) >= ALBUM_SIZE or album[1] + size > ALBUM_MAX_BYTES:
+            album = albums[kind] = [[], 0]
+            batches.append(album[0])
+        album[0].append(item)
+        album[1] += size
+    return batches
+
+
+def album_sources(items: list) -> tuple:
+    """
+    Источники альбома по элементам: (file_id/URI или путь, имя) и
+    (stat, способ, байты). Уже загруженные файлы идут по file_id.
+    """
+    cache = get_file_id_cache()
+    sent, sources = [], []
+    for item in items:
+        st = os.stat(item['path'])
+        cached = cache.get(item['path'], st.st_size, st.st_mtime_ns)
+        if cached:
+            sources.append((cached[0][1], None))
+            sent.append((st, 'cached', 0))
+            continue
+        name = os.path.basename(item['path'])
+        uri = bot_api_file_uri(item['path'])
+        sources.append((uri or item['path'], name))
+        sent.append((st, 'local', 0) if uri else (st, 'album', st.st_size))
+    return sources, sent
+
+
+async def upload_album(bot, chat_id, media_type, sources, sent):
+    """Отправляет альбом; байты файлов читаются, когда UploadEngine дал место."""
+    async def upload():
+        # В памяти не больше UPLOAD_CONCURRENCY загрузок
+        media = []
+        for (source, name), (_, path, _) in zip(sources, sent):
+            if path == 'album':
+                source = await read_upload(source)
+            media.append(media_type(source, filename=name) if name else media_type(source))
+        return await bot.send_media_group(chat_id=chat_id, media=media)
+    return await send_with_retry(
+        chat_id, upload, size=sum(size for _, _, size in sent), messages=len(sources))
+
+
+async def send_job_album(bot, job, items):
+    """Отправляет элементы задания одним альбомом; уже загруженные — по file_id."""
+    chat_id = job['chat_id']
+    user = types.SimpleNamespace(id=job['user_id'], first_name=job['user_name'])
+    cache = get_file_id_cache()
+    media_type = (telegram.InputMediaAudio if is_audio_file(items[0]['path'])
+                  else telegram.InputMediaDocument)
+    started = time.perf_counter()
+    sources, sent = album_sources(items)
+    try:
+        messages = await upload_album(bot, chat_id, media_type, sources, sent)
+    except telegram.error.BadRequest as err:
+        stale = [item['path'] for item, (_, path, _) in zip(items, sent) if path == 'cached']
+        if not stale:
+            raise
+        # Какой из file_id отклонён, неизвестно: альбом уходит заново без кэша
+        logger.info("file_id альбома отклонены (%s), загружаю заново", err)
+        for file_path in stale:
+            cache.forget(file_path)
+        return await send_job_album(bot, job, items)
+    seconds = (time.perf_counter() - started) / len(items)
+    for item, (st, path, size), message in zip(items, sent, messages):
+        file_id = sent_file_id(message)
+        if path != 'cached' and file_id:
+            cache.put(item['path'], st.st_size, st.st_mtime_ns,
+                      [(os.path.basename(item['path']), file_id)])
+        record_upload(path, size, seconds)
+        log_download(user, item['path'])
+
+
+async def finish_download_job(bot, job, items):
+    """Итог задания: убирает «Загружаю…», перечисляет ошибки и даёт инструкцию к архивам."""
+    chat_id = job['chat_id']
+    logger.info("Задание отправки %s: %s; всего отправок: %s",
+                job['id'], job['status'], get_upload_engine().stats())
+    if job['message_id']:
+        with contextlib.suppress(telegram.error.TelegramError):
+            await bot.delete_message(chat_id=chat_id, message_id=job['message_id'])
+    if job['status'] == 'cancelled':
+        return
+    failed = [i for i in items if i['status'] == 'failed']
+    if failed:
+        await bot.send_message(
+            chat_id=chat_id,
+            text="Не удалось отправить:\n" + "\n".join(
+                f"{os.path.basename(i['path'])}: {i['error']}" for i in failed)
+        )
+    if any(i['parts'] for i in items):
+        await bot.send_message(
+            chat_id=chat_id,
+            text=ARCHIVE_DONE_TEXT,
+            parse_mode=telegram.constants.ParseMode.HTML
+        )
+    else:
+        await bot.send_message(chat_id=chat_id, text="Загрузка завершена!")
 
 
 # тут скачать все и варианты возврата
@@ -442,8 +814,7 @@ async def three(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             "⛔️ Доступ запрещён.", show_alert=False
         )
         return ConversationHandler.END
-    files = FilesData()
-    files.get_files(path=MOUNT_PATH)
+    files = get_file_index().snapshot()
     return await send_files_group(update, context, files.file_list, "все файлы")
 
 
@@ -456,10 +827,15 @@ async def end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             "⛔️ Доступ запрещён.", show_alert=False
         )
         return ConversationHandler.END
+    # Пользователь ушёл — архивации и отправки для этого чата больше не нужны
+    get_download_worker().cancel(update.effective_chat.id)
+    get_archive_builds().cancel(update.effective_chat.id)
     query = update.callback_query
     await query.answer()
     await query.edit_message_text(text="👋")
-    sleep(1)
+    await asyncio.sleep(1)
+    get_menu_scheduler().cancel(
+        update.effective_chat.id, query.message.message_id)
     await query.delete_message()
     await context.bot.delete_message(
         chat_id=update.effective_chat.id,
@@ -480,72 +856,13 @@ async def six(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await query.answer()
     # Получаем текущую страницу для выбора файла
     page = int(context.user_data.get('six_files_page', 0))
-    files = FilesData()
-    if not getattr(files, 'file_list', None) and MOUNT_PATH:
-        files.get_files(path=MOUNT_PATH)
-    total_files = len(files.file_list)
-    # Сортируем файлы от самых новых к старым
-    files.file_list.sort(key=lambda f: f.ctime, reverse=True)
-    last_sunday = None
-    today = datetime.date.today()
-    if today.weekday() == 6:
-        last_sunday = today
-    else:
-        last_sunday = today - datetime.timedelta(days=(today.weekday() + 1) % 7 or 7)
-    last_sunday_str = last_sunday.strftime('%Y%m%d')
-    start = page * SIX_FILES_PAGE_SIZE
-    end = start + SIX_FILES_PAGE_SIZE
-    page_files = files.file_list[start:end]
-    # Формируем кнопки файлов с иконкой архиватора для больших файлов и 💒 для воскресных 16:00-19:00
-    file_buttons = []
-    for f in page_files:
-        name = str(f.name)
-        size = int(f.size)
-        h_size = str(f.h_size)
-        icons = []
-        match = re.search(r'(\d{8})-(\d{6})', name)
-        is_church = False
-        if match:
-            date_str, time_str = match.groups()
-            if date_str == last_sunday_str:
-                hour = int(time_str[:2])
-                if 16 <= hour < 19:
-                    is_church = True
-        is_archive = size > MAX_FILE_SIZE
-        if is_church:
-            icons.append('💒')
-        if is_archive:
-            icons.append('📦')
-        icon_str = f" {' '.join(icons)}" if icons else ""
-        print('DEBUG button:', f"{name} ({h_size}){icon_str}")
-        file_buttons.append([
-            InlineKeyboardButton(
-                f"{name} ({h_size}){icon_str}",
-                callback_data=f"file_to_download:{name}"
-            )
-        ])
-    # Кнопки пагинации файлов в один ряд
-    pagination_row = []
-    if page > 0:
-        pagination_row.append(InlineKeyboardButton("◀️", callback_data="six_prev_page"))
-    if end < total_files:
-        pagination_row.append(InlineKeyboardButton("▶️", callback_data="six_next_page"))
-    if pagination_row:
-        file_buttons.append(pagination_row)
-    # Кнопки возврата
-    file_buttons += [
-        [
-            InlineKeyboardButton("🔙 Назад", callback_data=str(ONE)),
-            InlineKeyboardButton("🚪 Выход", callback_data=str(TWO))
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(file_buttons)
-    # Вычисляем номер страницы и всего страниц
-    total_pages = (total_files + SIX_FILES_PAGE_SIZE - 1) // SIX_FILES_PAGE_SIZE
-    page_number = page + 1 if total_pages > 0 else 1
+    order = context.user_data.get('order', 'ctime')
+    files = get_file_index().snapshot()
+    text, reply_markup = render_cached(
+        render_file_picker, files, page, order, get_last_sunday())
     try:
         await query.edit_message_text(
-            text=f"Выберите файл для скачивания:\nСтраница {page_number} из {total_pages}",
+            text=text,
             reply_markup=reply_markup
         )
     except telegram.error.BadRequest as err:
@@ -571,7 +888,9 @@ async def six_prev_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 @error_handler
 async def seven(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    Handler for downloading a specific file. If the file is larger than MAX_FILE_SIZE, it is sent as an archive (possibly split into parts) with user instructions.
+    Handler for downloading a specific file. If the file is larger than MAX_FILE_SIZE,
+    it is sent in the background by DownloadWorker as an archive (possibly split into parts)
+    with user instructions.
 
     Args:
         update (Update): Telegram update object.
@@ -586,11 +905,15 @@ async def seven(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             "⛔️ Доступ запрещён.", show_alert=False
         )
         return START_ROUTES
-    file_name = update.callback_query.data.split(":", maxsplit=1)[-1].strip()
-    files = FilesData()
-    if not getattr(files, 'file_list', None) and MOUNT_PATH:
-        files.get_files(path=MOUNT_PATH)
-    file_obj = next((f for f in files.file_list if f.name == file_name), None)
+    # callback_data: file_to_download:<uid>:<tag>
+    _, uid, tag = (update.callback_query.data.split(":") + ["", ""])[:3]
+    files = get_file_index().snapshot()
+    file_obj = files.by_uid(uid)
+    if file_obj and file_obj.tag != tag:
+        await update.callback_query.answer(
+            "Файл изменился, список обновлён.", show_alert=False
+        )
+        return await six(update, context)
     if not file_obj or not is_safe_path(MOUNT_PATH, file_obj.file) or not is_file_accessible(file_obj.file):
         await update.callback_query.answer(
             "Файл не найден или недоступен.", show_alert=False
@@ -602,79 +925,25 @@ async def seven(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         chat_id=update.effective_chat.id,
         text="загружаю..."
     )
+    if file_obj.size > MAX_FILE_SIZE:
+        # Архив собирается и отправляется в фоне: обработчик сразу
+        # освобождает чат, и «Выход» успевает отменить отправку
+        get_download_worker().submit(
+            update.effective_chat.id, user.id, user.first_name,
+            os.path.basename(file_path), [file_path], loading_message.message_id
+        )
+        return START_ROUTES
     try:
-        if file_obj.size <= MAX_FILE_SIZE:
-            ext = os.path.splitext(file_path)[1].lower()
-            if ext in ['.mp3', '.wav', '.ogg', '.m4a']:
-                await context.bot.send_audio(
-                    chat_id=update.effective_chat.id,
-                    audio=open(file_path, "rb"),
-                    filename=os.path.basename(file_path)
-                )
-            else:
-                await context.bot.send_document(
-                    chat_id=update.effective_chat.id,
-                    document=open(file_path, "rb"),
-                    filename=os.path.basename(file_path)
-                )
-            log_download(user, file_path)
-            await context.bot.delete_message(
-                chat_id=update.effective_chat.id,
-                message_id=loading_message.message_id
-            )
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Загрузка завершена!"
-            )
-        else:
-            # Архивируем и отправляем архив/части
-            import tempfile
-            archive_sent = False
-            with tempfile.TemporaryDirectory() as tmpdir:
-                archive_path = os.path.join(tmpdir, f"{os.path.basename(file_path)}.zip")
-                archive_files([file_path], archive_path)
-                archive_size = os.path.getsize(archive_path)
-                if archive_size <= MAX_FILE_SIZE:
-                    send_files = [archive_path]
-                else:
-                    send_files = split_file(archive_path, MAX_FILE_SIZE)
-                for part in send_files:
-                    await context.bot.send_document(
-                        chat_id=update.effective_chat.id,
-                        document=open(part, "rb"),
-                        filename=os.path.basename(part)
-                    )
-                    log_download(user, part)
-                    archive_sent = True
-            await context.bot.delete_message(
-                chat_id=update.effective_chat.id,
-                message_id=loading_message.message_id
-            )
-            if archive_sent:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=(
-                        "<b>Загрузка завершена!</b>\n"
-                        "<i>Если архив был разбит на части, скачайте все части в одну папку.</i>\n\n"
-                        "<b>📁 Инструкция по склейке и распаковке:</b>\n"
-                        "<pre>\n"
-                        "<b>🐧 Linux/macOS:</b>\n"
-                        "<code>cat archive.zip.part* > archive.zip\nunzip archive.zip</code>\n\n"
-                        "<b>🖥 Windows (PowerShell):</b>\n"
-                        "<code>Get-Content archive.zip.part* -Encoding Byte -ReadCount 0 | Set-Content archive.zip -Encoding Byte\nExpand-Archive archive.zip</code>\n\n"
-                        "<b>🐍 Windows (cmd):</b>\n"
-                        "<code>copy /b archive.zip.part* archive.zip</code>\n\n"
-                        "<b>🐍 Универсально (Python):</b>\n"
-                        "<code>python -c \"with open('archive.zip','wb') as w: i=0\nwhile True:\n f='archive.zip.part'+str(i)\n if not __import__('os').path.exists(f): break\n w.write(open(f,'rb').read()); i+=1\"\nunzip archive.zip</code>\n"
-                        "</pre>"
-                    ),
-                    parse_mode=telegram.constants.ParseMode.HTML
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Загрузка завершена!"
-                )
+        async with get_download_scheduler().slot(user.id, SINGLE):
+            await send_file(context, update.effective_chat.id, user, file_path)
+        await context.bot.delete_message(
+            chat_id=update.effective_chat.id,
+            message_id=loading_message.message_id
+        )
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Загрузка завершена!"
+        )
     except Exception as err:
         logger.exception("Ошибка при отправке файла: user_id=%s, file=%s", user.id, file_path)
         await context.bot.delete_message(
@@ -690,9 +959,15 @@ async def seven(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 def check_env_vars():
     required = ["TELEGRAM_TOKEN", "MOUNT_PATH"]
+    if os.getenv('BOT_MODE', 'polling') == 'webhook':
+        required.append("WEBHOOK_URL")
     missing = [v for v in required if not os.getenv(v)]
     if missing:
         raise RuntimeError(f"Отсутствуют обязательные переменные окружения: {', '.join(missing)}")
+    policy = os.getenv('ARCHIVE_POLICY', 'auto')
+    if policy not in POLICIES:
+        raise RuntimeError(
+            f"Неизвестная ARCHIVE_POLICY={policy}; допустимо: {', '.join(POLICIES)}")
 
 
 def is_safe_path(base_path, path):
@@ -709,58 +984,253 @@ def log_download(user, file_path):
     logger.info(f"User {user.id} ({user.first_name}) скачал файл: {file_path}")
 
 
-def clean_old_archives(folder, max_age_seconds=3600):
-    now = time.time()
-    patterns = ["*.zip", "*.zip.part*"]
-    for pattern in patterns:
-        for file_path in glob.glob(os.path.join(folder, pattern)):
-            try:
-                if os.path.isfile(file_path) and now - os.path.getmtime(file_path) > max_age_seconds:
-                    os.remove(file_path)
-                    logger.info(f"Удалён старый архив: {file_path}")
-            except Exception as e:
-                logger.warning(f"Ошибка при удалении архива {file_path}: {e}")
-
-
-async def periodic_clean_archives(folder, max_age_seconds=3600, interval=1800):
+async def periodic_clean_archives(interval=1800):
+    """
+    Удаляет готовые архивы, которые никто не запрашивал ARCHIVE_TTL секунд.
+    Архивы лежат только в WORKSPACE_DIR; MOUNT_PATH не просматривается.
+    """
     while True:
-        clean_old_archives(folder, max_age_seconds)
+        await get_archive_builds().sweep()
         await asyncio.sleep(interval)
 
 
-def send_file_with_logging(context, chat_id, user, file_path):
-    try:
-        with open(file_path, "rb") as f:
-            context.bot.send_document(
+def bot_api_file_uri(file_path) -> Optional[str]:
+    """
+    file:// URI, по которому свой сервер Bot API (--local) прочитает файл
+    с общего диска, или None, если диск серверу не виден.
+    """
+    if not TELEGRAM_API_LOCAL or not TELEGRAM_API_MOUNT_PATH:
+        return None
+    rel = os.path.relpath(os.path.realpath(file_path), os.path.realpath(MOUNT_PATH))
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        return None
+    return 'file://' + os.path.join(TELEGRAM_API_MOUNT_PATH, rel)
+
+
+def record_upload(path: str, sent_bytes: int, seconds: float) -> None:
+    """Учитывает отправку одного файла способом path в метриках."""
+    metrics.UPLOAD_FILES.inc(path=path)
+    metrics.UPLOAD_BYTES.inc(sent_bytes, path=path)
+    metrics.UPLOAD_SECONDS.observe(seconds, path=path)
+
+
+async def send_with_retry(chat_id, send, size=0, messages=1):
+    """
+    Вызывает send() через общий UploadEngine: с ограничениями скорости
+    и до PART_ATTEMPTS раз — после сетевой ошибки ждёт PART_RETRY_DELAY,
+    удваивая паузу, после RetryAfter — сколько попросил Telegram.
+    size — загружаемые байты, messages — сообщений в запросе.
+    """
+    return await get_upload_engine().send(
+        chat_id, send, size=size, messages=messages,
+        attempts=PART_ATTEMPTS, retry_delay=PART_RETRY_DELAY)
+
+
+def read_file(path) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def read_upload(path) -> bytes:
+    """
+    Содержимое файла для загрузки. PTB всё равно читает файл целиком,
+    поэтому чтение вынесено в поток ввода-вывода, а не в event loop.
+    Вызывается внутри send() UploadEngine, чтобы в памяти были только
+    файлы, которые отправляются прямо сейчас.
+    """
+    return await get_worker_pool().run_io(read_file, path)
+
+
+def sent_file_id(message) -> Optional[str]:
+    media = message.audio or message.document
+    return media.file_id if media else None
+
+
+async def send_file(context, chat_id, user, file_path):
+    """
+    Отправляет файл как аудио (mp3/wav/ogg/m4a) или как документ.
+    Если этот файл уже загружался и не менялся, повторно используется
+    его file_id, и байты в Telegram не передаются. Свой сервер Bot API
+    с общим диском получает путь к файлу вместо его содержимого.
+    """
+    st = os.stat(file_path)
+    cache = get_file_id_cache()
+    is_audio = is_audio_file(file_path)
+    send = context.bot.send_audio if is_audio else context.bot.send_document
+    field = 'audio' if is_audio else 'document'
+    cached = cache.get(file_path, st.st_size, st.st_mtime_ns)
+    started = time.perf_counter()
+    if cached:
+        path, sent_bytes = 'cached', 0
+        try:
+            await send_with_retry(chat_id, lambda: send(chat_id=chat_id, **{field: cached[0][1]}))
+        except telegram.error.BadRequest as err:
+            # file_id больше не принимается (например, после смены токена)
+            logger.info("file_id %s отклонён (%s), загружаю заново", file_path, err)
+            cache.forget(file_path)
+            return await send_file(context, chat_id, user, file_path)
+    else:
+        name = os.path.basename(file_path)
+        uri = bot_api_file_uri(file_path)
+        path, sent_bytes = ('local' if uri else 'direct'), st.st_size
+
+        async def upload():
+            source = uri or await read_upload(file_path)
+            return await send(chat_id=chat_id, filename=name, **{field: source})
+        message = await send_with_retry(chat_id, upload, size=0 if uri else st.st_size)
+        file_id = sent_file_id(message)
+        if file_id:
+            cache.put(file_path, st.st_size, st.st_mtime_ns, [(name, file_id)])
+    record_upload(path, sent_bytes, time.perf_counter() - started)
+    log_download(user, file_path)
+
+
+async def send_archive(context, chat_id, user, file_path, done_parts=(), on_part=None):
+    """
+    Отправляет файл zip-архивом, при необходимости разбитым на части
+    по MAX_FILE_SIZE. file_id частей кэшируются, так что повторная
+    отправка неизменённого файла обходится без архивации.
+    done_parts — уже доставленные части (имя, file_id): они не отправляются
+    повторно. on_part(имя, file_id, версия) вызывается после каждой новой
+    части; версия (build_version) — из какого состояния файла собраны части.
+    Сбойная часть повторяется отдельно (send_with_retry).
+    """
+    st = os.stat(file_path)
+    version = build_version(st)
+    cache = get_file_id_cache()
+    variant = f'zip:{ARCHIVE_POLICY.name}'
+    cached = cache.get(file_path, st.st_size, st.st_mtime_ns, variant=variant)
+
+    def ack(name, file_id):
+        if on_part:
+            on_part(name, file_id, version)
+
+    if cached:
+        done_parts = list(done_parts)
+        try:
+            await send_cached_parts(context, chat_id, user, cached, done_parts, ack)
+        except telegram.error.BadRequest as err:
+            # Архив собирается заново; доставленные части не повторяются
+            logger.info("file_id части %s отклонён (%s), загружаю заново", file_path, err)
+            cache.forget(file_path)
+            return await send_archive(context, chat_id, user, file_path,
+                                      done_parts=done_parts, on_part=on_part)
+        return
+    parts = list(done_parts)
+    # Архив собирается в пуле процессов, одна сборка на все одновременные
+    # запросы этого файла; следующая часть готовится, пока отправляется текущая
+    parts_stream = get_archive_builds().parts(
+        file_path, MAX_FILE_SIZE, ARCHIVE_POLICY, owner=chat_id, st=st)
+    async with contextlib.aclosing(parts_stream):
+        sent = await upload_parts(context, chat_id, user, parts_stream, parts, ack)
+    for sent_bytes, seconds in sent:
+        record_upload('split' if len(parts) > 1 else 'archived', sent_bytes, seconds)
+    # Без file_id хотя бы одной части повторно отправить архив из кэша нельзя
+    if all(file_id for _, file_id in parts):
+        cache.put(file_path, st.st_size, st.st_mtime_ns, parts, variant=variant)
+
+
+async def send_cached_parts(context, chat_id, user, cached, done_parts, on_part):
+    """
+    Отправляет по file_id части из кэша, начиная после done_parts;
+    доставленные добавляются в done_parts. BadRequest отклонённого
+    file_id пробрасывается.
+    """
+    for name, file_id in cached[len(done_parts):]:
+        started = time.perf_counter()
+        await send_with_retry(
+            chat_id, lambda: context.bot.send_document(chat_id=chat_id, document=file_id))
+        record_upload('cached', 0, time.perf_counter() - started)
+        done_parts.append((name, file_id))
+        on_part(name, file_id)
+        log_download(user, name)
+
+
+async def upload_parts(context, chat_id, user, parts_stream, parts, on_part) -> list:
+    """
+    Загружает части из parts_stream, пропуская первые len(parts) уже
+    доставленных; новые (имя, file_id) добавляются в parts.
+    Возвращает (байты, секунды) по загруженным частям.
+    """
+    # Способ (archived/split) известен только в конце
+    sent = []
+    skip = len(parts)
+    async for part in parts_stream:
+        if skip:
+            # Часть уже доставлена до сбоя
+            skip -= 1
+            continue
+        name = os.path.basename(part)
+        started = time.perf_counter()
+        size = os.path.getsize(part)
+
+        async def upload(part=part, name=name):
+            return await context.bot.send_document(
                 chat_id=chat_id,
-                document=f,
-                filename=os.path.basename(file_path)
+                document=await read_upload(part),
+                filename=name
             )
-        log_download(user, file_path)
+        message = await send_with_retry(chat_id, upload, size=size)
+        sent.append((size, time.perf_counter() - started))
+        parts.append((name, sent_file_id(message)))
+        on_part(*parts[-1])
+        log_download(user, part)
+    return sent
+
+
+async def send_file_with_logging(context, chat_id, user, file_path):
+    try:
+        await send_file(context, chat_id, user, file_path)
     except Exception as err:
-        context.bot.send_message(
+        await context.bot.send_message(
             chat_id=chat_id,
             text=f"Ошибка при отправке файла {os.path.basename(file_path)}: {err}"
         )
 
 
-async def schedule_menu_deletion(context, chat_id, message_id, delay=MENU_LIFETIME_SECONDS):
-    await asyncio.sleep(delay)
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except Exception as e:
-        pass  # Сообщение уже удалено или недоступно
+def schedule_menu_deletion(chat_id, message_id, delay=MENU_LIFETIME_SECONDS):
+    """Удалить меню через delay секунд; прежний срок этого сообщения отменяется."""
+    get_menu_scheduler().schedule(chat_id, message_id, delay)
 
 
-def main() -> None:
-    check_env_vars()
-    # Запуск фоновой задачи очистки архивов
-    loop = asyncio.get_event_loop()
-    loop.create_task(periodic_clean_archives(MOUNT_PATH, max_age_seconds=3600, interval=1800))
+async def on_startup(application: Application) -> None:
+    global WATCHDOG
+    if LOOP_WATCHDOG and WATCHDOG is None:
+        WATCHDOG = LoopWatchdog(threshold=LOOP_STALL_THRESHOLD)
+        WATCHDOG.start()
+    get_menu_scheduler().start(application.bot.delete_message)
+    get_download_worker().start(application.bot)
+
+
+async def on_shutdown(application: Application) -> None:
+    global WATCHDOG
+    await get_download_worker().stop()
+    await get_menu_scheduler().stop()
+    if WATCHDOG is not None:
+        await WATCHDOG.stop()
+        WATCHDOG = None
+
+
+def build_application(token: Optional[str] = None,
+                      base_url: Optional[str] = None) -> Application:
+    """
+    Собирает Application со всеми обработчиками, но не запускает его.
+    base_url по умолчанию — TELEGRAM_API_URL (свой сервер Bot API).
+    """
     context_types = ContextTypes(context=CustomContext, chat_data=ChatData)
-    application = Application.builder().token(
-        TELEGRAM_TOKEN
-    ).context_types(context_types).build()
+    builder = Application.builder().token(
+        token or TELEGRAM_TOKEN
+    ).context_types(context_types).post_init(on_startup).post_shutdown(on_shutdown)
+    # Долгая отправка одному пользователю не задерживает меню остальных
+    builder = builder.concurrent_updates(ChatUpdateProcessor(CONCURRENT_UPDATES))
+    base_url = base_url or TELEGRAM_API_URL
+    if base_url:
+        builder = builder.base_url(base_url)
+    if TELEGRAM_API_FILE_URL:
+        builder = builder.base_file_url(TELEGRAM_API_FILE_URL)
+    if TELEGRAM_API_LOCAL:
+        builder = builder.local_mode(True)
+    application = builder.build()
     # done_handler = MessageHandler(
     #     filters.Regex("^Done$"),
     #     start
@@ -776,6 +1246,7 @@ def main() -> None:
                 CallbackQueryHandler(end, pattern="^" + str(TWO) + "$"),
                 CallbackQueryHandler(next_page, pattern="^next_page$"),
                 CallbackQueryHandler(prev_page, pattern="^prev_page$"),
+                CallbackQueryHandler(switch_order, pattern="^switch_order$"),
                 CallbackQueryHandler(download_today, pattern="^download_today$"),
                 CallbackQueryHandler(download_last_sunday, pattern="^download_last_sunday$"),
                 CallbackQueryHandler(six_next_page, pattern="^six_next_page$"),
@@ -787,7 +1258,60 @@ def main() -> None:
     )
 
     application.add_handler(conv_handler)
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    return application
+
+
+def webhook_options() -> dict:
+    """Параметры run_webhook / Updater.start_webhook из переменных окружения."""
+    url_path = WEBHOOK_PATH
+    if url_path is None:
+        url_path = urllib.parse.urlsplit(WEBHOOK_URL or '').path
+    return {
+        'listen': WEBHOOK_LISTEN,
+        'port': WEBHOOK_PORT,
+        'url_path': url_path.strip('/'),
+        'webhook_url': WEBHOOK_URL,
+        'secret_token': WEBHOOK_SECRET_TOKEN,
+        'cert': WEBHOOK_CERT,
+        'key': WEBHOOK_KEY,
+        'allowed_updates': ALLOWED_UPDATES,
+    }
+
+
+def tmp_disk_usage():
+    return shutil.disk_usage(get_workspace().root)
+
+
+def start_metrics(port: int, addr: str = '127.0.0.1'):
+    """Подключает вычисляемые метрики и поднимает страницу /metrics."""
+    metrics.ARCHIVE_JOBS_PENDING.set_function(lambda: get_worker_pool().pending)
+    metrics.TMP_FREE_BYTES.set_function(lambda: tmp_disk_usage().free)
+    metrics.TMP_USED_BYTES.set_function(lambda: tmp_disk_usage().used)
+    metrics.WORKSPACE_USED_BYTES.set_function(lambda: get_workspace().used)
+    metrics.UPLOAD_THROUGHPUT.set_function(
+        lambda: get_upload_engine().stats()['bytes_per_second'])
+    server = metrics.start_http_server(port, addr)
+    logger.info("Метрики: http://%s:%s/metrics", addr, server.server_address[1])
+    return server
+
+
+def main() -> None:
+    check_env_vars()
+    if METRICS_PORT:
+        start_metrics(int(METRICS_PORT), METRICS_ADDR)
+    # Индекс и пул процессов поднимаются в фоне: polling начинается сразу,
+    # не дожидаясь обхода MOUNT_PATH и запуска процессов архивации
+    get_file_index()
+    get_worker_pool().start(background=True)
+    get_workspace().start()
+    # Запуск фоновой задачи очистки архивов
+    loop = asyncio.get_event_loop()
+    loop.create_task(periodic_clean_archives(interval=1800))
+    application = build_application()
+    if BOT_MODE == 'webhook':
+        application.run_webhook(**webhook_options())
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from core import stream_archive_parts
+
+logger = logging.getLogger(__name__)
+
+_DONE = '__done__'
+# Как часто ожидающий часть проверяет, жив ли воркер архивации
+READY_POLL_SECONDS = 0.5
+
+
+class JobCancelled(Exception):
+    """Задача отменена: пользователь ушёл или вызвал отмену."""
+
+
+class QueueFull(Exception):
+    """Очередь тяжёлых задач заполнена, новая задача не принята."""
+
+
+def _archive_worker(file_paths, archive_path, part_size, policy, ready, acks, cancel):
+    """
+    Выполняется в процессе пула: пишет архив частями и кладёт пути
+    готовых частей в ready. Перед каждой частью берёт acks, поэтому
+    вперёд потребителя уходит не больше заданного числа частей.
+    """
+    parts = stream_archive_parts(
+        file_paths, archive_path, part_size, policy=policy)
+    try:
+        for part in parts:
+            while not acks.acquire(timeout=0.5):
+                if cancel.is_set():
+                    break
+            if cancel.is_set():
+                os.remove(part)
+                break
+            ready.put(part)
+    except Exception as err:
+        ready.put(('error', f'{type(err).__name__}: {err}'))
+    finally:
+        parts.close()
+        ready.put(_DONE)
+
+
+class WorkerPool:
+    """
+    Пулы для работы, которой не место в event loop:
+    процессы для сжатия (cpu_workers) и потоки для блокирующего
+    ввода-вывода (io_workers). Одновременно выполняется не больше
+    max_jobs архиваций, ещё max_queued ждут; остальные получают QueueFull.
+    При cpu_workers=0 архивация идёт в потоках io-пула.
+    """
+
+    def __init__(self, cpu_workers: int = 2, io_workers: int = 4,
+                 max_jobs: int = 2, max_queued: int = 16,
+                 parts_ahead: int = 1) -> None:
+        self.cpu_workers = cpu_workers
+        self.io_workers = io_workers
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self.parts_ahead = parts_ahead
+        self.pending = 0
+        self._cpu = None
+        self._io = None
+        self._manager = None
+        self._slots = None
+        self._owners = defaultdict(set)
+        # Пулы создаются лениво и, возможно, из фонового прогрева
+        self._create_lock = threading.Lock()
+
+    @property
+    def io(self) -> ThreadPoolExecutor:
+        with self._create_lock:
+            if self._io is None:
+                self._io = ThreadPoolExecutor(
+                    self.io_workers, thread_name_prefix='usb-io')
+        return self._io
+
+    @property
+    def cpu(self):
+        with self._create_lock:
+            if self._cpu is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                self._cpu = ProcessPoolExecutor(
+                    self.cpu_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+        return self._cpu
+
+    @property
+    def manager(self):
+        with self._create_lock:
+            if self._manager is None:
+                import multiprocessing
+                self._manager = multiprocessing.get_context('spawn').Manager()
+        return self._manager
+
+    def start(self, background: bool = False) -> None:
+        """
+        Заранее поднимает процессы, чтобы первый архив не ждал их запуска.
+        С background=True прогрев идёт в отдельном потоке и не задерживает
+        старт бота.
+        """
+        if background:
+            threading.Thread(
+                target=self.start, name='worker-pool-warmup', daemon=True
+            ).start()
+            return
+        if self.cpu_workers:
+            self.manager
+            # Процессы пула создаются при отправке задач: по пустой задаче на каждый
+            futures = [self.cpu.submit(os.getpid) for _ in range(self.cpu_workers)]
+            for future in futures:
+                future.result()
+        self.io
+
+    async def run_io(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io, func, *args)
+
+    async def run_cpu(self, func, *args):
+        loop = asyncio.get_running_loop()
+        executor = self.cpu if self.cpu_workers else self.io
+        return await loop.run_in_executor(executor, func, *args)
+
+    def cancel(self, owner) -> int:
+        """Отменяет все задачи владельца owner (обычно chat_id)."""
+        events = self._owners.pop(owner, set())
+        for event in events:
+            event.set()
+        return len(events)
+
+    async def archive_parts(self, file_paths: list, archive_path: str,
+                            part_size: int, owner=None, policy=None):
+        """
+        Асинхронный генератор частей архива (см. stream_archive_parts),
+        который строится вне event loop. Часть нужно удалить после
+        использования. Бросает QueueFull, если очередь переполнена,
+        и JobCancelled после cancel(owner).
+        """
+        if self.pending >= self.max_jobs + self.max_queued:
+            raise QueueFull()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_jobs)
+        self.pending += 1
+        try:
+            async with self._slots:
+                async for part in self._archive_parts(
+                        file_paths, archive_path, part_size, owner, policy):
+                    yield part
+        finally:
+            self.pending -= 1
+
+    async def _archive_parts(self, file_paths, archive_path, part_size,
+                             owner, policy):
+        if self.cpu_workers:
+            manager = self.manager
+            ready = manager.Queue()
+            acks = manager.Semaphore(self.parts_ahead)
+            cancel = manager.Event()
+            executor = self.cpu
+        else:
+            ready = queue.Queue()
+            acks = threading.Semaphore(self.parts_ahead)
+            cancel = threading.Event()
+            executor = self.io
+        self._owners[owner].add(cancel)
+        loop = asyncio.get_running_loop()
+        job = loop.run_in_executor(
+            executor, _archive_worker,
+            file_paths, archive_path, part_size, policy, ready, acks, cancel
+        )
+        try:
+            while True:
+                item = await self._next_ready(ready, job)
+                if cancel.is_set():
+                    if isinstance(item, str) and item != _DONE:
+                        os.remove(item)
+                    raise JobCancelled()
+                if item == _DONE:
+                    break
+                if isinstance(item, tuple):
+                    raise RuntimeError(item[1])
+                yield item
+                acks.release()
+            await job
+        finally:
+            if not job.done():
+                cancel.set()
+                await asyncio.wait([job])
+                await self._drain(ready)
+            self._owners[owner].discard(cancel)
+            if not self._owners[owner]:
+                self._owners.pop(owner, None)
+
+    async def _next_ready(self, ready, job):
+        """
+        Следующий элемент ready. Если воркер завершился, так и не положив
+        _DONE (например, процесс пула убит), бросает его ошибку, а не ждёт вечно.
+        """
+        while True:
+            try:
+                return await self.run_io(ready.get, True, READY_POLL_SECONDS)
+            except queue.Empty:
+                if not job.done():
+                    continue
+            try:
+                # Воркер мог положить последний элемент перед самым завершением
+                return await self.run_io(ready.get_nowait)
+            except queue.Empty:
+                pass
+            err = job.exception() or RuntimeError("архивация завершилась без результата")
+            if isinstance(err, BrokenProcessPool):
+                # Сломанный пул не принимает задачи: следующий архив создаст новый
+                self._reset_cpu()
+            raise err
+
+    def _reset_cpu(self) -> None:
+        with self._create_lock:
+            cpu, self._cpu = self._cpu, None
+        if cpu is not None:
+            cpu.shutdown(wait=False, cancel_futures=True)
+
+    async def _drain(self, ready) -> None:
+        """Удаляет части, которые воркер успел положить в очередь."""
+        while not await self.run_io(ready.empty):
+            item = await self.run_io(ready.get)
+            if isinstance(item, str) and item != _DONE and os.path.exists(item):
+                os.remove(item)
+
+    def shutdown(self) -> None:
+        if self._cpu is not None:
+            self._cpu.shutdown(cancel_futures=True)
+            self._cpu = None
+        if self._io is not None:
+            self._io.shutdown(cancel_futures=True)
+            self._io = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+def pool_from_env() -> WorkerPool:
+    return WorkerPool(
+        cpu_workers=int(os.getenv('CPU_WORKERS', '2')),
+        io_workers=int(os.getenv('IO_WORKERS', '4')),
+        max_jobs=int(os.getenv('MAX_ARCHIVE_JOBS', '2')),
+        max_queued=int(os.getenv('MAX_QUEUED_JOBS', '16')),
+    )
+
+
+_pool: Optional[WorkerPool] = None
+
+
+def get_worker_pool() -> WorkerPool:
+    global _pool
+    if _pool is None:
+        _pool = pool_from_env()
+    return _pool
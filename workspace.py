@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from workers import QueueFull, get_worker_pool
+
+logger = logging.getLogger(__name__)
+
+# Префикс каталогов, которые создаёт Workspace
+LEASE_PREFIX = 'lease-'
+
+
+class WorkspaceFull(QueueFull):
+    """Во временном каталоге нет места под новую задачу."""
+
+
+class Lease:
+    """Каталог под одну задачу и зарезервированный под неё объём."""
+
+    def __init__(self, path: str, size: int,
+                 on_evict: Optional[Callable[[], None]] = None) -> None:
+        self.path = path
+        self.size = size
+        self.refs = 0
+        self.done = False
+        self.on_evict = on_evict
+
+
+class Workspace:
+    """
+    Каталог root для архивов и частей с бюджетом budget байт (0 — только
+    свободное место на диске, за вычетом min_free). Место резервируется
+    до начала записи (reserve), после записи резерв уточняется по факту
+    (commit). Когда места не хватает, удаляются готовые каталоги без
+    ссылок, начиная с давно не использованных (LRU); пока на каталог
+    есть ссылки (pin), он не удаляется. Если места нет и так, reserve
+    ждёт освобождения до wait секунд и бросает WorkspaceFull.
+    Обход, удаление каталогов и опрос диска идут в потоках WorkerPool.
+    """
+
+    def __init__(self, root: Optional[str] = None, budget: int = 0,
+                 min_free: int = 0, wait: float = 60.0) -> None:
+        self.root = root or os.path.join(tempfile.gettempdir(), 'usb_bot')
+        self.budget = budget
+        self.min_free = min_free
+        self.wait = wait
+        # Порядок — от давно не использованных к недавним
+        self._leases = OrderedDict()
+        self._changed = None
+        # Проверка места и создание каталога — одна операция для reserve
+        self._reserving = None
+
+    def __len__(self) -> int:
+        return len(self._leases)
+
+    @property
+    def used(self) -> int:
+        return sum(lease.size for lease in self._leases.values())
+
+    def start(self) -> None:
+        """Создаёт root и удаляет каталоги, оставшиеся от прошлого запуска."""
+        os.makedirs(self.root, exist_ok=True)
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(LEASE_PREFIX) and path not in self._leases:
+                shutil.rmtree(path, ignore_errors=True)
+
+    async def reserve(self, size: int, on_evict: Optional[Callable[[], None]] = None) -> Lease:
+        """
+        Резервирует size байт и создаёт под них каталог. on_evict()
+        вызывается, если каталог удалён ради места для других задач.
+        """
+        if self.budget and size > self.budget:
+            raise WorkspaceFull(
+                f"нужно {size // 2 ** 20} МБ, бюджет временного каталога "
+                f"{self.budget // 2 ** 20} МБ")
+        deadline = time.monotonic() + self.wait
+        if self._reserving is None:
+            self._reserving = asyncio.Lock()
+        while True:
+            changed = self._event()
+            async with self._reserving:
+                if await self._fits(size):
+                    path = await get_worker_pool().run_io(self._mkdtemp)
+                    lease = Lease(path, size, on_evict)
+                    self._leases[path] = lease
+                    return lease
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise WorkspaceFull("нет места во временном каталоге")
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def pin(self, lease: Lease) -> None:
+        lease.refs += 1
+        if lease.path in self._leases:
+            self._leases.move_to_end(lease.path)
+
+    def unpin(self, lease: Lease) -> None:
+        lease.refs -= 1
+        if lease.path in self._leases:
+            self._leases.move_to_end(lease.path)
+        self._notify()
+
+    async def commit(self, lease: Lease) -> None:
+        """Запись закончена: резерв заменяется фактическим размером каталога."""
+        lease.size = await get_worker_pool().run_io(_tree_size, lease.path)
+        lease.done = True
+        self._notify()
+
+    async def remove(self, lease: Lease) -> None:
+        if self._leases.pop(lease.path, None) is not None:
+            self._notify()
+        await get_worker_pool().run_io(shutil.rmtree, lease.path, True)
+
+    async def _fits(self, size: int) -> bool:
+        while not await self._has_room(size):
+            victim = next((lease for lease in self._leases.values()
+                           if lease.done and lease.refs <= 0), None)
+            if victim is None:
+                return False
+            logger.info("Освобождаю место: удаляю %s (%s байт)", victim.path, victim.size)
+            await self.remove(victim)
+            if victim.on_evict is not None:
+                victim.on_evict()
+        return True
+
+    async def _has_room(self, size: int) -> bool:
+        if self.budget and self.used + size > self.budget:
+            return False
+        pending = [(lease.path, lease.size) for lease in self._leases.values()
+                   if not lease.done]
+        free = await get_worker_pool().run_io(_free_space, self.root, pending)
+        return free - size >= self.min_free
+
+    def _mkdtemp(self) -> str:
+        os.makedirs(self.root, exist_ok=True)
+        return tempfile.mkdtemp(prefix=LEASE_PREFIX, dir=self.root)
+
+    def _event(self) -> asyncio.Event:
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    def _notify(self) -> None:
+        if self._changed is not None:
+            event, self._changed = self._changed, None
+            event.set()
+
+
+def _free_space(root: str, pending: list) -> int:
+    """
+    Свободное место в root за вычетом ещё не записанного остатка
+    резервов pending [(каталог, резерв)]: записанное уже не входит в free.
+    """
+    os.makedirs(root, exist_ok=True)
+    free = shutil.disk_usage(root).free
+    return free - sum(max(size - _tree_size(path), 0) for path, size in pending)
+
+
+def _tree_size(path: str) -> int:
+    total = 0
+    for dirpath, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total